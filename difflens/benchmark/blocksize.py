@@ -0,0 +1,118 @@
+# Benchmark of the read path used for hashing, sweeping read block sizes with buffered and direct reads and reporting
+# the throughput and CPU time of each. Run with `python3 -m difflens.benchmark.blocksize --scan-directory /mnt/disk1`
+# to pick --read-block-size-kb for that disk, or without --scan-directory to use a synthetic tree
+import argparse
+# Used to evict files from the page cache between passes, and to construct paths
+import os
+from os import path
+# Used to create a throwaway directory for the synthetic tree
+from tempfile import TemporaryDirectory
+# Used to time each pass, both wall clock and CPU time of this process
+from time import perf_counter, process_time
+
+# Used for computing the hash of a file on disk
+# https://github.com/oconnor663/blake3-py
+from blake3 import blake3
+
+from difflens.benchmark.treegen import generate_tree
+from difflens.util.directorywalker import walk_directory
+from difflens.util.loghelper import get_logger_with_name
+from difflens.util.pathExcluder import PathExcluder
+from difflens.util.readengine import ReadEngine
+
+
+# Hash every file the way compute_full_hash() did before ReadEngine, with a new bytes object per read()
+def hash_with_read(file_paths, read_block_size):
+    bytes_read = 0
+    for file_path in file_paths:
+        blake3_hasher = blake3()
+        with open(file_path, "rb") as stream:
+            while True:
+                data = stream.read(read_block_size)
+                if not data:
+                    break
+                blake3_hasher.update(data)
+                bytes_read += len(data)
+    return bytes_read
+
+
+# Hash every file with a ReadEngine
+def hash_with_read_engine(file_paths, read_engine):
+    bytes_read = 0
+    for file_path in file_paths:
+        with read_engine.open(file_path) as file_descriptor:
+            bytes_read += read_engine.hash_range(file_descriptor, blake3(), 0)
+    return bytes_read
+
+
+# Ask the kernel to drop every file from the page cache, so each pass reads from disk rather than memory. Only clean
+# pages can be dropped, which is all of them for files that are only being read
+def evict_from_page_cache(file_paths):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for file_path in file_paths:
+        file_descriptor = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(file_descriptor)
+
+
+# Run one configuration, returning a Tuple of (MB per second, CPU seconds per GB read)
+def run_pass(file_paths, warm_cache, hash_function, *args):
+    if not warm_cache:
+        evict_from_page_cache(file_paths)
+    start_time = perf_counter()
+    start_cpu_time = process_time()
+    bytes_read = hash_function(file_paths, *args)
+    elapsed_seconds = perf_counter() - start_time
+    cpu_seconds = process_time() - start_cpu_time
+    return bytes_read / 1000 / 1000 / elapsed_seconds, cpu_seconds / max(bytes_read / 1000 / 1000 / 1000, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare read block sizes and read modes for hashing files")
+    parser.add_argument("--scan-directory", "-s", help="Existing directory whose files are hashed, ideally on the disk "
+                                                       "being tuned", type=str)
+    parser.add_argument("--file-count", "-n", help="Amount of files in the synthetic tree", type=int, default=200)
+    parser.add_argument("--max-file-size-bytes", help="Largest file size in the synthetic tree", type=int,
+                        default=16 * 2 ** 20)
+    parser.add_argument("--block-sizes-kb", help="Read block sizes to try, in KB", type=int, nargs="+",
+                        default=[64, 256, 1024, 4096, 16384])
+    parser.add_argument("--warm-cache", help="Leave files in the page cache between passes, measuring CPU cost rather "
+                                             "than disk throughput", action="store_true")
+    parser.add_argument("--skip-direct-io", help="Don't try O_DIRECT reads", action="store_true")
+    args = parser.parse_args()
+    logger = get_logger_with_name("Benchmark", "INFO")
+    # Keep the PathExcluder quiet, as its per-directory logging would dominate the output
+    path_excluder = PathExcluder(None, None, "WARNING")
+
+    with TemporaryDirectory(prefix="difflens-benchmark-") as temporary_directory:
+        path_to_process = args.scan_directory
+        if path_to_process is None:
+            path_to_process = path.join(temporary_directory, "tree")
+            logger.info("Generating synthetic tree of {} files up to {} bytes at {}".format(
+                args.file_count, args.max_file_size_bytes, path_to_process))
+            generate_tree(path_to_process, args.file_count, max_file_size_bytes=args.max_file_size_bytes)
+        path_to_process = path.abspath(path_to_process)
+        file_paths = [absolute_file_path for _, file_entries in walk_directory(path_to_process, path_excluder, None,
+                                                                               logger)
+                      for absolute_file_path, _, _ in file_entries]
+        logger.info("Hashing {} files per pass with the page cache {}".format(
+            len(file_paths), "kept warm" if args.warm_cache else "dropped before each pass"))
+        for block_size_kb in args.block_sizes_kb:
+            read_block_size = block_size_kb * 2 ** 10
+            configurations = [("read()", hash_with_read, read_block_size),
+                              ("readinto", hash_with_read_engine, ReadEngine(read_block_size, False, False, "WARNING"))]
+            if not args.skip_direct_io:
+                configurations.append(("O_DIRECT", hash_with_read_engine,
+                                       ReadEngine(read_block_size, False, True, "WARNING")))
+            for name, hash_function, configuration in configurations:
+                mb_per_second, cpu_seconds_per_gb = run_pass(file_paths, args.warm_cache, hash_function,
+                                                             configuration)
+                logger.info("{:>6}KB {:<8}: {:7.0f}MBps, {:5.2f} CPU seconds per GB".format(
+                    block_size_kb, name, mb_per_second, cpu_seconds_per_gb))
+
+
+if __name__ == "__main__":
+    main()
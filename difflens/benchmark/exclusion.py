@@ -0,0 +1,174 @@
+# Benchmark of checking directories and files against hundreds of exclusion rules, comparing the original loops of
+# startswith() and endswith() per rule against the compiled matching of PathExcluder. Run with
+# `python3 -m difflens.benchmark.exclusion` and optionally --rule-count, or --scan-directory to use real paths
+import argparse
+# Used to walk an existing directory for its relative paths
+from os import path, walk
+# Used to compile the .gitignore style patterns one at a time, the way a loop over rules would match them
+import re
+# Used to generate the same rules and paths on every run
+from random import Random
+# Used to time each matcher
+from time import perf_counter
+
+from difflens.util.loghelper import get_logger_with_name
+from difflens.util.pathExcluder import PathExcluder, sanitize_and_dedupe_extension_list, \
+    sanitize_and_dedupe_path_list, translate_glob
+
+# Characters the synthetic directory and file names are made of
+NAME_CHARACTERS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+# Return a random name of 3 to 10 characters
+def random_name(random):
+    return "".join(random.choice(NAME_CHARACTERS) for _ in range(random.randint(3, 10)))
+
+
+# Generate the relative directory paths and a Tuple of (file name, relative file path) for each file of a synthetic tree
+def generate_paths(random, directory_count, files_per_directory, extensions):
+    directory_paths = []
+    file_paths = []
+    for _ in range(directory_count):
+        # Nest new directories under existing ones, so excluded prefixes cover whole subtrees
+        parent = random.choice(directory_paths) + "/" if directory_paths and random.random() < 0.7 else ""
+        directory_path = parent + random_name(random)
+        directory_paths.append(directory_path)
+        for _ in range(files_per_directory):
+            file_name = random_name(random) + random.choice(extensions)
+            file_paths.append((file_name, directory_path + "/" + file_name))
+    return directory_paths, file_paths
+
+
+# Collect the relative directory paths and files of an existing directory, the way the walker names them
+def collect_paths(scan_directory):
+    directory_paths = []
+    file_paths = []
+    for abs_dir_path, _, files in walk(scan_directory):
+        rel_dir_path = path.relpath(abs_dir_path, scan_directory)
+        directory_paths.append(rel_dir_path)
+        for file in files:
+            file_paths.append((file, file if rel_dir_path == "." else rel_dir_path + "/" + file))
+    return directory_paths, file_paths
+
+
+# Generate rule_count excluded directories, extensions, and .gitignore style patterns, drawing the directories from
+# those in directory_paths so some of them match
+def generate_rules(random, rule_count, directory_paths):
+    path_rules = ["./" + random.choice(directory_paths) + "/" for _ in range(rule_count)]
+    extension_rules = ["*." + random_name(random)[:4] for _ in range(rule_count)]
+    glob_rules = []
+    for _ in range(rule_count):
+        # Half of the patterns name an existing directory, so they match some paths
+        name = random_name(random) if random.random() < 0.5 else random.choice(directory_paths).rpartition("/")[2]
+        glob_rules.append(random.choice(["*{}*.tmp", "{}/", "**/{}/*.bak", "/{}", "{}?.log"]).format(name))
+    return path_rules, extension_rules, glob_rules
+
+
+# Check every path the way PathExcluder did before compiling its rules, with one startswith() or endswith() per rule.
+# Returns the amount of directories and files excluded
+def match_with_loops(directory_paths, file_paths, path_rules, extension_rules):
+    path_list = sanitize_and_dedupe_path_list(path_rules)
+    extension_list = sanitize_and_dedupe_extension_list(extension_rules)
+    excluded_count = 0
+    for directory_path in directory_paths:
+        for path_string in path_list:
+            if directory_path.startswith(path_string):
+                excluded_count += 1
+                break
+    for file_name, _ in file_paths:
+        for extension_string in extension_list:
+            if file_name.endswith(extension_string):
+                excluded_count += 1
+                break
+    return excluded_count
+
+
+# Check every path against the .gitignore style patterns with one regular expression per pattern
+def match_globs_with_loops(directory_paths, file_paths, glob_rules):
+    regexes = [(re.compile(pattern + r"\Z"), directory_only) for pattern, directory_only, _ in
+               [translate_glob(glob) for glob in glob_rules]]
+    excluded_count = 0
+    for directory_path in directory_paths:
+        if any(regex.match(directory_path) for regex, _ in regexes):
+            excluded_count += 1
+    for _, relative_path in file_paths:
+        if any(regex.match(relative_path) for regex, directory_only in regexes if not directory_only):
+            excluded_count += 1
+    return excluded_count
+
+
+# Check every path with a PathExcluder, returning the amount of directories and files excluded
+def match_with_path_excluder(directory_paths, file_paths, path_excluder):
+    excluded_count = 0
+    for directory_path in directory_paths:
+        if path_excluder.is_excluded_dir(directory_path):
+            excluded_count += 1
+    for file_name, relative_path in file_paths:
+        if path_excluder.is_excluded_file(file_name, relative_path):
+            excluded_count += 1
+    return excluded_count
+
+
+# Time a matcher several times and return the fastest run in seconds, along with the amount of paths it excluded
+def time_best_of(repeat_count, matcher, *args):
+    best_seconds = None
+    excluded_count = 0
+    for _ in range(repeat_count):
+        start_time = perf_counter()
+        excluded_count = matcher(*args)
+        elapsed_seconds = perf_counter() - start_time
+        if best_seconds is None or elapsed_seconds < best_seconds:
+            best_seconds = elapsed_seconds
+    return best_seconds, excluded_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare looping over exclusion rules against PathExcluder's "
+                                                 "compiled matching")
+    parser.add_argument("--rule-count", "-n", help="Amount of rules of each kind: directories, extensions, and "
+                                                   "patterns", type=int, default=300)
+    parser.add_argument("--directory-count", "-d", help="Amount of directories in the synthetic paths", type=int,
+                        default=5000)
+    parser.add_argument("--files-per-directory", "-f", help="Amount of files in each synthetic directory", type=int,
+                        default=20)
+    parser.add_argument("--repeat-count", "-r", help="Times to check the paths with each matcher, keeping the fastest",
+                        type=int, default=5)
+    parser.add_argument("--scan-directory", "-s", help="Existing directory to take paths from instead of generating "
+                                                       "them", type=str)
+    args = parser.parse_args()
+    logger = get_logger_with_name("Benchmark", "INFO")
+    random = Random(0)
+
+    extensions = [".jpg", ".mkv", ".txt", ".nfo", ".tmp", ".bak", ".log"]
+    if args.scan_directory is None:
+        directory_paths, file_paths = generate_paths(random, args.directory_count, args.files_per_directory,
+                                                     extensions)
+    else:
+        directory_paths, file_paths = collect_paths(path.abspath(args.scan_directory))
+    path_rules, extension_rules, glob_rules = generate_rules(random, args.rule_count, directory_paths)
+    logger.info("Checking {} directories and {} files against {} rules of each kind".format(
+        len(directory_paths), len(file_paths), args.rule_count))
+
+    # Keep the PathExcluders quiet, as their per-directory logging would dominate the timings
+    rule_excluder = PathExcluder(extension_rules, path_rules, "WARNING")
+    glob_excluder = PathExcluder(None, None, "WARNING", glob_rules)
+    results = [
+        ("Directory and extension loops", time_best_of(args.repeat_count, match_with_loops, directory_paths,
+                                                       file_paths, path_rules, extension_rules)),
+        ("Directory and extension PathExcluder", time_best_of(args.repeat_count, match_with_path_excluder,
+                                                              directory_paths, file_paths, rule_excluder)),
+        ("Pattern loops", time_best_of(args.repeat_count, match_globs_with_loops, directory_paths, file_paths,
+                                       glob_rules)),
+        ("Pattern PathExcluder", time_best_of(args.repeat_count, match_with_path_excluder, directory_paths,
+                                              file_paths, glob_excluder))]
+
+    path_count = len(directory_paths) + len(file_paths)
+    for name, (seconds, excluded_count) in results:
+        logger.info("{}: excluded {} of {} paths in {:.3f} seconds, or {:.2f} microseconds per path".format(
+            name, excluded_count, path_count, seconds, seconds / max(path_count, 1) * 1000000))
+    for (loop_name, (loop_seconds, _)), (excluder_name, (excluder_seconds, _)) in [results[0:2], results[2:4]]:
+        logger.info("{} was {:.2f}x as fast as {}".format(excluder_name, loop_seconds / excluder_seconds, loop_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Check and benchmark of reading hash files with pyarrow's parser against pandas' C parser. Hash files are written
+# with awkward relative paths, such as ones holding tabs, quotes, backslashes, or line breaks, and read back with each
+# parser, which must produce identical DataFrames. Requires pyarrow. Run with
+# `python3 -m difflens.benchmark.hashread` and optionally --row-count. Exits with 1 if the parsers disagree
+import argparse
+# Used to construct paths
+from os import path
+# Used to generate the same rows on every run
+from random import Random
+# Used to create a throwaway directory for the hash files
+from tempfile import TemporaryDirectory
+# Used to time each parser
+from time import perf_counter
+
+# Used to create the DataFrame written to the hash files
+from pandas import DataFrame
+
+from difflens.util.carryforward import METADATA_COLUMNS
+from difflens.util.compareMode import CompareMode
+from difflens.util.hashfileio import PYARROW_AVAILABLE, get_read_csv_arguments, read_csv_with_pandas, \
+    read_csv_with_pyarrow, read_hash_file_header, write_hashes_to_file
+from difflens.util.loghelper import get_logger_with_name
+
+# Names that trip up delimited parsers, mixed into the generated relative paths
+AWKWARD_NAMES = ["tab\there", "line\nbreak", "carriage\rreturn", "quote\"d", "back\\slash", "trailing\\", "NA", "null",
+                 "nan", "#comment", "  spaced  ", "ünïcödé"]
+
+
+# Generate row_count rows of a full-hash hash file, a share of them with awkward relative paths
+def generate_data_frame(random, row_count):
+    relative_paths = []
+    for row_index in range(row_count):
+        name = random.choice(AWKWARD_NAMES) if random.random() < 0.1 else "file{}.bin".format(row_index)
+        relative_paths.append("dir{}/{}{}".format(row_index % 100, row_index, name))
+    return DataFrame({
+        "relative_path": relative_paths,
+        "hash": ["{:064x}".format(random.getrandbits(256)) for _ in range(row_count)],
+        "file_size_bytes": [random.randint(0, 2 ** 40) for _ in range(row_count)],
+        **{column_name: [random.randint(0, 2 ** 62) for _ in range(row_count)] for column_name in METADATA_COLUMNS}})
+
+
+# Read input_path with read_hash_csv, falling back to reading integer columns as floats the way
+# read_hashes_from_file() does. Returns the DataFrame and the seconds it took
+def time_read(read_hash_csv, input_path):
+    read_csv_arguments = get_read_csv_arguments(read_hash_file_header(input_path), None, "default")
+    start_time = perf_counter()
+    try:
+        data_frame = read_hash_csv(input_path, read_csv_arguments)
+    except ValueError:
+        read_csv_arguments["dtype"] = {column_name: column_dtype for column_name, column_dtype
+                                       in read_csv_arguments["dtype"].items() if column_dtype != "int64"}
+        data_frame = read_hash_csv(input_path, read_csv_arguments)
+    return data_frame, perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that pyarrow and pandas' C parser read hash files the same, "
+                                                 "and compare how fast they are")
+    parser.add_argument("--row-count", "-n", help="Amount of rows in each hash file", type=int, default=200000)
+    args = parser.parse_args()
+    logger = get_logger_with_name("Benchmark", "INFO")
+    if not PYARROW_AVAILABLE:
+        logger.error("pyarrow is not installed, install it with `pip3 install pyarrow`. Exiting")
+        exit(1)
+    random = Random(0)
+    data_frame = generate_data_frame(random, args.row_count)
+    # Rows combined from older hash files may be missing their metadata, which have to be read as floats
+    missing_data_frame = data_frame.astype({column_name: "float64" for column_name in METADATA_COLUMNS})
+    missing_data_frame.loc[::7, METADATA_COLUMNS] = None
+
+    mismatches = 0
+    with TemporaryDirectory(prefix="difflens-benchmark-") as temporary_directory:
+        for file_name, file_data_frame in [("hashes.tsv", data_frame), ("missing.tsv", missing_data_frame),
+                                           ("hashes.tsv.gz", data_frame)]:
+            input_path = path.join(temporary_directory, file_name)
+            write_hashes_to_file(file_data_frame, input_path, logger, CompareMode.FULL.value)
+            pandas_data_frame, pandas_seconds = time_read(read_csv_with_pandas, input_path)
+            pyarrow_data_frame, pyarrow_seconds = time_read(read_csv_with_pyarrow, input_path)
+            # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.equals.html
+            if not pandas_data_frame.equals(pyarrow_data_frame):
+                logger.error("{}: pyarrow read {} rows with dtypes {}, which differ from the {} rows with dtypes {} "
+                             "read by the C parser".format(file_name, len(pyarrow_data_frame.index),
+                                                           pyarrow_data_frame.dtypes.to_dict(),
+                                                           len(pandas_data_frame.index),
+                                                           pandas_data_frame.dtypes.to_dict()))
+                mismatches += 1
+                continue
+            logger.info("{}: both parsers read the same {} rows, the C parser in {:.3f} seconds and pyarrow in {:.3f} "
+                        "seconds, {:.2f}x as fast".format(file_name, len(pandas_data_frame.index), pandas_seconds,
+                                                          pyarrow_seconds, pandas_seconds / pyarrow_seconds))
+    if mismatches > 0:
+        logger.error("pyarrow read {} hash files differently from the C parser. Exiting".format(mismatches))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Benchmark of every stage of the difflens pipeline, from walking a tree through hashing, building and writing the
+# DataFrame, reading it back, and the comparison analyses. Each scale runs in its own process so its peak memory is its
+# own. Run with `python3 -m difflens.benchmark.stages --output-file results.json`, optionally with --file-count to pick
+# the scales, or --scan-directory to time a real tree
+import argparse
+# Used to write the results in a machine-readable format
+import json
+# Used to construct paths
+from os import path
+# Used to report the Python and platform the benchmark ran on
+import platform
+# Used to read the peak resident memory of the process, which the kernel tracks for us
+import resource
+# Used to run each scale in a fresh process
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+# Used to pick which rows of the comparison DataFrame to change
+from random import Random
+# Used to create a throwaway directory for the synthetic tree and hash file
+from tempfile import TemporaryDirectory
+# Used to time each stage
+from time import perf_counter
+
+# Used to get the current resident memory of the process
+# https://psutil.readthedocs.io/en/latest/#psutil.Process.memory_info
+import psutil
+# Used to combine the current DataFrame with the rows standing in for removed files
+from pandas import concat
+
+from difflens.benchmark.treegen import add_tree_arguments, generate_tree_from_args
+from difflens.util.compareMode import CompareMode
+from difflens.util.comparefiles import classify_changes, determine_duplicate_files, determine_modified_files, \
+    determine_removed_files
+from difflens.util.computediffs import hash_file
+from difflens.util.directorywalker import walk_directory
+from difflens.util.hashfileio import read_hashes_from_files, write_hashes_to_file
+from difflens.util.loghelper import get_logger_with_name
+from difflens.util.pathExcluder import PathExcluder
+from difflens.util.readengine import ReadEngine
+from difflens.util.scanaccumulator import ScanAccumulator
+
+# Bytes hashed per file in partial-hash mode, the same as difflens uses
+BYTE_COUNT_TO_HASH = 1000000
+
+
+# Return the resident memory of this process right now and the most it has ever been, both in MB
+def get_memory_mb():
+    current_rss_mb = psutil.Process().memory_info().rss / 1000 / 1000
+    # https://docs.python.org/3/library/resource.html#resource.getrusage
+    # On Linux, ru_maxrss is in KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 / 1000 / 1000
+    return current_rss_mb, peak_rss_mb
+
+
+# Run function(*args), appending how long it took and the memory in use afterwards to stage_results under stage_name.
+# item_count is the amount of files the stage handled, used to compute its rate. Returns what function returned
+def time_stage(stage_results, stage_name, item_count, logger, function, *args):
+    start_time = perf_counter()
+    result = function(*args)
+    elapsed_seconds = perf_counter() - start_time
+    current_rss_mb, peak_rss_mb = get_memory_mb()
+    stage_results.append({"stage": stage_name, "seconds": elapsed_seconds, "files": item_count,
+                          "files_per_second": item_count / elapsed_seconds if elapsed_seconds > 0 else None,
+                          "rss_mb": current_rss_mb, "peak_rss_mb": peak_rss_mb})
+    logger.info("{:<24} {:>9.3f} seconds, {:>12.0f} files per second, {:>8.1f}MB resident, {:>8.1f}MB peak".format(
+        stage_name, elapsed_seconds, item_count / max(elapsed_seconds, 1e-9), current_rss_mb, peak_rss_mb))
+    return result
+
+
+# Return every file under path_to_process as a list of (absolute_file_path, relative_file_path, os.stat_result)
+def walk_files(path_to_process, path_excluder, logger):
+    return [file_entry for _, file_entries in walk_directory(path_to_process, path_excluder, path_to_process, logger)
+            for file_entry in file_entries]
+
+
+# Hash every file in compare_mode, returning a list of the hash difflens would store for each and the bytes read
+def hash_files(file_entries, compare_mode, read_engine):
+    file_hashes = []
+    bytes_read = 0
+    for absolute_file_path, _, file_stat in file_entries:
+        partial_hash, file_fully_hashed, full_hash = hash_file(absolute_file_path, file_stat.st_size,
+                                                               BYTE_COUNT_TO_HASH, compare_mode, read_engine)
+        file_hashes.append(full_hash or partial_hash)
+        bytes_read += file_stat.st_size if file_fully_hashed or full_hash else BYTE_COUNT_TO_HASH
+    return file_hashes, bytes_read
+
+
+# Build the sorted DataFrame of a scan the way compute_diffs() and run.py do, through a ScanAccumulator
+def build_data_frame(file_entries, file_hashes):
+    scan_accumulator = ScanAccumulator(True)
+    for (_, relative_file_path, file_stat), file_hash in zip(file_entries, file_hashes):
+        scan_accumulator.append(relative_file_path, file_hash, file_stat.st_size,
+                                (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev))
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.sort_values.html
+    return scan_accumulator.to_data_frame().sort_values("relative_path", ignore_index=True)
+
+
+# Make a comparison DataFrame out of the current one, as if change_ratio of its files were added since, change_ratio
+# were modified, and as many again were removed, so every analysis has rows to find
+def make_comparison_data_frame(data_frame, change_ratio, seed):
+    random = Random(seed)
+    row_count = len(data_frame.index)
+    changed_count = int(row_count * change_ratio)
+    changed_rows = random.sample(range(row_count), min(changed_count * 2, row_count))
+    # Files missing from the comparison show up as added
+    comparison_data_frame = data_frame.drop(index=changed_rows[:changed_count])
+    # Files with a different hash in the comparison show up as modified
+    modified_rows = changed_rows[changed_count:]
+    comparison_data_frame.loc[modified_rows, "hash"] = comparison_data_frame.loc[modified_rows, "hash"].str[::-1]
+    # Files only in the comparison show up as removed
+    removed_data_frame = data_frame.iloc[:changed_count].copy()
+    removed_data_frame["relative_path"] = "removed" + path.sep + removed_data_frame["relative_path"]
+    return concat([comparison_data_frame, removed_data_frame], ignore_index=True)
+
+
+# Time every stage on one tree of file_count files, returning a Dict of the results for that scale. Run in its own
+# process, so the peak memory reported is this scale's alone
+def run_scale(file_count, args):
+    logger = get_logger_with_name("Benchmark", "INFO")
+    # Keep the PathExcluder and ReadEngine quiet, as their logging would dominate the output
+    path_excluder = PathExcluder(None, None, "WARNING")
+    read_engine = ReadEngine(log_level="WARNING")
+    stage_results = []
+    with TemporaryDirectory(prefix="difflens-benchmark-") as temporary_directory:
+        path_to_process = args.scan_directory
+        if path_to_process is None:
+            path_to_process = path.join(temporary_directory, "tree")
+            logger.info("Generating synthetic tree of {} files at {}".format(file_count, path_to_process))
+            time_stage(stage_results, "generate_tree", file_count, logger, generate_tree_from_args, path_to_process,
+                       args, file_count)
+        path_to_process = path.abspath(path_to_process)
+
+        file_entries = walk_files(path_to_process, path_excluder, logger)
+        # Time a second walk, so the directory cache is equally warm whether or not the tree was just generated
+        file_entries = time_stage(stage_results, "walk", len(file_entries), logger, walk_files, path_to_process,
+                                  path_excluder, logger)
+        file_count = len(file_entries)
+        _, partial_bytes_read = time_stage(stage_results, "partial_hash", file_count, logger, hash_files,
+                                           file_entries, CompareMode.PARTIAL.value, read_engine)
+        stage_results[-1]["bytes_read"] = partial_bytes_read
+        file_hashes, full_bytes_read = time_stage(stage_results, "full_hash", file_count, logger, hash_files,
+                                                  file_entries, CompareMode.FULL.value, read_engine)
+        stage_results[-1]["bytes_read"] = full_bytes_read
+        # ScanAccumulator.to_data_frame() replaced flatten_dict_to_data_frame() as the step building the DataFrame
+        data_frame = time_stage(stage_results, "build_data_frame", file_count, logger, build_data_frame,
+                                file_entries, file_hashes)
+        del file_entries, file_hashes
+
+        hash_file_path = path.join(temporary_directory, args.hash_file_name)
+        time_stage(stage_results, "write_hashes_to_file", file_count, logger, write_hashes_to_file, data_frame,
+                   hash_file_path, logger, CompareMode.FULL.value)
+        stage_results[-1]["hash_file_bytes"] = path.getsize(hash_file_path)
+        data_frame = time_stage(stage_results, "read_hashes_from_files", file_count, logger, read_hashes_from_files,
+                                [hash_file_path], logger, CompareMode.FULL.value)
+
+        comparison_data_frame = make_comparison_data_frame(data_frame, args.change_ratio, args.seed)
+        time_stage(stage_results, "determine_removed_files", file_count, logger, determine_removed_files,
+                   comparison_data_frame, data_frame)
+        time_stage(stage_results, "determine_added_files", file_count, logger, determine_removed_files, data_frame,
+                   comparison_data_frame)
+        time_stage(stage_results, "determine_modified_files", file_count, logger, determine_modified_files,
+                   data_frame, comparison_data_frame)
+        time_stage(stage_results, "determine_duplicate_files", file_count, logger, determine_duplicate_files,
+                   data_frame, "hash", ["hash", "relative_path", "file_size_bytes"])
+        time_stage(stage_results, "classify_changes", file_count, logger, classify_changes, data_frame,
+                   comparison_data_frame)
+
+    _, peak_rss_mb = get_memory_mb()
+    return {"file_count": file_count, "peak_rss_mb": peak_rss_mb, "stages": stage_results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the difflens pipeline at one or more scales")
+    add_tree_arguments(parser, [10000, 100000, 1000000])
+    parser.add_argument("--scan-directory", "-s", help="Existing directory to benchmark instead of a synthetic tree, "
+                                                       "which ignores the tree arguments", type=str)
+    parser.add_argument("--hash-file-name", help="Name of the hash file written and read back, whose extension picks "
+                                                 "its format, such as .tsv.gz or .dlh", type=str, default="hashes.tsv")
+    parser.add_argument("--change-ratio", help="Share of files, from 0 to 0.5, that are added, removed, and modified "
+                                               "between the current and comparison DataFrames", type=float,
+                        default=0.05)
+    parser.add_argument("--output-file", "-o", help="Path to write the results to as JSON, otherwise they are printed",
+                        type=str)
+    args = parser.parse_args()
+    logger = get_logger_with_name("Benchmark", "INFO")
+    if not 0 <= args.change_ratio <= 0.5:
+        logger.error("--change-ratio must be between 0 and 0.5, exiting")
+        exit(1)
+
+    file_counts = [None] if args.scan_directory is not None else args.file_count
+    scale_results = []
+    for file_count in file_counts:
+        # Spawn rather than fork, so each scale starts from an empty process and reports only its own peak memory
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            scale_result = executor.submit(run_scale, file_count, args).result()
+        logger.info("{} files peaked at {:.1f}MB resident".format(scale_result["file_count"],
+                                                                  scale_result["peak_rss_mb"]))
+        scale_results.append(scale_result)
+
+    results = {"python_version": platform.python_version(), "platform": platform.platform(),
+               "scan_directory": args.scan_directory, "scales": scale_results}
+    if args.output_file is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output_file, "w") as stream:
+            json.dump(results, stream, indent=2)
+        logger.info("Wrote results to {}".format(args.output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Used to get CLI args when generating a tree on its own
+import argparse
+# Used to pick lognormal file sizes around a median
+import math
+# Used to create the directories and files of a synthetic tree
+from os import makedirs, path
+# Used to create duplicate files by copying earlier ones
+from shutil import copyfile
+# Used to deterministically pick file sizes, so repeated benchmark runs see the same tree
+from random import Random
+
+
+# File size distributions generate_tree() can pick from:
+# - uniform picks every size between the min and max with equal odds
+# - lognormal clusters sizes around the median with a long tail of larger files, much like real collections of files
+SIZE_DISTRIBUTIONS = ["uniform", "lognormal"]
+# Spread of the lognormal distribution, as the standard deviation of the natural log of the file size
+LOGNORMAL_SIGMA = 1.5
+
+
+# Pick a file size from size_distribution, clamped between min_file_size_bytes and max_file_size_bytes
+def pick_file_size(random, size_distribution, min_file_size_bytes, max_file_size_bytes, median_file_size_bytes):
+    if size_distribution == "lognormal":
+        # https://docs.python.org/3/library/random.html#random.lognormvariate
+        file_size_bytes = int(random.lognormvariate(math.log(max(median_file_size_bytes, 1)), LOGNORMAL_SIGMA))
+        return min(max(file_size_bytes, min_file_size_bytes), max_file_size_bytes)
+    return random.randint(min_file_size_bytes, max_file_size_bytes)
+
+
+# Create a synthetic tree of file_count files under output_directory, spread across directories nested up to
+# directory_depth levels with directory_fanout subdirectories each. File sizes are picked from size_distribution
+# between min_file_size_bytes and max_file_size_bytes. A duplicate_ratio share of the files are copies of an earlier
+# file, so duplicate finding has something to find. Returns the amount of files created
+def generate_tree(output_directory, file_count, directory_depth=3, directory_fanout=4, min_file_size_bytes=0,
+                  max_file_size_bytes=4096, seed=0, size_distribution="uniform", median_file_size_bytes=4096,
+                  duplicate_ratio=0.0):
+    random = Random(seed)
+    # Build the list of every directory in the tree, breadth-first, so files can be assigned round-robin
+    directories = [output_directory]
+    level_directories = [output_directory]
+    for _ in range(directory_depth):
+        level_directories = [path.join(parent, "dir{}".format(index)) for parent in level_directories
+                             for index in range(directory_fanout)]
+        directories.extend(level_directories)
+    for directory in directories:
+        makedirs(directory, exist_ok=True)
+    file_paths = []
+    for file_index in range(file_count):
+        file_path = path.join(directories[file_index % len(directories)], "file{}.bin".format(file_index))
+        if file_paths and random.random() < duplicate_ratio:
+            # https://docs.python.org/3/library/shutil.html#shutil.copyfile
+            copyfile(random.choice(file_paths), file_path)
+        else:
+            file_size_bytes = pick_file_size(random, size_distribution, min_file_size_bytes, max_file_size_bytes,
+                                             median_file_size_bytes)
+            with open(file_path, "wb") as stream:
+                stream.write(random.randbytes(file_size_bytes))
+        file_paths.append(file_path)
+    return file_count
+
+
+# Add the arguments controlling the shape of a generated tree to parser, shared by every benchmark that generates one.
+# If default_file_count is a list, --file-count takes several counts so a benchmark can run at more than one scale
+def add_tree_arguments(parser, default_file_count):
+    parser.add_argument("--file-count", "-n", help="Amount of files to create", type=int, default=default_file_count,
+                        nargs="+" if isinstance(default_file_count, list) else None)
+    parser.add_argument("--directory-depth", help="Levels of nested directories", type=int, default=3)
+    parser.add_argument("--directory-fanout", help="Subdirectories in each directory", type=int, default=4)
+    parser.add_argument("--min-file-size-bytes", help="Smallest file size to create", type=int, default=0)
+    parser.add_argument("--max-file-size-bytes", help="Largest file size to create", type=int, default=4096)
+    parser.add_argument("--size-distribution", help="Distribution file sizes are picked from",
+                        choices=SIZE_DISTRIBUTIONS, type=str, default="uniform")
+    parser.add_argument("--median-file-size-bytes", help="With the lognormal distribution, the median file size",
+                        type=int, default=4096)
+    parser.add_argument("--duplicate-ratio", help="Share of files, from 0 to 1, that are copies of another file",
+                        type=float, default=0.0)
+    parser.add_argument("--seed", help="Seed for the random file sizes and contents", type=int, default=0)
+
+
+# Generate a tree from the arguments added by add_tree_arguments(), with file_count files if given, or --file-count
+def generate_tree_from_args(output_directory, args, file_count=None):
+    if file_count is None:
+        file_count = args.file_count
+    return generate_tree(output_directory, file_count, args.directory_depth, args.directory_fanout,
+                         args.min_file_size_bytes, args.max_file_size_bytes, args.seed, args.size_distribution,
+                         args.median_file_size_bytes, args.duplicate_ratio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic directory tree for benchmarking difflens")
+    parser.add_argument("--output-directory", "-o", help="Directory to create the tree in", type=str, required=True)
+    add_tree_arguments(parser, 10000)
+    args = parser.parse_args()
+    generate_tree_from_args(args.output_directory, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Benchmark of the per-file metadata cost of walking a directory tree, comparing the original os.walk() loop against
+# the scandir-based walk_directory(), and optionally walk_directory() with several walk workers. Run with
+# `python3 -m difflens.benchmark.walk` and optionally --file-count or --walk-workers
+import argparse
+# Used to construct paths, traverse directory trees, or read file metadata the way compute_diffs originally did
+from os import path, walk
+# Used to create a throwaway directory for the synthetic tree
+from tempfile import TemporaryDirectory
+# Used to time each walker
+from time import perf_counter
+
+from difflens.benchmark.treegen import generate_tree
+from difflens.util.directorywalker import walk_directory
+from difflens.util.loghelper import get_logger_with_name
+from difflens.util.pathExcluder import PathExcluder
+
+
+# The loop compute_diffs used before walk_directory(): os.walk(), then path.islink(), path.getsize(), and two
+# path.relpath() calls per file. Returns the amount of files seen
+def walk_with_os_walk(path_to_process, path_excluder):
+    files_seen = 0
+    for abs_dir_path, sub_dirs, files in walk(path_to_process):
+        rel_dir_path = path.relpath(abs_dir_path)
+        if path_excluder.is_excluded_dir(rel_dir_path):
+            sub_dirs[:] = []
+            continue
+        for file in files:
+            if path_excluder.has_excluded_extension(file):
+                continue
+            absolute_file_path = path.join(abs_dir_path, file)
+            if path.islink(absolute_file_path):
+                continue
+            path.relpath(absolute_file_path)
+            path.getsize(absolute_file_path)
+            files_seen += 1
+    return files_seen
+
+
+# Walk with walk_directory(), which reuses DirEntry type info and builds relative paths by concatenation, listing
+# directories on walk_workers threads if there's more than one
+def walk_with_scandir(path_to_process, path_excluder, logger, walk_workers=1):
+    files_seen = 0
+    for _, file_entries in walk_directory(path_to_process, path_excluder, None, logger, walk_workers):
+        files_seen += len(file_entries)
+    return files_seen
+
+
+# Time a walker several times and return the fastest run in seconds, which is the one least disturbed by other load
+def time_best_of(repeat_count, walker, *args):
+    best_seconds = None
+    files_seen = 0
+    for _ in range(repeat_count):
+        start_time = perf_counter()
+        files_seen = walker(*args)
+        elapsed_seconds = perf_counter() - start_time
+        if best_seconds is None or elapsed_seconds < best_seconds:
+            best_seconds = elapsed_seconds
+    return best_seconds, files_seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-file metadata cost of os.walk() and walk_directory()")
+    parser.add_argument("--file-count", "-n", help="Amount of files in the synthetic tree", type=int, default=100000)
+    parser.add_argument("--repeat-count", "-r", help="Times to walk the tree with each walker, keeping the fastest",
+                        type=int, default=5)
+    parser.add_argument("--scan-directory", "-s", help="Existing directory to walk instead of a synthetic tree",
+                        type=str)
+    parser.add_argument("--walk-workers", "-w", help="Also time walk_directory() with this many walk workers, such as "
+                                                     "on a FUSE mount where listing is bound by latency", type=int,
+                        default=1)
+    args = parser.parse_args()
+    logger = get_logger_with_name("Benchmark", "INFO")
+    # Keep the PathExcluder quiet, as its per-directory logging would dominate the timings
+    path_excluder = PathExcluder(None, None, "WARNING")
+
+    with TemporaryDirectory(prefix="difflens-benchmark-") as temporary_directory:
+        path_to_process = args.scan_directory
+        if path_to_process is None:
+            path_to_process = path.join(temporary_directory, "tree")
+            logger.info("Generating synthetic tree of {} empty files at {}".format(args.file_count, path_to_process))
+            # Empty files keep generation fast, and file contents don't matter for walking
+            generate_tree(path_to_process, args.file_count, max_file_size_bytes=0)
+        path_to_process = path.abspath(path_to_process)
+        # Walk once before timing so both walkers see the same warm directory cache
+        walk_with_scandir(path_to_process, path_excluder, logger)
+        os_walk_seconds, os_walk_files = time_best_of(args.repeat_count, walk_with_os_walk, path_to_process,
+                                                      path_excluder)
+        scandir_seconds, scandir_files = time_best_of(args.repeat_count, walk_with_scandir, path_to_process,
+                                                      path_excluder, logger)
+        results = [("os.walk", os_walk_seconds, os_walk_files), ("walk_directory", scandir_seconds, scandir_files)]
+        if args.walk_workers > 1:
+            parallel_seconds, parallel_files = time_best_of(args.repeat_count, walk_with_scandir, path_to_process,
+                                                            path_excluder, logger, args.walk_workers)
+            results.append(("walk_directory with {} walk workers".format(args.walk_workers), parallel_seconds,
+                            parallel_files))
+
+    for name, seconds, files_seen in results:
+        logger.info("{}: {} files in {:.3f} seconds, or {:.2f} microseconds per file".format(
+            name, files_seen, seconds, seconds / max(files_seen, 1) * 1000000))
+    logger.info("walk_directory was {:.2f}x as fast as os.walk".format(os_walk_seconds / scandir_seconds))
+    if args.walk_workers > 1:
+        logger.info("walk_directory with {} walk workers was {:.2f}x as fast as with one".format(
+            args.walk_workers, scandir_seconds / results[-1][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Converts hash files between the delimited text format and the binary hash store format. The format of each file is
+# picked from its extension, so this can also recompress a delimited file, such as .tsv.gz to .tsv.zst. Rows are written
+# sorted by relative path, so this also sorts hash files written before difflens sorted its outputs
+# Used for getting more easily defined CLI args
+import argparse
+
+from difflens.util.compareMode import CompareMode
+from difflens.util.hashfileio import read_hashes_from_files, write_hashes_to_file
+from difflens.util.hashstore import HASH_STORE_EXTENSION, is_hash_store_path
+from difflens.util.loghelper import get_logger_with_name
+
+
+# Set up the argparse object that defines and handles program input arguments
+def configure_argument_parser():
+    parser = argparse.ArgumentParser(description="Convert hash files between delimited text and binary {} "
+                                                 "formats".format(HASH_STORE_EXTENSION))
+    parser.add_argument("--input-hash-file", "-i", help="Hash file to read", type=str, required=True)
+    parser.add_argument("--output-hash-file", "-o", help="Hash file to write. Paths ending in {} are written in the "
+                                                         "binary format".format(HASH_STORE_EXTENSION),
+                        type=str, required=True)
+    parser.add_argument("--compare-mode", "-p", help="Comparison mode the input hash file was created with",
+                        choices=[CompareMode.FULL.value, CompareMode.PARTIAL.value, CompareMode.SIZE.value,
+                                 CompareMode.CHUNK.value],
+                        type=str, default=CompareMode.FULL.value)
+    parser.add_argument("--compression-level", help="Compression level of the output if it's a compressed file, "
+                                                    "otherwise the codec's default", type=int)
+    parser.add_argument("--compression-threads", help="Threads compressing the output if it's a .gz or .zst file",
+                        type=int, default=1)
+    parser.add_argument("--log-level", "-l", help="Set log level",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], type=str, default="INFO")
+    return parser
+
+
+def main():
+    args = configure_argument_parser().parse_args()
+    io_logger = get_logger_with_name("IO", args.log_level)
+    # Chunk digests have no column in the binary format, so refuse before reading the whole input
+    if args.compare_mode == CompareMode.CHUNK.value and is_hash_store_path(args.output_hash_file):
+        io_logger.error("compare_mode {} stores chunk digests, which {} hash stores can't hold, so {} must be a "
+                        "delimited file, such as hashes.tsv. Exiting".format(
+                            args.compare_mode, HASH_STORE_EXTENSION, args.output_hash_file))
+        exit(1)
+    io_logger.info("Reading hash file {}".format(args.input_hash_file))
+    data_frame = read_hashes_from_files([args.input_hash_file], io_logger, args.compare_mode)
+    # Hash files are kept sorted by relative path so they can be compared with --streaming-comparison
+    data_frame = data_frame.sort_values("relative_path", ignore_index=True)
+    io_logger.info("Writing {} rows to {}".format(len(data_frame.index), args.output_hash_file))
+    write_hashes_to_file(data_frame, args.output_hash_file, io_logger, args.compare_mode, args.compression_level,
+                         args.compression_threads)
+
+
+# Used for running via module mode, aka python -m difflens.convert
+if __name__ == "__main__":
+    main()
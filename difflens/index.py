@@ -0,0 +1,79 @@
+# Queries or updates the persistent hash index written by `difflens --index-database`, answering lookups across every
+# scanned disk without reading their hash files. Results are printed to the console as tab-separated rows
+# Used for getting more easily defined CLI args
+import argparse
+# Used to write query results in the same delimited format as hash files
+from csv import QUOTE_NONNUMERIC, writer
+# Used to print query results
+from sys import stdout
+# Used to print run times in a readable format
+from time import localtime, strftime
+
+from difflens.util.compareMode import CompareMode
+from difflens.util.hashfileio import read_hashes_from_files
+from difflens.util.hashindex import HashIndex
+from difflens.util.loghelper import get_logger_with_name
+
+
+# Set up the argparse object that defines and handles program input arguments, with one subcommand per query
+def configure_argument_parser():
+    parser = argparse.ArgumentParser(description="Query or update a difflens hash index")
+    parser.add_argument("--index-database", "-b", help="Path to the index database", type=str, required=True)
+    parser.add_argument("--log-level", "-l", help="Set log level",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], type=str, default="WARNING")
+    # https://docs.python.org/3/library/argparse.html#sub-commands
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("runs", help="List every run indexed so far")
+    where_hash_parser = subparsers.add_parser("where-hash", help="List every file with the given hash")
+    where_hash_parser.add_argument("hash", help="64-character hex hash to look up", type=str)
+    subparsers.add_parser("duplicates", help="List every file sharing its hash with another file, grouped by hash")
+    changed_since_parser = subparsers.add_parser("changed-since",
+                                                 help="List files added, removed, or modified by runs after a run")
+    changed_since_parser.add_argument("run_id", help="ID of the run to list changes after, or 0 for every change",
+                                      type=int)
+    add_parser = subparsers.add_parser("add", help="Index a hash file, such as one written before the index existed")
+    add_parser.add_argument("--input-hash-file", "-i", help="Hash file to index", type=str, required=True)
+    add_parser.add_argument("--root-name", "-n", help="Name of the scanned directory the hash file came from, such as "
+                                                      "disk1", type=str, required=True)
+    add_parser.add_argument("--compare-mode", "-p", help="Comparison mode the hash file was created with",
+                            choices=[CompareMode.FULL.value, CompareMode.PARTIAL.value, CompareMode.SIZE.value,
+                                     CompareMode.CHUNK.value],
+                            type=str, default=CompareMode.FULL.value)
+    return parser
+
+
+def main():
+    args = configure_argument_parser().parse_args()
+    logger = get_logger_with_name("Index", args.log_level)
+    compare_mode = args.compare_mode if args.command == "add" else None
+    try:
+        hash_index = HashIndex(args.index_database, compare_mode, logger)
+    except ValueError:
+        # HashIndex has already logged why the index can't take these hashes
+        logger.error("Could not open index {}. Exiting".format(args.index_database))
+        exit(1)
+    row_writer = writer(stdout, delimiter="\t", quoting=QUOTE_NONNUMERIC, doublequote=False, escapechar="\\",
+                        lineterminator="\n")
+    if args.command == "runs":
+        row_writer.writerow(["run_id", "root_name", "indexed_time", "file_count"])
+        for run_id, root_name, indexed_time_s, file_count in hash_index.get_runs():
+            row_writer.writerow([run_id, root_name, strftime("%Y-%m-%dT%H:%M:%S%z", localtime(indexed_time_s)),
+                                 file_count])
+    elif args.command == "where-hash":
+        row_writer.writerow(["scan_root", "relative_path", "hash", "file_size_bytes"])
+        row_writer.writerows(hash_index.find_hash(args.hash.lower()))
+    elif args.command == "duplicates":
+        row_writer.writerow(["hash", "scan_root", "relative_path", "file_size_bytes"])
+        row_writer.writerows(hash_index.iterate_duplicates())
+    elif args.command == "changed-since":
+        row_writer.writerow(["run_id", "scan_root", "relative_path", "change_type", "hash"])
+        row_writer.writerows(hash_index.iterate_changes_since(args.run_id))
+    else:
+        data_frame = read_hashes_from_files([args.input_hash_file], logger, args.compare_mode)
+        hash_index.update_root(args.root_name, data_frame)
+    hash_index.close()
+
+
+# Used for running via module mode, aka python -m difflens.index
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,25 @@
 # This is the entry to the project, what a CLI user of Python will call
 # Used for getting more easily defined CLI args
 import argparse
-# Used for printing the Python working directory
-from os import getcwd, getpid
+# Used to scan multiple directories concurrently
+from concurrent.futures import ThreadPoolExecutor
+# Used to close however many streaming output files were opened
+from contextlib import ExitStack
+# Used to queue up analyses and output writes to run concurrently
+from functools import partial
+# Used for printing the Python working directory or checking that a file exists
+from os import getcwd, getpid, path
 
 # Used to get memory information
 from psutil import Process
+# Used to pick BLAKE3's default thread count
+# https://github.com/oconnor663/blake3-py
+from blake3 import blake3
+# Used to combine the DataFrames of multiple scan directories
+from pandas import concat
 
 from difflens.util.compareMode import CompareMode
+from difflens.util.readOrder import ReadOrder
 # Different import styles yield different errors in different environments:
 # (1) ImportError: attempted relative import with no known parent package
 # (2) ModuleNotFoundError: No module named 'difflens'
@@ -28,11 +40,27 @@ from difflens.util.compareMode import CompareMode
 # - WILL WORK when imports are relative, i.e. `from .util.xyz`
 # - WILL WORK when imports are absolute, i.e. `from difflens.util.xyz`
 # - WILL NOT WORK when imports are (partial?) absolute, i.e. `from util.xyz` (3)
-from difflens.util.comparefiles import determine_duplicate_files, determine_modified_files, determine_removed_files
-from difflens.util.computediffs import compute_diffs, flatten_dict_to_data_frame
-from difflens.util.hashfileio import write_hashes_to_file, read_hashes_from_files
+from difflens.util.carryforward import CarryForward
+from difflens.util.checkpoint import CheckpointJournal, load_checkpoint_journal, remove_checkpoint_journal
+from difflens.util.commonutils import ROOT_NAME_PLACEHOLDER, format_root_path, sanitize_and_validate_directory_path, \
+    sanitize_and_validate_file_path
+from difflens.util.comparefiles import ADDED, CHANGE_COLUMNS, MODIFIED, REMOVED, check_rows_sorted, classify_changes, \
+    determine_changes_streaming, determine_duplicate_files, determine_modified_byte_ranges, determine_moved_files, \
+    have_same_files
+from difflens.util.compression import COMPRESSION_CODECS, get_compression_codec
+from difflens.util.computediffs import collect_files_by_size, compute_diffs, hash_duplicate_candidates
+from difflens.util.dirtyjournal import DirtyScanPlan, claim_dirty_journal, remove_claimed_dirty_journal
+from difflens.util.hashindex import HashIndex
+from difflens.util.hashingengine import HashingEngine
+from difflens.util.hashstore import HASH_STORE_EXTENSION, is_hash_store_path
+from difflens.util.hashfileio import PYARROW_AVAILABLE, STRING_DTYPES, get_hash_column_name, \
+    iterate_hash_file_rows, write_hashes_to_file, read_hashes_from_files, HashFileRowWriter
 from difflens.util.loghelper import get_logger_with_name
+from difflens.util.metrics import RunMetrics
 from difflens.util.pathExcluder import PathExcluder
+from difflens.util.readengine import ReadEngine
+from difflens.util.rollingscrub import PATH_HASH_ORDER, SCRUB_ORDERS, RollingScrub
+from difflens.util.throttle import ReadThrottle
 
 
 # Set up the argparse object that defines and handles program input arguments
@@ -44,27 +72,66 @@ def configure_argument_parser():
     # Initialize a group to force either-or argument behavior
     # https://stackoverflow.com/questions/11154946/
     arg_group = parser.add_mutually_exclusive_group(required=True)
-    arg_group.add_argument("--scan-directory", "-s", help="Path in which to look for files", type=str)
+    # nargs="+" allows this arg to take one or more values, each scanned concurrently in one process
+    # https://docs.python.org/3/library/argparse.html#nargs
+    arg_group.add_argument("--scan-directory", "-s",
+                           help="Path(s) in which to look for files. When multiple are given, output paths are "
+                                "expanded per path by replacing {root_name} with its directory name", type=str,
+                           nargs="+")
     # action="append" allows this arg to return as a list when passed multiple times as input, or None
     # https://stackoverflow.com/questions/36166225
     arg_group.add_argument("--input-hash-file", "-i",
                            help="Input file for new hash values if live directory scanning should be skipped",
                            type=str, action="append")
     # Define arguments where a string is expected
-    parser.add_argument("--comparison-hash-file", "-c", help="Path to delimited file containing old hash values",
-                        type=str)
+    parser.add_argument("--comparison-hash-file", "-c", help="Path to delimited file containing old hash values. Pass "
+                                                             "once per scan directory when scanning multiple",
+                        type=str, action="append")
     parser.add_argument("--output-hash-file", "-o", help="Output file for newly computed hash values", type=str)
     parser.add_argument("--output-removed-files", "-r", help="Output file listing files that have been removed",
                         type=str)
     parser.add_argument("--output-added-files", "-a", help="Output file listing files that have been added", type=str)
     parser.add_argument("--output-modified-files", "-m", help="Output file listing files that have been modified",
                         type=str)
+    parser.add_argument("--output-moved-files",
+                        help="Output file pairing removed and added files with the same hash and size, which are left "
+                             "out of the removed and added outputs", type=str)
     parser.add_argument("--output-duplicates", "-d", help="Output file listing files that contain matching data",
                         type=str)
+    parser.add_argument("--index-database",
+                        help="SQLite database to update with the hashes of each scanned directory, so files can be "
+                             "looked up across directories and runs with difflens-index", type=str)
+    parser.add_argument("--checkpoint-file",
+                        help="Uncompressed delimited file that the hash of each scanned file is appended to in batches "
+                             "as the scan goes, so an interrupted scan can be picked up again with --resume. Removed "
+                             "once the outputs are written", type=str)
+    parser.add_argument("--scrub-state-file",
+                        help="With rolling-scrub, JSON file recording which slice the next run scrubs. Without it, "
+                             "path-hash order scrubs the slice of the day, and cursor order can't be used", type=str)
+    parser.add_argument("--dirty-journal",
+                        help="With --incremental, journal of changed paths kept by difflens-watch. Only the files it "
+                             "lists, plus --verify-percent of the rest, are looked at and the rest are carried forward "
+                             "without walking the directory. Falls back to walking it if changes may have been missed",
+                        type=str)
+    parser.add_argument("--metrics-json-file",
+                        help="Output file for per-phase timings, memory use, hashing throughput by file size, and "
+                             "error counts of the run, as JSON", type=str)
+    parser.add_argument("--metrics-prometheus-file",
+                        help="Output file for the same metrics as --metrics-json-file in the Prometheus text format, "
+                             "such as a .prom file in the node_exporter textfile collector directory", type=str)
     parser.add_argument("--exclude-file-extension", "-e",
                         help="File extension such as '*.nfo' that should not be scanned", type=str, action="append")
     parser.add_argument("--exclude-relative-path", "-y",
                         help="Relative dir such as './foo/bar' that should not be scanned", type=str, action="append")
+    parser.add_argument("--exclude-glob",
+                        help="Pattern written like a .gitignore line, such as '*.tmp', 'cache/', '/top.log', or "
+                             "'!keep.tmp', matched against paths relative to the scan directory that should not be "
+                             "scanned. The last pattern a path matches decides, and a leading ! keeps it",
+                        type=str, action="append")
+    parser.add_argument("--exclude-file",
+                        help="File of patterns written like a .gitignore, one per line, the same as --exclude-glob. "
+                             "Its patterns come after every --exclude-glob",
+                        type=str, action="append")
 
     # Define argument where a specific list of strings are allowed
     # https://stackoverflow.com/questions/15836713
@@ -76,17 +143,828 @@ def configure_argument_parser():
                         help="Target interval in seconds between log updates when hashing", type=int, default=30)
     parser.add_argument("--log-update-interval-files", "-x", help="Target interval of files hashed between log updates",
                         type=int, default=10000)
+    parser.add_argument("--slow-file-seconds",
+                        help="Files taking longer than this to hash are logged and counted as slow in the metrics",
+                        type=int, default=60)
+    parser.add_argument("--checkpoint-interval-seconds",
+                        help="With --checkpoint-file, target interval in seconds between batches written to it",
+                        type=int, default=60)
+    parser.add_argument("--chunk-size-mb",
+                        help="With chunk-hash compare mode, size of the chunks each file is split into and hashed. "
+                             "Modified files report which chunks changed, and files that grew in place with "
+                             "--incremental only have their new chunks read", type=int, default=64)
+    parser.add_argument("--read-block-size-kb",
+                        help="Size of each read from a file being hashed. python3 -m difflens.benchmark.blocksize "
+                             "compares sizes on a given disk", type=int, default=1024)
+    parser.add_argument("--mmap-threshold-mb",
+                        help="Memory map files at least this large on solid state disks and hash each with several "
+                             "threads. 0 disables memory mapping", type=int, default=256)
+    parser.add_argument("--blake3-threads",
+                        help="Threads used to hash each memory mapped file. 0 uses one per CPU core", type=int,
+                        default=0)
+    parser.add_argument("--max-read-mbps",
+                        help="Limit reads from each scanned disk to this many megabytes per second", type=int)
+    parser.add_argument("--adaptive-latency-ms",
+                        help="With --adaptive-throttle, average disk request latency above which reads back off",
+                        type=int, default=50)
+    parser.add_argument("--hash-workers", help="Number of threads hashing files concurrently. 1 hashes each file in "
+                                               "turn on the main thread", type=int, default=1)
+    parser.add_argument("--walk-workers",
+                        help="Number of threads listing directories concurrently, for trees where walking is slowed "
+                             "by metadata latency such as millions of small files or FUSE mounts. 1 walks on the "
+                             "thread hashing files", type=int, default=1)
+    parser.add_argument("--scrub-cycle-runs",
+                        help="With rolling-scrub, amount of runs it takes to rehash every file once", type=int,
+                        default=7)
+    parser.add_argument("--analysis-workers",
+                        help="Number of threads writing outputs and running analyses concurrently once the current "
+                             "hashes are ready, while the comparison hash file is also read during the scan. 1 runs "
+                             "each in turn, reading the comparison once the scan is done", type=int, default=4)
+    parser.add_argument("--rotational-device-readers",
+                        help="With more than one hash worker, max concurrent readers per spinning or unknown disk",
+                        type=int, default=1)
+    parser.add_argument("--solid-state-device-readers",
+                        help="With more than one hash worker, max concurrent readers per solid state disk", type=int,
+                        default=4)
 
     # Define argument where a specific list of options are allowed
     # https://stackoverflow.com/questions/15836713
-    parser.add_argument("--compare-mode", "-p", help="Set comparison mode to full file hash, partial file hash, or "
-                                                     "file size only",
-                        choices=[CompareMode.FULL.value, CompareMode.PARTIAL.value, CompareMode.SIZE.value],
+    parser.add_argument("--compare-mode", "-p", help="Set comparison mode to full file hash, partial file hash, file "
+                                                     "size only, a hash of each file chunk, or a rolling scrub. "
+                                                     "rolling-scrub stores full file hashes, but only rehashes new and "
+                                                     "changed files plus one slice of the rest each run, so every file "
+                                                     "is read back once every --scrub-cycle-runs runs",
+                        choices=[CompareMode.FULL.value, CompareMode.PARTIAL.value, CompareMode.SIZE.value,
+                                 CompareMode.CHUNK.value, CompareMode.ROLLING.value],
                         type=str, default=CompareMode.FULL.value)
+    parser.add_argument("--scrub-order",
+                        help="With rolling-scrub, how each run's slice is picked. path-hash scrubs the files whose "
+                             "relative path hashes to the slice, while cursor scrubs 1 / --scrub-cycle-runs of the "
+                             "bytes in relative path order, carrying on from where the last run stopped",
+                        choices=SCRUB_ORDERS, type=str, default=PATH_HASH_ORDER)
+
+    parser.add_argument("--hash-file-string-dtype",
+                        help="How relative paths and hashes read from hash files are stored in memory. category stores "
+                             "each distinct value once, and pyarrow stores each column in one buffer but needs the "
+                             "pyarrow package",
+                        choices=STRING_DTYPES, type=str, default="default")
+    parser.add_argument("--compression-level",
+                        help="Compression level of outputs written to compressed files, such as 1 to 9 for .gz or -7 "
+                             "to 22 for .zst. Lower is faster, higher is smaller. Defaults to each codec's default",
+                        type=int)
+    parser.add_argument("--compression-threads",
+                        help="Threads compressing each output written to a .gz or .zst file. .gz outputs written with "
+                             "more than 1 are made of independently compressed blocks, which gunzip reads as usual",
+                        type=int, default=1)
+    parser.add_argument("--read-order",
+                        help="Order to read files in. walk reads each directory as it's listed, while inode and extent "
+                             "list every file first and read them in inode or on-disk position order, cutting down "
+                             "seeking on spinning disks. extent falls back to inode where the filesystem doesn't "
+                             "support FIEMAP",
+                        choices=[ReadOrder.WALK.value, ReadOrder.INODE.value, ReadOrder.EXTENT.value], type=str,
+                        default=ReadOrder.WALK.value)
+
+    # Define arguments that toggle behavior on when present, without expecting a value
+    # https://docs.python.org/3/library/argparse.html#action
+    parser.add_argument("--incremental", help="Reuse hashes from the comparison hash file for files whose size, "
+                                              "modification time, inode, and device are unchanged",
+                        action="store_true")
+    parser.add_argument("--resume", help="Continue a scan that was interrupted, reusing the hashes saved to "
+                                         "--checkpoint-file for files whose size, modification time, inode, and "
+                                         "device are unchanged", action="store_true")
+    parser.add_argument("--direct-io", help="Open files with O_DIRECT so reads bypass the page cache, falling back to "
+                                            "normal reads where the filesystem doesn't support it",
+                        action="store_true")
+    parser.add_argument("--keep-page-cache", help="Leave hashed files in the page cache rather than telling the kernel "
+                                                  "to drop them once read", action="store_true")
+    parser.add_argument("--adaptive-throttle",
+                        help="Watch /proc/diskstats for each scanned disk and slow reads down while other programs are "
+                             "reading or writing it or its latency rises above --adaptive-latency-ms",
+                        action="store_true")
+    parser.add_argument("--metrics-on-progress",
+                        help="Write the metrics files each time scan progress is logged, rather than only at the end",
+                        action="store_true")
+    parser.add_argument("--lazy-duplicates", help="Only hash files sharing a size with another file, and only fully "
+                                                  "hash those also sharing a partial hash. Requires "
+                                                  "--output-duplicates and no other outputs", action="store_true")
+    parser.add_argument("--streaming-comparison",
+                        help="Find removed, added, and modified files by walking the current hashes and the comparison "
+                             "hash file side by side in relative path order, rather than reading the comparison hash "
+                             "file into memory. The comparison hash file must be sorted, as difflens writes them",
+                        action="store_true")
+    # Define argument where a float is expected
+    parser.add_argument("--verify-percent", help="With --incremental, percentage of unchanged files to rehash anyway "
+                                                 "in order to catch bitrot", type=float, default=0)
 
     return parser
 
 
+# Confirm that scanning several roots won't cause their outputs to overwrite each other. Each per-root output path needs
+# the {root_name} placeholder, and comparison files must be given once per root or once using the placeholder
+def validate_multiple_root_args(args, root_names, logger):
+    if len(set(root_names)) != len(root_names):
+        logger.error("Scan directories {} must have unique directory names. Exiting".format(args.scan_directory))
+        exit(1)
+    for output_path in [args.output_hash_file, args.output_removed_files, args.output_added_files,
+                        args.output_modified_files, args.output_moved_files, args.checkpoint_file,
+                        args.dirty_journal, args.scrub_state_file]:
+        if output_path is not None and ROOT_NAME_PLACEHOLDER not in output_path:
+            logger.error("Output {} must contain {} when scanning multiple directories. Exiting".format(
+                output_path, ROOT_NAME_PLACEHOLDER))
+            exit(1)
+    if args.comparison_hash_file is not None and len(args.comparison_hash_file) == 1 \
+            and ROOT_NAME_PLACEHOLDER not in args.comparison_hash_file[0]:
+        logger.error("Comparison {} must contain {} when scanning multiple directories. Exiting".format(
+            args.comparison_hash_file[0], ROOT_NAME_PLACEHOLDER))
+        exit(1)
+
+
+# Confirm that comparison files were passed in either once, or once per scan root
+def validate_comparison_args(args, root_count, logger):
+    if args.comparison_hash_file is not None and len(args.comparison_hash_file) not in [1, root_count]:
+        logger.error("Pass --comparison-hash-file once, or once per scan directory. Exiting")
+        exit(1)
+
+
+# Confirm that lazy duplicate finding was asked for with only a duplicates output, as it leaves out files that can't be
+# duplicates and thus can't produce complete hash, added, removed, or modified outputs
+def validate_lazy_duplicates_args(args, logger):
+    if args.compare_mode == CompareMode.CHUNK.value:
+        logger.error("--lazy-duplicates finds the same duplicates with full-hash as with chunk-hash, use that instead. "
+                     "Exiting")
+        exit(1)
+    if args.output_duplicates is None:
+        logger.error("--lazy-duplicates requires --output-duplicates. Exiting")
+        exit(1)
+    for output_path in [args.output_hash_file, args.output_removed_files, args.output_added_files,
+                        args.output_modified_files, args.output_moved_files, args.index_database,
+                        args.checkpoint_file, args.dirty_journal]:
+        if output_path is not None:
+            logger.error("--lazy-duplicates only finds duplicates, so it can't write {}. Exiting".format(output_path))
+            exit(1)
+
+
+# Confirm that moved files were asked for in a mode able to find them. Pairing files needs both hashes in memory at
+# once, and files can't be told apart by size alone
+def validate_moved_files_args(args, compare_mode, logger):
+    if args.output_moved_files is None:
+        return
+    if args.streaming_comparison:
+        logger.error("--output-moved-files can't be combined with --streaming-comparison. Exiting")
+        exit(1)
+    if compare_mode == CompareMode.SIZE.value:
+        logger.error("--output-moved-files needs hashes to pair files, so it can't be used with compare_mode {}. "
+                     "Exiting".format(compare_mode))
+        exit(1)
+
+
+# Confirm that a checkpoint journal can be kept for the scan. It's only ever appended to, which compressed and binary
+# formats don't allow for, and file-size compare mode has no hashes worth saving
+def validate_checkpoint_args(args, compare_mode, logger):
+    if args.checkpoint_file is None:
+        if args.resume:
+            logger.error("--resume requires --checkpoint-file. Exiting")
+            exit(1)
+        return
+    if compare_mode == CompareMode.SIZE.value:
+        logger.error("--checkpoint-file saves hashes, so it can't be used with compare_mode {}. Exiting".format(
+            compare_mode))
+        exit(1)
+    if get_compression_codec(args.checkpoint_file) is not None or is_hash_store_path(args.checkpoint_file):
+        logger.error("--checkpoint-file {} must be an uncompressed delimited file, such as checkpoint.tsv. "
+                     "Exiting".format(args.checkpoint_file))
+        exit(1)
+
+
+# Confirm that every output written as a binary hash store can hold the columns of compare_mode. Chunk-hash outputs
+# carry chunk digests, which hash stores don't have room for, so they'd only fail once the scan is over
+def validate_hash_store_args(args, compare_mode, logger):
+    if compare_mode != CompareMode.CHUNK.value:
+        return
+    output_paths = [args.output_hash_file, args.output_removed_files, args.output_added_files,
+                    args.output_modified_files, args.output_moved_files, args.output_duplicates]
+    for output_path in [output_path for output_path in output_paths if output_path is not None]:
+        if is_hash_store_path(output_path):
+            logger.error("compare_mode {} stores chunk digests, which {} hash stores can't hold, so {} must be a "
+                         "delimited file, such as hashes.tsv. Exiting".format(
+                             compare_mode, HASH_STORE_EXTENSION, output_path))
+            exit(1)
+
+
+# Confirm that the index can take the hashes of compare_mode before scanning, rather than finding out once every root
+# has been scanned. Opening the index creates it if it doesn't exist yet, recording compare_mode as the one it holds
+def validate_index_args(args, compare_mode, logger):
+    if args.index_database is None or args.input_hash_file is not None:
+        return
+    try:
+        HashIndex(args.index_database, compare_mode, logger).close()
+    except ValueError:
+        # HashIndex has already logged why the index can't take these hashes
+        logger.error("Could not update index {}. Exiting".format(args.index_database))
+        exit(1)
+
+
+# Confirm that a rolling scrub can keep track of which files it has scrubbed, which the cursor has to be saved for
+def validate_rolling_scrub_args(args, logger):
+    if args.compare_mode != CompareMode.ROLLING.value:
+        return
+    if args.scrub_cycle_runs < 1:
+        logger.error("--scrub-cycle-runs must be at least 1. Exiting")
+        exit(1)
+    if args.scrub_order != PATH_HASH_ORDER and args.scrub_state_file is None:
+        logger.error("--scrub-order {} requires --scrub-state-file to save the cursor in. Exiting".format(
+            args.scrub_order))
+        exit(1)
+    if args.lazy_duplicates:
+        logger.error("--lazy-duplicates doesn't keep hashes to scrub, use compare_mode {} instead. Exiting".format(
+            CompareMode.FULL.value))
+        exit(1)
+
+
+# Confirm that a dirty journal was asked for along with the incremental mode whose hashes it carries forward, and that
+# it can be appended to
+def validate_dirty_journal_args(args, logger):
+    if args.dirty_journal is None:
+        return
+    if not args.incremental:
+        logger.error("--dirty-journal carries forward hashes of unchanged files, so it requires --incremental. Exiting")
+        exit(1)
+    if get_compression_codec(args.dirty_journal) is not None or is_hash_store_path(args.dirty_journal):
+        logger.error("--dirty-journal {} must be an uncompressed file, such as dirty.tsv. Exiting".format(
+            args.dirty_journal))
+        exit(1)
+
+
+# Confirm that the optional package needed to store strings the way --hash-file-string-dtype asks for is installed
+def validate_string_dtype_args(args, logger):
+    if args.hash_file_string_dtype == "pyarrow" and not PYARROW_AVAILABLE:
+        logger.error("--hash-file-string-dtype pyarrow requires the pyarrow package, install it with "
+                     "`pip3 install pyarrow`. Exiting")
+        exit(1)
+
+
+# Confirm that every compressed input and output can be read or written, which .zst and .lz4 files need optional
+# packages for, and that --compression-level and --compression-threads suit the codecs of the outputs
+def validate_compression_args(args, logger):
+    if args.compression_threads < 1:
+        logger.error("--compression-threads must be at least 1. Exiting")
+        exit(1)
+    output_paths = [args.output_hash_file, args.output_removed_files, args.output_added_files,
+                    args.output_modified_files, args.output_moved_files, args.output_duplicates]
+    input_paths = (args.comparison_hash_file or []) + (args.input_hash_file or [])
+    for file_path in [file_path for file_path in output_paths + input_paths if file_path is not None]:
+        codec = get_compression_codec(file_path)
+        if codec is not None and not codec["available"]:
+            logger.error("{} is compressed with {}, which requires the {} package, install it with `pip3 install {}`. "
+                         "Exiting".format(file_path, codec["name"], codec["package"], codec["package"]))
+            exit(1)
+    output_codecs = [get_compression_codec(output_path) for output_path in output_paths if output_path is not None]
+    for codec in {codec["name"]: codec for codec in output_codecs if codec is not None}.values():
+        if args.compression_level is not None and args.compression_level not in codec["levels"]:
+            logger.error("--compression-level {} is not a valid {} level, which range from {} to {}. Exiting".format(
+                args.compression_level, codec["name"], codec["levels"][0], codec["levels"][-1]))
+            exit(1)
+        if args.compression_threads > 1 and not codec["threads"]:
+            logger.warning("{} compresses on a single thread, so --compression-threads won't speed up its "
+                           "outputs".format(codec["name"]))
+    if args.compression_level is not None and not any(output_codecs):
+        logger.warning("No output is written to a compressed file, so --compression-level has no effect. Use an "
+                       "extension such as {}".format(", ".join(COMPRESSION_CODECS)))
+
+
+# Confirm that every --exclude-file can be read before scanning starts
+def validate_exclude_args(args, logger):
+    for exclude_file_path in args.exclude_file or []:
+        if not path.isfile(exclude_file_path):
+            logger.error("--exclude-file {} does not exist or is not a file. Exiting".format(exclude_file_path))
+            exit(1)
+
+
+# Make sure there's at least one thread to walk with
+def validate_walk_workers_args(args, logger):
+    if args.walk_workers < 1:
+        logger.error("--walk-workers {} must be at least 1. Exiting".format(args.walk_workers))
+        exit(1)
+
+
+# Create the ReadEngine that files are read with, as configured by the input arguments. It's shared by every root, so
+# roots on the same disk also share its read throttle
+def create_read_engine(args):
+    read_throttle = None
+    if args.max_read_mbps is not None or args.adaptive_throttle:
+        read_throttle = ReadThrottle(args.max_read_mbps, args.adaptive_throttle, args.adaptive_latency_ms,
+                                     args.log_level)
+    return ReadEngine(args.read_block_size_kb * 2 ** 10, not args.keep_page_cache, args.direct_io, args.log_level,
+                      args.mmap_threshold_mb * 2 ** 20, args.blake3_threads or blake3.AUTO, read_throttle)
+
+
+# Create the PathExcluder for a scan of scan_directory, as configured by the input arguments. Exclude globs are anchored
+# to scan_directory, which is given as a path relative to relative_base, the same as the paths it's matched against
+def create_path_excluder(args, scan_directory, relative_base):
+    return PathExcluder(args.exclude_file_extension, args.exclude_relative_path, args.log_level, args.exclude_glob,
+                        args.exclude_file, path.relpath(scan_directory, relative_base))
+
+
+# Create the RunMetrics the run's metrics are collected into and written out by, as configured by the input arguments
+def create_run_metrics(args, logger):
+    json_path, prometheus_path = [None if output_path is None else sanitize_and_validate_file_path(output_path, logger)
+                                  for output_path in [args.metrics_json_file, args.metrics_prometheus_file]]
+    return RunMetrics(json_path, prometheus_path, args.metrics_on_progress, args.slow_file_seconds, logger)
+
+
+# Find duplicates by first collecting the size of every file under every root, then hashing only the files whose size
+# collides with another file's. Roots are grouped together unless the duplicates output has one file per root
+def find_duplicates_lazily(args, root_args_list, relative_bases, root_loggers, compare_mode, executor_logger,
+                           io_logger, hashing_engine, read_engine, run_metrics):
+    byte_count_to_hash = 1000000
+    across_roots = len(root_args_list) > 1 and ROOT_NAME_PLACEHOLDER not in args.output_duplicates
+    executor_logger.info("Beginning directory scan to collect file sizes of files in {}".format(args.scan_directory))
+    # Stat every root in parallel, each with its own dict of {key:file_size_bytes, value:list of file entries} and
+    # PathExcluder, as exclude globs are anchored to each root
+    with run_metrics.run_metrics.phase("collect_file_sizes"), \
+            ThreadPoolExecutor(max_workers=len(root_args_list), thread_name_prefix="difflens-root") as executor:
+        futures = [executor.submit(collect_files_by_size, root_args.scan_directory, root_logger,
+                                   args.log_update_interval_seconds, args.log_update_interval_files,
+                                   create_path_excluder(args, root_args.scan_directory, relative_base), {},
+                                   relative_base, root_args.root_name, args.walk_workers)
+                   for root_args, relative_base, root_logger in zip(root_args_list, relative_bases, root_loggers)]
+        file_size_dicts = [future.result() for future in futures]
+    if across_roots:
+        # Merge the file size dicts of every root so sizes colliding across roots are hashed too
+        merged_file_size_dict = {}
+        for file_size_dict in file_size_dicts:
+            for file_size_bytes, file_entries in file_size_dict.items():
+                merged_file_size_dict.setdefault(file_size_bytes, []).extend(file_entries)
+        with run_metrics.run_metrics.phase("hash_duplicate_candidates"):
+            candidate_data_frame = hash_duplicate_candidates(merged_file_size_dict, io_logger, byte_count_to_hash,
+                                                             compare_mode, hashing_engine, read_engine,
+                                                             run_metrics.run_metrics)
+        with run_metrics.run_metrics.phase("find_duplicates"):
+            write_duplicates(candidate_data_frame, args.output_duplicates, compare_mode, executor_logger, io_logger,
+                             args.compression_level, args.compression_threads, ["scan_root"])
+        return
+    for root_args, root_logger, file_size_dict in zip(root_args_list, root_loggers, file_size_dicts):
+        scan_metrics = run_metrics.create_scan_metrics(root_args.root_name)
+        with scan_metrics.phase("hash_duplicate_candidates"):
+            candidate_data_frame = hash_duplicate_candidates(file_size_dict, root_logger, byte_count_to_hash,
+                                                             compare_mode, hashing_engine, read_engine, scan_metrics)
+        with scan_metrics.phase("find_duplicates"):
+            write_duplicates(candidate_data_frame, root_args.output_duplicates, compare_mode, executor_logger,
+                             root_logger, root_args.compression_level, root_args.compression_threads)
+
+
+# Create a copy of the input arguments specific to one scan root, with its output paths and comparison file filled in
+# https://docs.python.org/3/library/argparse.html#argparse.Namespace
+def get_root_args(args, root_index, root_name):
+    root_args = argparse.Namespace(**vars(args))
+    root_args.scan_directory = args.scan_directory[root_index]
+    root_args.root_name = root_name
+    if args.comparison_hash_file is not None:
+        # Either one comparison file per root in the same order as the roots, or a single one with a placeholder
+        comparison_hash_file = args.comparison_hash_file[min(root_index, len(args.comparison_hash_file) - 1)]
+        root_args.comparison_hash_file = format_root_path(comparison_hash_file, root_name)
+    for output_arg in ["output_hash_file", "output_removed_files", "output_added_files", "output_modified_files",
+                       "output_moved_files", "output_duplicates", "checkpoint_file", "dirty_journal",
+                       "scrub_state_file"]:
+        setattr(root_args, output_arg, format_root_path(getattr(args, output_arg), root_name))
+    return root_args
+
+
+# Read the comparison hash file for one scan root, returning None if it does not exist so other roots can continue. If
+# columns is a list of column names, only those are read, which is enough for comparing it against a scan
+def read_comparison_data_frame(comparison_hash_file, io_logger, executor_logger, compare_mode, string_dtype,
+                               columns=None):
+    if not path.isfile(comparison_hash_file):
+        executor_logger.warning("Comparison hash file {} does not exist".format(comparison_hash_file))
+        return None
+    io_logger.info("Reading Comparison DataFrame from disk at {}".format(comparison_hash_file))
+    return read_hashes_from_files([comparison_hash_file], io_logger, compare_mode, columns, string_dtype)
+
+
+# Claim the dirty journal of one scan root and work out which of its files have to be looked at, returning the
+# DirtyScanPlan, or None if the whole directory has to be walked because changes may have been missed or there are no
+# hashes to carry forward. The journal is claimed either way, so the next run only sees changes made from now on
+def plan_dirty_scan(args, relative_base, carry_forward, path_excluder, executor_logger, io_logger, metrics):
+    root_directory = sanitize_and_validate_directory_path(args.scan_directory, executor_logger)
+    with metrics.phase("claim_dirty_journal"):
+        dirty_paths = claim_dirty_journal(args.dirty_journal, root_directory, io_logger)
+    walk_reasons = list(dirty_paths.overflow_reasons)
+    if carry_forward is None:
+        walk_reasons.append("there are no hashes to carry forward")
+    elif carry_forward.files_without_metadata > 0:
+        walk_reasons.append("{} files in the comparison are missing metadata".format(
+            carry_forward.files_without_metadata))
+    if walk_reasons:
+        executor_logger.warning("Walking all of {} rather than only the changes in dirty journal {}, as {}".format(
+            args.scan_directory, args.dirty_journal, "; ".join(walk_reasons)))
+        return None
+    with metrics.phase("plan_dirty_scan"):
+        return DirtyScanPlan(dirty_paths, root_directory, relative_base, path_excluder, carry_forward,
+                             args.verify_percent, io_logger, args.walk_workers)
+
+
+# Scan one root directory and hash its files, returning the resulting DataFrame along with the comparison DataFrame if
+# it had to be read before scanning, or None otherwise, and the RollingScrub whose state is saved once every output is
+# written, or None. relative_base is the directory that stored relative paths start from, which is the current working
+# directory if None. Each phase is timed into the root's ScanMetrics
+def scan_directory_into_data_frame(args, relative_base, compare_mode, executor_logger, io_logger, hashing_engine,
+                                   read_engine, metrics):
+    # The comparison DataFrame is read before scanning when incremental mode needs its hashes, and after otherwise
+    comparison_data_frame = None
+    carry_forward = None
+    if args.incremental:
+        if args.comparison_hash_file is None:
+            executor_logger.warning("Ignoring --incremental as no comparison_hash_file was passed in")
+        else:
+            with metrics.phase("read_comparison"):
+                comparison_data_frame = read_comparison_data_frame(args.comparison_hash_file, io_logger,
+                                                                   executor_logger, compare_mode,
+                                                                   args.hash_file_string_dtype)
+            if comparison_data_frame is None:
+                executor_logger.warning("Ignoring --incremental as there are no hashes to carry forward")
+    # Files hashed before an interruption are carried forward from the checkpoint journal, taking precedence over the
+    # comparison since they're more recent
+    checkpoint_journal = None
+    carry_forward_data_frame = comparison_data_frame
+    if args.checkpoint_file is not None:
+        if args.resume:
+            with metrics.phase("load_checkpoint"):
+                journal_data_frame = load_checkpoint_journal(args.checkpoint_file, compare_mode, io_logger)
+            if journal_data_frame is not None:
+                carry_forward_data_frame = journal_data_frame if comparison_data_frame is None else concat(
+                    [journal_data_frame, comparison_data_frame]).drop_duplicates("relative_path", keep="first")
+        checkpoint_journal = CheckpointJournal(args.checkpoint_file, compare_mode, args.chunk_size_mb * 2 ** 20,
+                                               args.checkpoint_interval_seconds, io_logger, args.resume)
+    if carry_forward_data_frame is not None:
+        carry_forward = CarryForward(carry_forward_data_frame, args.verify_percent, args.log_level)
+    rolling_scrub = None
+    if args.compare_mode == CompareMode.ROLLING.value:
+        if carry_forward is None:
+            executor_logger.warning("Hashing every file of {} as there are no hashes from a previous run to "
+                                    "scrub".format(args.scan_directory))
+        else:
+            rolling_scrub = RollingScrub(args.scrub_cycle_runs, args.scrub_order, args.scrub_state_file, io_logger)
+            rolling_scrub.request_slice_verification(carry_forward)
+    path_excluder = create_path_excluder(args, args.scan_directory, relative_base)
+    dirty_scan_plan = None
+    if args.dirty_journal is not None:
+        dirty_scan_plan = plan_dirty_scan(args, relative_base, carry_forward, path_excluder, executor_logger,
+                                          io_logger, metrics)
+    executor_logger.info(
+        "Beginning directory scan and file hash computation of files in {} using compare_mode {}".format(
+            args.scan_directory, compare_mode))
+    byte_count_to_hash = 1000000
+    # TODO this isn't really computing diffs, so rename it to something else, maybe compute_hash or something
+    with metrics.phase("scan"):
+        scan_accumulator = compute_diffs(
+            args.scan_directory, io_logger, byte_count_to_hash=byte_count_to_hash, compare_mode=compare_mode,
+            log_update_interval_seconds=args.log_update_interval_seconds,
+            log_update_interval_files=args.log_update_interval_files, path_excluder=path_excluder,
+            carry_forward=carry_forward, hashing_engine=hashing_engine, relative_base=relative_base,
+            chunk_size_bytes=args.chunk_size_mb * 2 ** 20, checkpoint_journal=checkpoint_journal,
+            read_engine=read_engine, read_order=args.read_order, metrics=metrics, dirty_scan_plan=dirty_scan_plan,
+            walk_workers=args.walk_workers)
+        if checkpoint_journal is not None:
+            checkpoint_journal.close()
+    metrics.add_phase_totals("scan", metrics.files_seen, metrics.bytes_read)
+    executor_logger.info("Directory scan and file hash computation of {} complete. Building DataFrame from "
+                         "{} scanned files".format(args.scan_directory, len(scan_accumulator)))
+    with metrics.phase("build_data_frame"):
+        current_data_frame = scan_accumulator.to_data_frame()
+    metrics.add_phase_totals("build_data_frame", len(current_data_frame.index), 0)
+    # Files come out of the scan in whatever order walk workers listed their directories in, and a dirty journal scan
+    # stores carried files first, so sort by relative path to keep every output the same from run to run
+    with metrics.phase("sort"):
+        if not current_data_frame["relative_path"].is_monotonic_increasing:
+            current_data_frame = current_data_frame.sort_values("relative_path", ignore_index=True)
+    return current_data_frame, comparison_data_frame, rolling_scrub
+
+
+# Find rows sharing a hash, or a file size when hashing is disabled, and write them to the output_duplicates path
+def write_duplicates(current_data_frame, output_duplicates, compare_mode, executor_logger, io_logger,
+                     compression_level, compression_threads, extra_columns=None):
+    # Handle when all hashing is disabled and a diff can only occur on file size
+    if compare_mode == CompareMode.SIZE.value:
+        duplicate_field = "file_size_bytes"
+        output_schema = [duplicate_field, "relative_path"]
+    else:
+        duplicate_field = "hash"
+        output_schema = [duplicate_field, "relative_path", "file_size_bytes"]
+    if extra_columns is not None:
+        output_schema = output_schema + extra_columns
+    executor_logger.info("Finding duplicates in Current DataFrame based on {}".format(duplicate_field))
+    duplicates_data_frame = determine_duplicate_files(current_data_frame, duplicate_field, output_schema)
+    # https://stackoverflow.com/questions/45759966
+    # https://www.geeksforgeeks.org/how-to-count-distinct-values-of-a-pandas-dataframe-column/
+    io_logger.info("Writing Duplicate DataFrame with {} rows across {} groups to disk at {}".format(
+        len(duplicates_data_frame.index), len(duplicates_data_frame[duplicate_field].value_counts()),
+        output_duplicates))
+    write_hashes_to_file(duplicates_data_frame, output_duplicates, io_logger, compare_mode, compression_level,
+                         compression_threads)
+
+
+# Find removed, added, and modified files by streaming current_rows, an iterator of (relative_path, hash,
+# file_size_bytes) sorted by relative path, alongside the rows of the sorted comparison hash file. Each output is
+# written row by row as it's found, so neither input nor any output has to fit in memory
+def write_changes_streaming(current_rows, args, compare_mode, executor_logger, io_logger):
+    output_list = [("(Re)moved", args.output_removed_files), ("Added", args.output_added_files),
+                   ("Modified", args.output_modified_files)]
+    if all(output_path is None for _, output_path in output_list):
+        return
+    if not path.isfile(args.comparison_hash_file):
+        executor_logger.warning("Comparison hash file {} does not exist. Skipping any Added, Removed, or Modified "
+                                "analysis".format(args.comparison_hash_file))
+        return
+    executor_logger.info("Finding (Re)moved, Added, and Modified files by streaming the comparison hash file {} "
+                         "alongside the current hashes".format(args.comparison_hash_file))
+    comparison_rows = check_rows_sorted(iterate_hash_file_rows(args.comparison_hash_file, io_logger, compare_mode),
+                                        args.comparison_hash_file, io_logger)
+    current_rows = check_rows_sorted(current_rows, "Current hash list", io_logger)
+    hash_file_columns = ["relative_path", get_hash_column_name(compare_mode), "file_size_bytes"]
+    # https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
+    with ExitStack() as exit_stack:
+        row_writers = [None if output_path is None else
+                       exit_stack.enter_context(HashFileRowWriter(output_path, columns, io_logger,
+                                                                  args.compression_level, args.compression_threads))
+                       for (_, output_path), columns in zip(output_list, [hash_file_columns, hash_file_columns,
+                                                                          ["relative_path"]])]
+        determine_changes_streaming(current_rows, comparison_rows, *row_writers)
+    for (output_name, output_path), row_writer in zip(output_list, row_writers):
+        if row_writer is not None:
+            io_logger.info("Wrote {} rows of {} files to disk at {}".format(row_writer.row_count, output_name,
+                                                                            output_path))
+
+
+# Write one of the change outputs, named output_name in logs, to output_path
+def write_change_output(data_frame, output_name, output_path, args, compare_mode, io_logger):
+    io_logger.info("Writing {} DataFrame with {} rows to disk at {}".format(output_name, len(data_frame.index),
+                                                                            output_path))
+    write_hashes_to_file(data_frame, output_path, io_logger, compare_mode, args.compression_level,
+                         args.compression_threads)
+
+
+# Write the moved, removed, added, and modified outputs that have a path set in args, given the changes_data_frame from
+# classify_changes(). Moved files are found first, as they're left out of the rest, which are then formatted,
+# compressed, and written on up to args.analysis_workers threads at once
+def write_changes(changes_data_frame, current_data_frame, comparison_data_frame, args, compare_mode, executor_logger,
+                  io_logger):
+    # If CLI arg is set, pair up removed and added files with matching contents, leaving them out of both lists
+    if args.output_moved_files is not None:
+        executor_logger.info("Finding (Re)moved and Added files sharing a hash and size that have been Moved")
+        moved_data_frame = determine_moved_files(changes_data_frame)
+        write_change_output(moved_data_frame, "Moved", args.output_moved_files, args, compare_mode, io_logger)
+        # A path can't be both removed and added, so checking both columns of moved pairs only drops moved rows
+        moved_rows = changes_data_frame["relative_path"].isin(moved_data_frame["previous_relative_path"]) \
+            | changes_data_frame["relative_path"].isin(moved_data_frame["relative_path"])
+        changes_data_frame = changes_data_frame[~moved_rows]
+
+    output_tasks = []
+    # If CLI arg is set, write out files whose relative path is only in the comparison
+    if args.output_removed_files is not None:
+        removed_data_frame = changes_data_frame[changes_data_frame["change_type"] == REMOVED][CHANGE_COLUMNS]
+        output_tasks.append(partial(write_change_output, removed_data_frame, "(Re)moved", args.output_removed_files,
+                                    args, compare_mode, io_logger))
+
+    # If CLI arg is set, write out files whose relative path is only in the current_data_frame
+    if args.output_added_files is not None:
+        added_data_frame = changes_data_frame[changes_data_frame["change_type"] == ADDED][CHANGE_COLUMNS]
+        output_tasks.append(partial(write_change_output, added_data_frame, "Added", args.output_added_files, args,
+                                    compare_mode, io_logger))
+
+    # If CLI arg is set, write out files whose relative path is in both but whose hash changed
+    if args.output_modified_files is not None:
+        modified_data_frame = changes_data_frame[changes_data_frame["change_type"] == MODIFIED][["relative_path"]]
+        # Chunk digests allow pointing out which parts of each modified file changed
+        if compare_mode == CompareMode.CHUNK.value:
+            modified_data_frame = determine_modified_byte_ranges(modified_data_frame, current_data_frame,
+                                                                 comparison_data_frame)
+        output_tasks.append(partial(write_change_output, modified_data_frame, "Modified", args.output_modified_files,
+                                    args, compare_mode, io_logger))
+    run_concurrently(output_tasks, args.analysis_workers, "difflens-changes")
+
+
+# Return the columns of the comparison hash file needed to compare it against a scan. Only the columns compared are
+# read, except in chunk-hash mode where any chunk digests describe what changed
+def get_comparison_columns(compare_mode):
+    return None if compare_mode == CompareMode.CHUNK.value else CHANGE_COLUMNS
+
+
+# Return True if args asks for an output that needs the comparison hash file read into memory, rather than streamed
+def needs_comparison_data_frame(args):
+    change_outputs = [args.output_removed_files, args.output_added_files, args.output_modified_files,
+                      args.output_moved_files]
+    return args.comparison_hash_file is not None and not args.streaming_comparison \
+        and any(output_path is not None for output_path in change_outputs)
+
+
+# Read the comparison hash file for comparing against a scan, timed as the read_comparison phase of metrics
+def read_comparison_for_changes(args, compare_mode, executor_logger, io_logger, metrics):
+    with metrics.phase("read_comparison"):
+        return read_comparison_data_frame(args.comparison_hash_file, io_logger, executor_logger, compare_mode,
+                                          args.hash_file_string_dtype, get_comparison_columns(compare_mode))
+
+
+# Start reading the comparison hash file on a thread of its own if args needs it read into memory and allows more than
+# one analysis worker, so it loads while the current hashes are still being scanned or read. Returns a Future of the
+# comparison DataFrame, or None if it's to be read once the current hashes are ready, if at all
+def read_comparison_in_background(args, compare_mode, executor_logger, io_logger, metrics):
+    if args.analysis_workers <= 1 or not needs_comparison_data_frame(args):
+        return None
+    comparison_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="difflens-comparison")
+    comparison_future = comparison_executor.submit(read_comparison_for_changes, args, compare_mode, executor_logger,
+                                                   io_logger, metrics)
+    # Let the read finish on its own, after which the thread exits
+    comparison_executor.shutdown(wait=False)
+    return comparison_future
+
+
+# Call each function in functions with no arguments, on up to worker_count threads at once, returning once all are done.
+# Raises the first exception any of them raised, in the order they were given
+def run_concurrently(functions, worker_count, thread_name_prefix):
+    if worker_count <= 1 or len(functions) <= 1:
+        for function in functions:
+            function()
+        return
+    with ThreadPoolExecutor(max_workers=min(worker_count, len(functions)),
+                            thread_name_prefix=thread_name_prefix) as executor:
+        futures = [executor.submit(function) for function in functions]
+        for future in futures:
+            future.result()
+
+
+# Run function(*args) timed as phase_name of metrics, returning what it returned
+def run_in_phase(metrics, phase_name, function, *args):
+    with metrics.phase(phase_name):
+        return function(*args)
+
+
+# Write the sorted current_data_frame to args.output_hash_file, timed as the write_hash_file phase of metrics
+def write_hash_file(current_data_frame, args, compare_mode, io_logger, metrics):
+    current_data_frame_rows = len(current_data_frame.index)
+    io_logger.info("Writing newly computed {} for {} files to disk at {}".format(compare_mode, current_data_frame_rows,
+                                                                                 args.output_hash_file))
+    with metrics.phase("write_hash_file"):
+        write_hashes_to_file(current_data_frame, args.output_hash_file, io_logger, compare_mode,
+                             args.compression_level, args.compression_threads)
+    metrics.add_phase_totals("write_hash_file", current_data_frame_rows, 0)
+
+
+# Find and write the removed, added, modified, and moved outputs set in args, streaming the comparison hash file if
+# asked to, and otherwise comparing against comparison_data_frame. If that's None, it's taken from comparison_future if
+# the comparison was read in the background, or read now
+def analyze_changes(current_data_frame, comparison_data_frame, comparison_future, args, compare_mode, executor_logger,
+                    io_logger, metrics):
+    # Stream the comparison_hash_file rather than reading it in if asked to, unless it was already read in
+    if args.streaming_comparison and comparison_data_frame is None and args.comparison_hash_file is not None:
+        # zip() yields one row at a time from the columns, converting sizes to int so they're written unquoted
+        current_rows = zip(current_data_frame["relative_path"], current_data_frame["hash"],
+                           map(int, current_data_frame["file_size_bytes"]))
+        with metrics.phase("stream_changes"):
+            write_changes_streaming(current_rows, args, compare_mode, executor_logger, io_logger)
+        return
+
+    change_outputs = [args.output_removed_files, args.output_added_files, args.output_modified_files,
+                      args.output_moved_files]
+    if all(output_path is None for output_path in change_outputs):
+        return
+    if args.comparison_hash_file is None:
+        executor_logger.warning(
+            "Skipping any Added, Removed, Modified, or Moved analysis as no comparison_hash_file was passed in")
+        return
+    # If the path to a comparison_hash_file is provided by the CLI, read it in for comparison-based analysis, unless
+    # that already happened while the current hashes were being scanned or read
+    if comparison_data_frame is None:
+        if comparison_future is not None:
+            comparison_data_frame = comparison_future.result()
+        else:
+            comparison_data_frame = read_comparison_for_changes(args, compare_mode, executor_logger, io_logger,
+                                                                metrics)
+    if comparison_data_frame is None:
+        executor_logger.warning("Skipping any Added, Removed, Modified, or Moved analysis as the comparison hash file "
+                                "could not be read")
+        return
+    # Both current_data_frame and comparison_data_frame are loaded into memory, begin analysis
+    with metrics.phase("classify_changes"):
+        if have_same_files(current_data_frame, comparison_data_frame):
+            # Skip the join, as every output would be empty. Classifying no rows gives those empty outputs their columns
+            executor_logger.info("Current and comparison hashes match row for row, so no file was Added, (Re)moved, "
+                                 "Modified, or Moved")
+            changes_data_frame = classify_changes(current_data_frame.iloc[:0], comparison_data_frame.iloc[:0])
+        else:
+            executor_logger.info("Classifying each file as Added, (Re)moved, Modified, or unchanged by relative path")
+            changes_data_frame = classify_changes(current_data_frame, comparison_data_frame)
+    metrics.add_phase_totals("classify_changes", len(changes_data_frame.index), 0)
+
+    with metrics.phase("write_changes"):
+        write_changes(changes_data_frame, current_data_frame, comparison_data_frame, args, compare_mode,
+                      executor_logger, io_logger)
+
+
+# Write the current_data_frame to disk and run each analysis that has an output path set in args, timing each phase
+# into metrics. Writing the hash file, finding duplicates, and comparing against the comparison hash file don't depend
+# on one another, so they run on up to args.analysis_workers threads at once, each one's output compressed and written
+# while the others are still being worked out. comparison_future is the Future of a comparison DataFrame being read in
+# the background, if it's not yet in comparison_data_frame
+def analyze_and_write_outputs(current_data_frame, comparison_data_frame, args, compare_mode, executor_logger,
+                              io_logger, metrics, comparison_future=None):
+    # The current_data_frame should now be loaded, either from scanning or reading in a file.
+    # https://stackoverflow.com/questions/15943769
+    current_data_frame_rows = len(current_data_frame.index)
+    # Sort by relative path so hash files are written in the order a streaming comparison walks them
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.sort_values.html
+    # https://pandas.pydata.org/docs/reference/api/pandas.Series.is_monotonic_increasing.html
+    with metrics.phase("sort"):
+        if not current_data_frame["relative_path"].is_monotonic_increasing:
+            current_data_frame = current_data_frame.sort_values("relative_path", ignore_index=True)
+    output_tasks = []
+    # Write current_data_frame to disk if an output path was provided.
+    if args.output_hash_file is not None:
+        # If only one instance of input-hash-file was passed in, this would do nothing. Otherwise, we're in concat mode
+        # and the output is unique content that should be saved
+        if args.input_hash_file is not None and len(args.input_hash_file) == 1:
+            executor_logger.info(
+                "Desired output {} would be identical to {}, use that instead as no scan+compute took place".format(
+                    args.output_hash_file, args.input_hash_file[0]))
+        else:
+            output_tasks.append(partial(write_hash_file, current_data_frame, args, compare_mode, io_logger, metrics))
+
+    executor_logger.info("Beginning analysis of Current DataFrame with {} rows".format(current_data_frame_rows))
+
+    # If CLI arg is set, perform the only analysis that can be done without a comparison file: finding duplicates
+    if args.output_duplicates is not None:
+        output_tasks.append(partial(run_in_phase, metrics, "find_duplicates", write_duplicates, current_data_frame,
+                                    args.output_duplicates, compare_mode, executor_logger, io_logger,
+                                    args.compression_level, args.compression_threads))
+
+    output_tasks.append(partial(analyze_changes, current_data_frame, comparison_data_frame, comparison_future, args,
+                                compare_mode, executor_logger, io_logger, metrics))
+    run_concurrently(output_tasks, args.analysis_workers, "difflens-output")
+
+
+# Scan and hash each root directory on its own thread, then write outputs and run analysis for each root, plus finding
+# duplicates across every root if the duplicates output path is shared by all of them. Each root's phases are timed into
+# its own ScanMetrics, and phases spanning every root into those of the run
+def scan_and_analyze_roots(args, root_args_list, root_names, relative_bases, root_loggers, compare_mode,
+                           executor_logger, io_logger, hashing_engine, read_engine, run_metrics):
+    scan_metrics_list = [run_metrics.create_scan_metrics(root_args.root_name) for root_args in root_args_list]
+    # Comparison hash files needed after the scan are read while it runs, unless incremental mode reads them before
+    comparison_futures = [None if root_args.incremental else
+                          read_comparison_in_background(root_args, compare_mode, executor_logger, root_logger,
+                                                        scan_metrics)
+                          for root_args, root_logger, scan_metrics in zip(root_args_list, root_loggers,
+                                                                          scan_metrics_list)]
+    # Give each root its own thread reading from its disk, while sharing the hashing_engine if there is one
+    # https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+    with ThreadPoolExecutor(max_workers=len(root_args_list), thread_name_prefix="difflens-root") as executor:
+        futures = [executor.submit(scan_directory_into_data_frame, root_args, relative_base, compare_mode,
+                                   executor_logger, root_logger, hashing_engine, read_engine, scan_metrics)
+                   for root_args, relative_base, root_logger, scan_metrics in zip(root_args_list, relative_bases,
+                                                                                  root_loggers, scan_metrics_list)]
+        # result() waits for each scan to finish and raises any exception the scan ran into
+        scan_results = [future.result() for future in futures]
+    # Print out stats on memory used
+    # https://stackoverflow.com/questions/938733
+    process = Process(getpid())
+    # https://stackoverflow.com/questions/455612
+    executor_logger.info("RAM used by Python process: {:.1f}MB".format(process.memory_info().rss / 1000 / 1000))
+
+    for root_args, root_logger, scan_metrics, (current_data_frame, comparison_data_frame, _), comparison_future in zip(
+            root_args_list, root_loggers, scan_metrics_list, scan_results, comparison_futures):
+        analyze_and_write_outputs(current_data_frame, comparison_data_frame, root_args, compare_mode,
+                                  executor_logger, root_logger, scan_metrics, comparison_future)
+
+    # With multiple roots and a single duplicates output, look for duplicates across all of them together
+    if len(root_args_list) > 1 and args.output_duplicates is not None \
+            and ROOT_NAME_PLACEHOLDER not in args.output_duplicates:
+        # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.assign.html
+        with run_metrics.run_metrics.phase("find_duplicates"):
+            all_roots_data_frame = concat([current_data_frame.assign(scan_root=root_name)
+                                           for root_name, (current_data_frame, _, _) in zip(root_names, scan_results)])
+            write_duplicates(all_roots_data_frame, args.output_duplicates, compare_mode, executor_logger, io_logger,
+                             args.compression_level, args.compression_threads, ["scan_root"])
+
+    # Bring the index up to date with each root's scan, which only writes the files that changed since the last one
+    if args.index_database is not None:
+        executor_logger.info("Updating index {} with the scan of {}".format(args.index_database, root_names))
+        with run_metrics.run_metrics.phase("update_index"):
+            # validate_index_args() already confirmed the index holds hashes from this compare_mode
+            hash_index = HashIndex(args.index_database, compare_mode, io_logger)
+            for root_args, (current_data_frame, _, _) in zip(root_args_list, scan_results):
+                hash_index.update_root(root_args.root_name, current_data_frame)
+            hash_index.close()
+
+    # Every output has been written, so there's nothing left for the checkpoint journals to resume, the next run only
+    # needs the changes made since this run claimed its dirty journals, and it can move on to the scrub slice after
+    # this run's. A run that fails before this point scrubs the same slice again
+    for root_args, root_logger, (_, _, rolling_scrub) in zip(root_args_list, root_loggers, scan_results):
+        if rolling_scrub is not None:
+            rolling_scrub.save_state()
+        if root_args.checkpoint_file is not None:
+            remove_checkpoint_journal(root_args.checkpoint_file, root_logger)
+        if root_args.dirty_journal is not None:
+            remove_claimed_dirty_journal(root_args.dirty_journal, root_logger)
+
+
 def main():
     # Set up the argparse object that defines and handles program input arguments
     parser = configure_argument_parser()
@@ -101,113 +979,106 @@ def main():
     compare_mode = args.compare_mode
 
     executor_logger.warning("Starting difflens from current working directory {}".format(getcwd()))
+    run_metrics = create_run_metrics(args, executor_logger)
+    validate_moved_files_args(args, compare_mode, executor_logger)
+    validate_checkpoint_args(args, compare_mode, executor_logger)
+    validate_hash_store_args(args, compare_mode, executor_logger)
+    validate_string_dtype_args(args, executor_logger)
+    validate_compression_args(args, executor_logger)
+    validate_exclude_args(args, executor_logger)
+    validate_walk_workers_args(args, executor_logger)
+    validate_rolling_scrub_args(args, executor_logger)
+    if compare_mode == CompareMode.ROLLING.value:
+        # A rolling scrub stores full hashes, so its hash files can be compared with those of full-hash runs. It carries
+        # forward the hashes of files outside the slice it scrubs, so it's always incremental
+        compare_mode = CompareMode.FULL.value
+        if args.input_hash_file is None:
+            args.incremental = True
+    validate_dirty_journal_args(args, executor_logger)
+    validate_index_args(args, compare_mode, executor_logger)
+    if args.input_hash_file is not None and args.index_database is not None:
+        executor_logger.warning("Ignoring --index-database as there is no scan directory to name the hashes after. "
+                                "Use difflens-index add instead")
+    if args.input_hash_file is not None and args.checkpoint_file is not None:
+        executor_logger.warning("Ignoring --checkpoint-file as there is no scan to checkpoint")
+    if args.input_hash_file is not None and args.dirty_journal is not None:
+        executor_logger.warning("Ignoring --dirty-journal as there is no scan to guide")
 
     # If the scan directory was given and not the input hash file, try to scan
     if args.scan_directory is not None and args.input_hash_file is None:
-        executor_logger.info(
-            "Beginning directory scan and file hash computation of files in {} using compare_mode {}".format(
-                args.scan_directory, compare_mode))
-        byte_count_to_hash = 1000000
-        path_excluder = PathExcluder(args.exclude_file_extension, args.exclude_relative_path, args.log_level)
-        # TODO this isn't really computing diffs, so rename it to something else, maybe compute_hash or something
-        current_dict = compute_diffs(args.scan_directory, io_logger, byte_count_to_hash=byte_count_to_hash,
-                                     compare_mode=compare_mode,
-                                     log_update_interval_seconds=args.log_update_interval_seconds,
-                                     log_update_interval_files=args.log_update_interval_files,
-                                     path_excluder=path_excluder)
-        executor_logger.info("Directory scan and file hash computation complete. Flattening output into DataFrame")
-        current_data_frame = flatten_dict_to_data_frame(current_dict)
-        # Print out stats on memory used
-        # https://stackoverflow.com/questions/938733
-        process = Process(getpid())
-        # https://stackoverflow.com/questions/455612
-        executor_logger.info("RAM used by Python process: {:.1f}MB".format(process.memory_info().rss / 1000 / 1000))
+        # Name each root after its last directory, such as disk1 for /mnt/disk1, and validate each is a directory
+        root_directories = [sanitize_and_validate_directory_path(root, executor_logger)
+                            for root in args.scan_directory]
+        root_names = [path.basename(root) for root in root_directories]
+        validate_comparison_args(args, len(root_directories), executor_logger)
+        hashing_engine = None
+        if args.hash_workers > 1:
+            hashing_engine = HashingEngine(args.hash_workers, args.rotational_device_readers,
+                                           args.solid_state_device_readers, args.log_level)
+        read_engine = create_read_engine(args)
+        if len(root_directories) == 1:
+            # A single root keeps storing paths relative to the current working directory
+            root_args_list = [get_root_args(args, 0, root_names[0])]
+            root_loggers = [io_logger]
+            relative_bases = [None]
+        else:
+            # Multiple roots store paths relative to each root, so they line up with hash files from single-root scans
+            # run from inside each root directory
+            validate_multiple_root_args(args, root_names, executor_logger)
+            root_args_list = [get_root_args(args, root_index, root_name)
+                              for root_index, root_name in enumerate(root_names)]
+            root_loggers = [get_logger_with_name("IO-{}".format(root_name), args.log_level) for root_name in root_names]
+            relative_bases = root_directories
+            # Duplicates are found across all roots at once unless the output path asks for one file per root
+            if args.output_duplicates is not None and ROOT_NAME_PLACEHOLDER not in args.output_duplicates:
+                for root_args in root_args_list:
+                    root_args.output_duplicates = None
+
+        if args.lazy_duplicates:
+            validate_lazy_duplicates_args(args, executor_logger)
+            find_duplicates_lazily(args, root_args_list, relative_bases, root_loggers, compare_mode, executor_logger,
+                                   io_logger, hashing_engine, read_engine, run_metrics)
+        else:
+            scan_and_analyze_roots(args, root_args_list, root_names, relative_bases, root_loggers, compare_mode,
+                                   executor_logger, io_logger, hashing_engine, read_engine, run_metrics)
+        if hashing_engine is not None:
+            hashing_engine.shutdown()
+    elif args.streaming_comparison and len(args.input_hash_file) == 1 and args.output_duplicates is None:
+        # Only a streaming comparison between two hash files was asked for, so stream both rather than reading either
+        validate_comparison_args(args, 1, executor_logger)
+        if args.comparison_hash_file is None:
+            executor_logger.warning(
+                "Skipping any Added, Removed, or Modified analysis as no comparison_hash_file was passed in")
+        else:
+            args.comparison_hash_file = args.comparison_hash_file[0]
+            io_logger.info("Streaming current hashes from {} rather than reading them into memory".format(
+                args.input_hash_file[0]))
+            with run_metrics.run_metrics.phase("stream_changes"):
+                write_changes_streaming(iterate_hash_file_rows(args.input_hash_file[0], io_logger, compare_mode),
+                                        args, compare_mode, executor_logger, io_logger)
     else:
         # Otherwise, the hash files were provided in place of a scan directory. Read them in as data_frames,
         # merging with each other if there are multiple
+        validate_comparison_args(args, 1, executor_logger)
+        if args.comparison_hash_file is not None:
+            args.comparison_hash_file = args.comparison_hash_file[0]
+        comparison_future = read_comparison_in_background(args, compare_mode, executor_logger, io_logger,
+                                                          run_metrics.run_metrics)
         io_logger.info(
             "Reading current_data_frame from file(s) {} rather than directory scan".format(args.input_hash_file))
-        current_data_frame = read_hashes_from_files(args.input_hash_file, io_logger, compare_mode)
+        with run_metrics.run_metrics.phase("read_input_hashes"):
+            current_data_frame = read_hashes_from_files(args.input_hash_file, io_logger, compare_mode,
+                                                        string_dtype=args.hash_file_string_dtype)
+        run_metrics.run_metrics.add_phase_totals("read_input_hashes", len(current_data_frame.index), 0)
         duplicate_file_names = determine_duplicate_files(current_data_frame, "relative_path", ["relative_path"])
         # https://stackoverflow.com/questions/19828822
         if not duplicate_file_names.empty:
             executor_logger.warning("Input Hash Files contained {} colliding relative paths! "
                                     "Confirm the inputs contain expected data.".format(len(duplicate_file_names.index)))
+        analyze_and_write_outputs(current_data_frame, None, args, compare_mode, executor_logger, io_logger,
+                                  run_metrics.run_metrics, comparison_future)
 
-    # The current_data_frame should now be loaded, either from scanning or reading in a file.
-    # https://stackoverflow.com/questions/15943769
-    current_data_frame_rows = len(current_data_frame.index)
-    # Write current_data_frame to disk if an output path was provided.
-    if args.output_hash_file is not None:
-        # If only one instance of input-hash-file was passed in, this would do nothing. Otherwise, we're in concat mode
-        # and the output is unique content that should be saved
-        if args.input_hash_file is not None and len(args.input_hash_file) == 1:
-            executor_logger.info(
-                "Desired output {} would be identical to {}, use that instead as no scan+compute took place".format(
-                    args.output_hash_file, args.input_hash_file[0]))
-        else:
-            io_logger.info(
-                "Writing newly computed {} for {} files to disk at {}".format(compare_mode, current_data_frame_rows,
-                                                                              args.output_hash_file))
-            write_hashes_to_file(current_data_frame, args.output_hash_file, io_logger, compare_mode)
-
-    executor_logger.info("Beginning analysis of Current DataFrame with {} rows".format(current_data_frame_rows))
-
-    # If CLI arg is set, perform the only analysis that can be done without a comparison file: finding duplicates
-    if args.output_duplicates is not None:
-        # Handle when all hashing is disabled and a diff can only occur on file size
-        if compare_mode == CompareMode.SIZE.value:
-            duplicate_field = "file_size_bytes"
-            output_schema = [duplicate_field, "relative_path"]
-        else:
-            duplicate_field = "hash"
-            output_schema = [duplicate_field, "relative_path", "file_size_bytes"]
-        executor_logger.info("Finding duplicates in Current DataFrame based on {}".format(duplicate_field))
-        duplicates_data_frame = determine_duplicate_files(current_data_frame, duplicate_field, output_schema)
-        # https://stackoverflow.com/questions/45759966
-        # https://www.geeksforgeeks.org/how-to-count-distinct-values-of-a-pandas-dataframe-column/
-        io_logger.info("Writing Duplicate DataFrame with {} rows across {} groups to disk at {}".format(
-            len(duplicates_data_frame.index), len(duplicates_data_frame[duplicate_field].value_counts()),
-            args.output_duplicates))
-        write_hashes_to_file(duplicates_data_frame, args.output_duplicates, io_logger, compare_mode)
-
-    # If the path to a comparison_hash_file is provided by the CLI, read it in for comparison-based analysis
-    if args.comparison_hash_file is not None:
-        io_logger.info("Reading Comparison DataFrame from disk at {}".format(args.comparison_hash_file))
-        comparison_data_frame = read_hashes_from_files([args.comparison_hash_file], io_logger, compare_mode)
-
-        # Both current_data_frame and comparison_data_frame are loaded into memory, begin analysis
-
-        # If CLI arg is set, look for deleted files based on relative path
-        if args.output_removed_files is not None:
-            executor_logger.info("Finding files in the comparison_data_frame that have been (Re)moved")
-            removed_data_frame = determine_removed_files(comparison_data_frame, current_data_frame)
-            io_logger.info(
-                "Writing (Re)moved DataFrame with {} rows to disk at {}".format(len(removed_data_frame.index),
-                                                                                args.output_removed_files))
-            write_hashes_to_file(removed_data_frame, args.output_removed_files, io_logger, compare_mode)
-
-        # If CLI arg is set, look for added files based on relative path
-        if args.output_added_files is not None:
-            executor_logger.info("Finding files in the comparison_data_frame that have been Added")
-            added_data_frame = determine_removed_files(current_data_frame, comparison_data_frame)
-            io_logger.info("Writing Added DataFrame with {} rows to disk at {}".format(len(added_data_frame.index),
-                                                                                       args.output_added_files))
-            write_hashes_to_file(added_data_frame, args.output_added_files, io_logger, compare_mode)
-
-        # If CLI arg is set, look for modified files based on relative path and hash
-        if args.output_modified_files is not None:
-            executor_logger.info("Finding files with different hashes than their Comparison DataFrame counterparts")
-            modified_data_frame = determine_modified_files(comparison_data_frame, current_data_frame)
-            io_logger.info("Writing Modified DataFrame with {} rows to disk at {}".format(
-                len(modified_data_frame.index), args.output_modified_files))
-            write_hashes_to_file(modified_data_frame, args.output_modified_files, io_logger, compare_mode)
-    else:
-        if args.output_removed_files is not None \
-                or args.output_added_files is not None \
-                or args.output_modified_files is not None:
-            executor_logger.warning(
-                "Skipping any Added, Removed, or Modified analysis as no comparison_hash_file was passed in")
+    run_metrics.write()
     executor_logger.warning("Shutting down difflens")
     exit(0)
 
@@ -0,0 +1,133 @@
+# Used to pick a random sample of carried-forward files to re-verify against their on-disk contents
+from random import random
+
+from .chunkhash import CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN, hex_to_chunk_digests
+from .loghelper import get_logger_with_name
+
+# Columns recorded for each scanned file in addition to relative_path, hash, and file_size_bytes. If all of these and
+# the file size match the comparison hash file, the file is assumed unchanged and its old hash is carried forward
+METADATA_COLUMNS = ["modified_time_ns", "inode", "device"]
+
+
+# Holds the hashes and file metadata of a previous scan, keyed by relative path, so that compute_diffs can skip reading
+# files whose size, modification time, inode, and device all still match what was recorded last time
+class CarryForward:
+    def __init__(self, comparison_data_frame, verify_percent, log_level):
+        self.logger = get_logger_with_name("CarryForward", log_level)
+        # Percentage (0-100) of otherwise carried-forward files that should be read and hashed anyway to catch bitrot
+        self.verify_percent = verify_percent
+        self.carry_forward_dict = build_carry_forward_dict(comparison_data_frame, self.logger)
+        # Files of the comparison that can't be carried forward, as they're missing metadata
+        self.files_without_metadata = len(comparison_data_frame.index) - len(self.carry_forward_dict)
+        # In chunk-hash mode, dict of {key:relative_path, value:(chunk_size_bytes, chunk_digests_hex)}
+        self.chunk_digests_dict = build_chunk_digests_dict(comparison_data_frame)
+        self.files_appended = 0
+        # Relative paths chosen for verification this run, mapped to the hash they are expected to have
+        self.pending_verification_dict = {}
+        # Relative paths that must be verified if they're unchanged, whatever verify_percent is
+        self.requested_verification_paths = set()
+        # Initialize counters used for the summary at the end of the scan
+        self.files_carried = self.bytes_carried = self.files_verified = self.files_mismatched = 0
+        self.logger.info("CarryForward initialized with {} previously hashed files, verifying {}% of unchanged "
+                         "files".format(len(self.carry_forward_dict), verify_percent))
+
+    # Return the previously computed hash of a file if its metadata is unchanged, or None if it must be (re)hashed.
+    # Unchanged files picked for verification also return None, with their expected hash remembered for later
+    def get_carried_hash(self, relative_path, file_size_bytes, modified_time_ns, inode, device):
+        previous_entry = self.carry_forward_dict.get(relative_path)
+        if previous_entry is None or previous_entry[:4] != (file_size_bytes, modified_time_ns, inode, device):
+            return None
+        # https://docs.python.org/3/library/random.html#random.random
+        if relative_path in self.requested_verification_paths \
+                or self.verify_percent > 0 and random() * 100 < self.verify_percent:
+            self.requested_verification_paths.discard(relative_path)
+            self.pending_verification_dict[relative_path] = previous_entry[4]
+            return None
+        self.files_carried += 1
+        self.bytes_carried += file_size_bytes
+        return previous_entry[4]
+
+    # Have get_carried_hash() pick a file for verification if it's unchanged, such as one sampled for bitrot by a scan
+    # that doesn't look at every file
+    def request_verification(self, relative_path):
+        self.requested_verification_paths.add(relative_path)
+
+    # Return a Tuple of (hash, file_size_bytes, file_metadata) of a file assumed unchanged without looking at it, such
+    # as one a dirty journal doesn't mention, counting it as carried forward
+    def get_unchanged_row(self, relative_path):
+        file_size_bytes, modified_time_ns, inode, device, hash_string = self.carry_forward_dict[relative_path]
+        self.files_carried += 1
+        self.bytes_carried += file_size_bytes
+        return hash_string, file_size_bytes, (modified_time_ns, inode, device)
+
+    # Return the raw chunk digests recorded for a file whose hash was carried forward, or empty bytes if there are none
+    def get_carried_chunk_digests(self, relative_path, carried_hash):
+        chunk_size_bytes, chunk_digests_hex = self.chunk_digests_dict.get(relative_path, (None, ""))
+        if chunk_size_bytes is None:
+            return b""
+        return hex_to_chunk_digests(chunk_digests_hex, carried_hash)
+
+    # If a file is still the same file on the same device as last scan but has grown, it may have only been appended to.
+    # Return a Tuple of (previous_file_size_bytes, previous_chunk_digests) for hash_file_chunks() to reuse, or None
+    def get_appended_file_chunks(self, relative_path, file_size_bytes, inode, device, chunk_size_bytes):
+        previous_entry = self.carry_forward_dict.get(relative_path)
+        if previous_entry is None or previous_entry[2:4] != (inode, device) or previous_entry[0] >= file_size_bytes:
+            return None
+        previous_chunk_size_bytes, chunk_digests_hex = self.chunk_digests_dict.get(relative_path, (None, ""))
+        if previous_chunk_size_bytes != chunk_size_bytes:
+            return None
+        self.files_appended += 1
+        return previous_entry[0], hex_to_chunk_digests(chunk_digests_hex, previous_entry[4])
+
+    # Compare a freshly computed hash against the carried-forward hash, if the file was picked for verification
+    def check_verified_hash(self, relative_path, computed_hash):
+        expected_hash = self.pending_verification_dict.pop(relative_path, None)
+        if expected_hash is None:
+            return
+        self.files_verified += 1
+        if expected_hash != computed_hash:
+            self.files_mismatched += 1
+            self.logger.warning("File {} has unchanged size and modification time but its hash changed from {} to {}. "
+                                "Possible bitrot!".format(relative_path, expected_hash, computed_hash))
+
+    # Print out summarized information on the files that were carried forward or verified
+    def log_summary(self):
+        self.logger.info("Carried forward hashes for {} unchanged files, skipping reading {:.0f}MB from disk".format(
+            self.files_carried, self.bytes_carried / 1000 / 1000))
+        if self.files_appended > 0:
+            self.logger.info("Found {} files that grew in place, reading only what was appended if their last full "
+                             "chunk was unchanged".format(self.files_appended))
+        if self.verify_percent > 0 or self.files_verified > 0:
+            self.logger.info("Verified {} unchanged files by rehashing them, {} of which had a different hash".format(
+                self.files_verified, self.files_mismatched))
+
+
+# Convert the comparison DataFrame into a dict of {key:relative_path, value:(size, mtime, inode, device, hash)}
+# Rows that are missing any of the metadata columns, such as those written by older versions, are left out
+def build_carry_forward_dict(comparison_data_frame, logger):
+    missing_columns = [column for column in METADATA_COLUMNS if column not in comparison_data_frame.columns]
+    if missing_columns:
+        logger.warning("Comparison DataFrame is missing columns {}, so no hashes can be carried forward and every "
+                       "file will be hashed".format(missing_columns))
+        return {}
+    # Drop rows where any of the metadata is NaN, which happens when concatenating old and new style hash files
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.dropna.html
+    usable_data_frame = comparison_data_frame.dropna(subset=["file_size_bytes"] + METADATA_COLUMNS)
+    # Zip the columns together rather than using iterrows(), which is far slower on large DataFrames
+    # https://stackoverflow.com/questions/16476924
+    return {relative_path: (int(size), int(modified_time_ns), int(inode), int(device), hash_string)
+            for relative_path, hash_string, size, modified_time_ns, inode, device in
+            zip(usable_data_frame["relative_path"], usable_data_frame["hash"], usable_data_frame["file_size_bytes"],
+                usable_data_frame["modified_time_ns"], usable_data_frame["inode"], usable_data_frame["device"])}
+
+
+# Convert the chunk columns of the comparison DataFrame into a dict of
+# {key:relative_path, value:(chunk_size_bytes, chunk_digests_hex)}, or an empty dict if it wasn't from chunk-hash mode
+def build_chunk_digests_dict(comparison_data_frame):
+    if not all(column in comparison_data_frame.columns for column in [CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN]):
+        return {}
+    usable_data_frame = comparison_data_frame.dropna(subset=[CHUNK_SIZE_COLUMN])
+    return {relative_path: (int(chunk_size_bytes), chunk_digests_hex)
+            for relative_path, chunk_size_bytes, chunk_digests_hex in
+            zip(usable_data_frame["relative_path"], usable_data_frame[CHUNK_SIZE_COLUMN],
+                usable_data_frame[CHUNK_DIGESTS_COLUMN].fillna(""))}
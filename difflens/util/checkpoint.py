@@ -0,0 +1,127 @@
+# Used to make each batch of journal rows durable before moving on, and to remove the journal once it is not needed
+from os import fsync, path, remove, truncate
+# Used to write journal rows in the same delimited format as hash files
+from csv import QUOTE_NONNUMERIC, writer
+# Used to look for complete rows without reading the whole journal into memory
+import mmap
+# Used to find where the last complete row of the journal ends
+import re
+# Used to decide when enough time has passed to write out the next batch
+from time import time
+
+from .carryforward import METADATA_COLUMNS
+from .chunkhash import CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN, chunk_digests_to_hex
+from .compareMode import CompareMode
+from .hashfileio import get_hash_column_name, open_hash_text_file, read_hashes_from_files
+
+# Most rows held in memory before a batch is written out, however little time has passed
+CHECKPOINT_BATCH_FILES = 10000
+# Matches up to CHECKPOINT_BATCH_FILES complete rows. Quoted fields such as relative paths may hold line breaks, with
+# quotes and backslashes inside them escaped by a backslash, so only a line break outside of quotes ends a row. The
+# loops are unrolled so the regular expression engine doesn't keep state for every byte it matches
+# https://docs.python.org/3/library/re.html#regular-expression-syntax
+COMPLETE_ROWS_PATTERN = re.compile(rb'(?:[^"\n]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\n]*)*\n){1,%d}'
+                                   % CHECKPOINT_BATCH_FILES, re.DOTALL)
+
+
+# Cut off a row left half written when the previous run was killed partway through a batch, so the journal can be read
+# and appended to. Looking back for the last line break isn't enough, as the row may have been cut off inside a quoted
+# relative path holding one, so the journal is matched from the start up to the end of its last complete row. Returns
+# the amount of bytes dropped
+def truncate_partial_row(checkpoint_path):
+    with open(checkpoint_path, "rb") as stream, \
+            mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as journal:
+        journal_size = len(journal)
+        complete_length = 0
+        rows_match = COMPLETE_ROWS_PATTERN.match(journal)
+        while rows_match is not None:
+            complete_length = rows_match.end()
+            rows_match = COMPLETE_ROWS_PATTERN.match(journal, complete_length)
+    if complete_length < journal_size:
+        truncate(checkpoint_path, complete_length)
+    return journal_size - complete_length
+
+
+# Read the rows a previous, unfinished run saved to its checkpoint journal, in the same form as a comparison DataFrame
+# so they can be carried forward. Files recorded more than once, as happens after resuming more than once, keep their
+# latest row. Returns None if there is no journal or it has no rows
+def load_checkpoint_journal(checkpoint_path, compare_mode, logger):
+    if not path.isfile(checkpoint_path) or path.getsize(checkpoint_path) == 0:
+        logger.warning("No checkpoint journal found at {}, starting the scan from the beginning".format(
+            checkpoint_path))
+        return None
+    dropped_bytes = truncate_partial_row(checkpoint_path)
+    if dropped_bytes:
+        logger.info("Dropped the last {} bytes of checkpoint journal {}, which held a partially written row".format(
+            dropped_bytes, checkpoint_path))
+    journal_data_frame = read_hashes_from_files([checkpoint_path], logger, compare_mode)
+    if journal_data_frame.empty:
+        return None
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.drop_duplicates.html
+    journal_data_frame = journal_data_frame.drop_duplicates("relative_path", keep="last")
+    logger.info("Resuming from checkpoint journal {} with {} files already hashed".format(
+        checkpoint_path, len(journal_data_frame.index)))
+    return journal_data_frame
+
+
+# Appends the hash and metadata of each scanned file to a journal on disk, so a scan that is interrupted, such as by an
+# Unraid server rebooting, can be resumed without rehashing what it already got through. Rows are held in memory and
+# written out in batches every interval_seconds, each batch synced to disk before the next is collected
+class CheckpointJournal:
+    # If resume is True, rows are appended to the existing journal rather than starting a new one
+    def __init__(self, checkpoint_path, compare_mode, chunk_size_bytes, interval_seconds, logger, resume):
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size_bytes = chunk_size_bytes if compare_mode == CompareMode.CHUNK.value else None
+        self.interval_seconds = interval_seconds
+        self.logger = logger
+        self.pending_rows = []
+        self.rows_written = 0
+        self.last_write_time = time()
+        column_names = ["relative_path", get_hash_column_name(compare_mode), "file_size_bytes"] + METADATA_COLUMNS
+        if self.chunk_size_bytes is not None:
+            column_names += [CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN]
+        append_to_journal = resume and path.isfile(checkpoint_path) and path.getsize(checkpoint_path) > 0
+        self.stream = open_hash_text_file(checkpoint_path, "a" if append_to_journal else "w")
+        # Use the same dialect as write_hashes_to_file() so the journal can be read back with read_hashes_from_files()
+        self.row_writer = writer(self.stream, delimiter="\t", quoting=QUOTE_NONNUMERIC, doublequote=False,
+                                 escapechar="\\", lineterminator="\n")
+        if not append_to_journal:
+            self.row_writer.writerow(column_names)
+            self.sync()
+
+    # Save one file to the journal. The arguments are the same as those of ScanAccumulator.append()
+    def record(self, relative_path, hex_hash, file_size_bytes, file_metadata, chunk_digests):
+        row = [relative_path, hex_hash, file_size_bytes, *file_metadata]
+        if self.chunk_size_bytes is not None:
+            row += [chunk_digests_to_hex(chunk_digests), self.chunk_size_bytes]
+        self.pending_rows.append(row)
+        if len(self.pending_rows) >= CHECKPOINT_BATCH_FILES or time() - self.last_write_time > self.interval_seconds:
+            self.write_batch()
+
+    # Append every pending row to the journal at once and wait for it to reach the disk
+    def write_batch(self):
+        self.row_writer.writerows(self.pending_rows)
+        self.sync()
+        self.rows_written += len(self.pending_rows)
+        self.logger.debug("Checkpointed {} files to {}, {} in total".format(len(self.pending_rows),
+                                                                            self.checkpoint_path, self.rows_written))
+        self.pending_rows = []
+        self.last_write_time = time()
+
+    # https://docs.python.org/3/library/os.html#os.fsync
+    def sync(self):
+        self.stream.flush()
+        fsync(self.stream.fileno())
+
+    # Write out any remaining rows and close the journal, which is kept until the scan's outputs have been written
+    def close(self):
+        if self.pending_rows:
+            self.write_batch()
+        self.stream.close()
+
+
+# Delete a checkpoint journal once the outputs it protected have been written, so a later --resume starts from scratch
+def remove_checkpoint_journal(checkpoint_path, logger):
+    if path.isfile(checkpoint_path):
+        remove(checkpoint_path)
+        logger.info("Removed checkpoint journal {} as the scan completed".format(checkpoint_path))
@@ -0,0 +1,110 @@
+# Used for computing the hash of each chunk of a file, and of the list of chunk digests
+# https://github.com/oconnor663/blake3-py
+from blake3 import blake3
+
+# Column holding the hex digest of every fixed-size chunk of a file, concatenated in file order. Files made of a single
+# chunk leave it empty, as their only chunk digest is the same as their chunk_hash
+CHUNK_DIGESTS_COLUMN = "chunk_digests"
+# Column holding the chunk size the chunk digests were computed with, as they can't be compared across chunk sizes
+CHUNK_SIZE_COLUMN = "chunk_size_bytes"
+DIGEST_BYTES = 32
+
+
+# Compute the hex hash of a file from the digests of its chunks. A file made of a single chunk uses that chunk's digest,
+# which makes its hash identical to its full_hash. Otherwise, the hash is the BLAKE3 hash of the chunk digests in order
+def compute_chunk_root(chunk_digests):
+    if len(chunk_digests) == DIGEST_BYTES:
+        return chunk_digests.hex()
+    return blake3(chunk_digests).hexdigest()
+
+
+# Return the amount of chunks a file of the given size is split into. Empty files still have one, empty, chunk
+def get_chunk_count(file_size_bytes, chunk_size_bytes):
+    return max(1, -(-file_size_bytes // chunk_size_bytes))
+
+
+# Convert the raw chunk digests of a file to the value stored in the chunk_digests column
+def chunk_digests_to_hex(chunk_digests):
+    if len(chunk_digests) == DIGEST_BYTES:
+        return ""
+    return chunk_digests.hex()
+
+
+# Convert the chunk_digests and chunk_hash columns of a file back to its raw chunk digests
+def hex_to_chunk_digests(chunk_digests_hex, chunk_hash):
+    if not chunk_digests_hex:
+        return bytes.fromhex(chunk_hash)
+    return bytes.fromhex(chunk_digests_hex)
+
+
+# Hash count bytes of an open file starting at offset, a read block at a time so large chunks don't have to fit in
+# memory, and return the raw digest
+def hash_chunk(read_engine, file_descriptor, offset, count):
+    blake3_hasher = read_engine.create_hasher(file_descriptor, count)
+    # Stops early if the file shrank while it was being read
+    read_engine.hash_range(file_descriptor, blake3_hasher, offset, count)
+    return blake3_hasher.digest()
+
+
+# Return the chunk index to start hashing a file from, given the size and chunk digests it had in a previous scan when
+# it is thought to only have been appended to. Chunks before the returned index are reused from the previous scan.
+# The chunk before the returned index, which is the last chunk that was full last time, is reread and must still match
+# its previous digest, which catches files that were rewritten rather than appended to
+def get_append_start_chunk(read_engine, file_descriptor, previous_file_size_bytes, previous_chunk_digests,
+                           chunk_size_bytes):
+    full_chunk_count = previous_file_size_bytes // chunk_size_bytes
+    if full_chunk_count == 0 or len(previous_chunk_digests) < full_chunk_count * DIGEST_BYTES:
+        return 0
+    boundary_chunk_index = full_chunk_count - 1
+    previous_boundary_digest = previous_chunk_digests[boundary_chunk_index * DIGEST_BYTES:
+                                                      full_chunk_count * DIGEST_BYTES]
+    if hash_chunk(read_engine, file_descriptor, boundary_chunk_index * chunk_size_bytes,
+                  chunk_size_bytes) != previous_boundary_digest:
+        return 0
+    return full_chunk_count
+
+
+# Split the file into chunks of chunk_size_bytes and hash each, reading with read_engine, returning a Tuple of
+# (chunk_hash, chunk_digests) where chunk_hash is computed by compute_chunk_root() and chunk_digests is the raw digests
+# of every chunk in order.
+# If the file was previously previous_file_size_bytes with previous_chunk_digests and is believed to have only been
+# appended to since, the chunks that were already full are reused after checking the last of them, and only the rest of
+# the file is read. Otherwise pass previous_chunk_digests as None
+def hash_file_chunks(absolute_path, file_size_bytes, chunk_size_bytes, read_engine, previous_file_size_bytes=0,
+                     previous_chunk_digests=None):
+    with read_engine.open(absolute_path) as file_descriptor:
+        start_chunk_index = 0
+        if previous_chunk_digests is not None:
+            start_chunk_index = get_append_start_chunk(read_engine, file_descriptor, previous_file_size_bytes,
+                                                       previous_chunk_digests, chunk_size_bytes)
+        chunk_digests = bytearray(previous_chunk_digests[:start_chunk_index * DIGEST_BYTES] if start_chunk_index
+                                  else b"")
+        for chunk_index in range(start_chunk_index, get_chunk_count(file_size_bytes, chunk_size_bytes)):
+            chunk_digests += hash_chunk(read_engine, file_descriptor, chunk_index * chunk_size_bytes,
+                                        chunk_size_bytes)
+    chunk_digests = bytes(chunk_digests)
+    return compute_chunk_root(chunk_digests), chunk_digests
+
+
+# Describe the byte ranges that differ between two versions of a file as a comma separated list of inclusive ranges,
+# such as 0-67108863,134217728-150000000. Chunks are compared by index, and any chunks only one version has are part of
+# the difference. If the chunk sizes differ, nothing can be compared and the whole file is described as changed
+def describe_changed_byte_ranges(previous_chunk_digests, previous_file_size_bytes, previous_chunk_size_bytes,
+                                 chunk_digests, file_size_bytes, chunk_size_bytes):
+    largest_file_size_bytes = max(previous_file_size_bytes, file_size_bytes)
+    if previous_chunk_size_bytes != chunk_size_bytes:
+        return "0-{}".format(max(largest_file_size_bytes - 1, 0))
+    chunk_count = max(len(previous_chunk_digests), len(chunk_digests)) // DIGEST_BYTES
+    changed_ranges = []
+    for chunk_index in range(chunk_count):
+        digest_slice = slice(chunk_index * DIGEST_BYTES, (chunk_index + 1) * DIGEST_BYTES)
+        if previous_chunk_digests[digest_slice] == chunk_digests[digest_slice]:
+            continue
+        range_start = chunk_index * chunk_size_bytes
+        range_end = min((chunk_index + 1) * chunk_size_bytes, largest_file_size_bytes) - 1
+        # Merge with the previous range when the chunks are next to each other
+        if changed_ranges and changed_ranges[-1][1] == range_start - 1:
+            changed_ranges[-1][1] = range_end
+        else:
+            changed_ranges.append([range_start, max(range_end, range_start)])
+    return ",".join("{}-{}".format(range_start, range_end) for range_start, range_end in changed_ranges)
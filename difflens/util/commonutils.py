@@ -1,6 +1,16 @@
 # Used to construct or modify file paths and to find this Process ID
 from os import path, sep
 
+# Placeholder in output paths that is replaced by the directory name of each scan root, such as disk1 for /mnt/disk1
+ROOT_NAME_PLACEHOLDER = "{root_name}"
+
+
+# Substitute the name of a scan root into an output path such as /boot/logs/{root_name}-hashes.tsv.gz
+def format_root_path(path_template, root_name):
+    if path_template is None:
+        return None
+    return path_template.replace(ROOT_NAME_PLACEHOLDER, root_name)
+
 
 def resolve_absolute_path(path_to_process, logger):
     # Check if the input is a relative or absolute path
@@ -5,3 +5,5 @@ class CompareMode(Enum):
     PARTIAL = "partial-hash"
     FULL = "full-hash"
     SIZE = "file-size"
+    CHUNK = "chunk-hash"
+    ROLLING = "rolling-scrub"
@@ -1,3 +1,28 @@
+# Used to pick each file's change type from several conditions at once
+import numpy
+# Used to create or combine DataFrames, and to recognize categorical columns
+from pandas import CategoricalDtype, DataFrame, concat
+
+from .chunkhash import CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN, describe_changed_byte_ranges, hex_to_chunk_digests
+
+# Columns compared by classify_changes()
+CHANGE_COLUMNS = ["relative_path", "hash", "file_size_bytes"]
+# Values of the change_type column added by classify_changes()
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+UNCHANGED = "unchanged"
+
+
+# Return a column that can be compared with, or filled in from, a column of another data frame. Categorical columns, as
+# read_hashes_from_files() can produce, only allow that when both have the same categories, so they're turned back into
+# plain values. Other columns are returned as they are
+def get_comparable_column(column):
+    if isinstance(column.dtype, CategoricalDtype):
+        return column.astype(column.cat.categories.dtype)
+    return column
+
+
 # Return a list of files that existed in the original data frame but not in the comparison data frame
 # Run determine_removed_files(old, new) to find removed files and determine_removed_files(new, old) to find added files
 def determine_removed_files(original_data_frame, comparison_data_frame):
@@ -30,7 +55,8 @@ def determine_modified_files(original_data_frame, comparison_data_frame):
     analysis_data_frame = original_data_frame.merge(comparison_data_frame, how="inner", on="relative_path",
                                                     validate="one_to_one")
     # Next, filter the data_frame to only contain rows where the original and comparison hash differ
-    filtered_data_frame = analysis_data_frame[analysis_data_frame["hash_x"] != analysis_data_frame["hash_y"]]
+    filtered_data_frame = analysis_data_frame[get_comparable_column(analysis_data_frame["hash_x"])
+                                              != get_comparable_column(analysis_data_frame["hash_y"])]
     # Reduce the filtered data frame to only the fields returned by this: filename
     # https://www.analyseup.com/python-data-science-reference/pandas-selecting-dropping-and-renaming-columns.html
     # Single-column DataFrames are automatically converted to Series, so convert it back
@@ -53,3 +79,145 @@ def determine_duplicate_files(data_frame, duplicate_field, output_schema):
     # Reduce the data_frame to only the fields returned by this: hash, filename, and file size
     reduced_data_frame = filtered_data_frame[output_schema]
     return reduced_data_frame
+
+
+# Return True if both data_frames hold the same relative paths in the same order with the same hashes and sizes, which
+# proves classify_changes() would find every file unchanged. Comparing the columns row by row is much cheaper than the
+# join classify_changes() does, and hash files are written sorted by relative path, so two scans of a disk where nothing
+# changed line up exactly
+def have_same_files(original_data_frame, comparison_data_frame):
+    if len(original_data_frame.index) != len(comparison_data_frame.index):
+        return False
+    # https://numpy.org/doc/stable/reference/generated/numpy.array_equal.html
+    return all(numpy.array_equal(get_comparable_column(original_data_frame[column_name]).to_numpy(),
+                                 get_comparable_column(comparison_data_frame[column_name]).to_numpy())
+               for column_name in CHANGE_COLUMNS)
+
+
+# Label each relative path in either the original or the comparison data_frame as added, removed, modified, or unchanged
+# using a single outer join. Returns a data_frame with columns relative_path, hash, file_size_bytes, and change_type,
+# where hash and file_size_bytes come from the original unless the file was removed. Equivalent to running
+# determine_removed_files() both ways plus determine_modified_files(), with one merge instead of three
+def classify_changes(original_data_frame, comparison_data_frame):
+    # indicator=True adds a _merge column saying whether each row came from the left, the right, or both
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.merge.html
+    analysis_data_frame = original_data_frame[CHANGE_COLUMNS].merge(
+        comparison_data_frame[CHANGE_COLUMNS], how="outer", on="relative_path", suffixes=("", "_comparison"),
+        validate="one_to_one", indicator=True)
+    original_hashes = get_comparable_column(analysis_data_frame["hash"])
+    comparison_hashes = get_comparable_column(analysis_data_frame["hash_comparison"])
+    added_rows = analysis_data_frame["_merge"] == "left_only"
+    removed_rows = analysis_data_frame["_merge"] == "right_only"
+    modified_rows = (analysis_data_frame["_merge"] == "both") & (original_hashes != comparison_hashes)
+    # https://numpy.org/doc/stable/reference/generated/numpy.select.html
+    change_types = numpy.select([added_rows, removed_rows, modified_rows], [ADDED, REMOVED, MODIFIED], UNCHANGED)
+    # Removed files only have the hash and size from the comparison, which the outer join left as NaN in the original
+    # columns. Fill them in so the sizes can go back to being integers
+    hashes = original_hashes.where(~removed_rows, comparison_hashes)
+    file_sizes = analysis_data_frame["file_size_bytes"].fillna(analysis_data_frame["file_size_bytes_comparison"])
+    return DataFrame({"relative_path": analysis_data_frame["relative_path"], "hash": hashes,
+                      "file_size_bytes": file_sizes.astype("int64"), "change_type": change_types})
+
+
+# Pair up removed and added rows sharing the values of join_columns, numbering each row within its group so the Nth
+# removed row pairs with the Nth added row. Returns a data_frame with columns previous_relative_path, relative_path, and
+# join_columns
+def pair_removed_and_added(removed_data_frame, added_data_frame, join_columns):
+    # https://pandas.pydata.org/docs/reference/api/pandas.core.groupby.DataFrameGroupBy.cumcount.html
+    removed_data_frame = removed_data_frame.assign(occurrence=removed_data_frame.groupby(join_columns).cumcount())
+    added_data_frame = added_data_frame.assign(occurrence=added_data_frame.groupby(join_columns).cumcount())
+    paired_data_frame = removed_data_frame.merge(added_data_frame, how="inner", on=join_columns + ["occurrence"],
+                                                 suffixes=("_previous", ""))
+    paired_data_frame = paired_data_frame.rename(columns={"relative_path_previous": "previous_relative_path"})
+    return paired_data_frame[["previous_relative_path", "relative_path"] + join_columns]
+
+
+# Pair up the removed and added rows of a classify_changes() data_frame that share a hash and size, which are files that
+# were moved or renamed. Files keeping their name are paired first, so moving a folder that contains a copy of another
+# file doesn't pair the copy with the wrong original. Any other removed and added files sharing a hash and size are then
+# paired in order until either side runs out, and the rest stay removed or added. Returns a data_frame with columns
+# previous_relative_path, relative_path, hash, and file_size_bytes
+def determine_moved_files(changes_data_frame):
+    removed_data_frame = changes_data_frame[changes_data_frame["change_type"] == REMOVED][CHANGE_COLUMNS]
+    added_data_frame = changes_data_frame[changes_data_frame["change_type"] == ADDED][CHANGE_COLUMNS]
+    # Nothing can be paired without both removed and added files, and an empty column can't be split into file names
+    if removed_data_frame.empty or added_data_frame.empty:
+        return DataFrame(columns=["previous_relative_path"] + CHANGE_COLUMNS)
+    # The file name is whatever follows the last slash of the relative path
+    # https://pandas.pydata.org/docs/reference/api/pandas.Series.str.rpartition.html
+    removed_data_frame = removed_data_frame.assign(file_name=removed_data_frame["relative_path"].str.rpartition("/")[2])
+    added_data_frame = added_data_frame.assign(file_name=added_data_frame["relative_path"].str.rpartition("/")[2])
+    same_name_data_frame = pair_removed_and_added(removed_data_frame, added_data_frame,
+                                                  ["hash", "file_size_bytes", "file_name"])
+    removed_data_frame = removed_data_frame[
+        ~removed_data_frame["relative_path"].isin(same_name_data_frame["previous_relative_path"])]
+    added_data_frame = added_data_frame[~added_data_frame["relative_path"].isin(same_name_data_frame["relative_path"])]
+    renamed_data_frame = pair_removed_and_added(removed_data_frame, added_data_frame, ["hash", "file_size_bytes"])
+    return concat([same_name_data_frame.drop(columns="file_name"), renamed_data_frame], ignore_index=True)
+
+
+# Add a changed_byte_ranges column to a data_frame of modified relative paths, describing which byte ranges of each file
+# differ between the original and the comparison based on their chunk digests. The data_frame is returned unchanged if
+# either input lacks chunk digests, as only chunk-hash mode records them
+def determine_modified_byte_ranges(modified_data_frame, original_data_frame, comparison_data_frame):
+    chunk_columns = CHANGE_COLUMNS + [CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN]
+    if not all(column in data_frame.columns for column in chunk_columns
+               for data_frame in [original_data_frame, comparison_data_frame]):
+        return modified_data_frame
+    analysis_data_frame = modified_data_frame[["relative_path"]].merge(
+        original_data_frame[chunk_columns], how="inner", on="relative_path", validate="one_to_one").merge(
+        comparison_data_frame[chunk_columns], how="inner", on="relative_path", suffixes=("", "_comparison"),
+        validate="one_to_one")
+    changed_byte_ranges = [
+        describe_changed_byte_ranges(hex_to_chunk_digests(previous_chunk_digests_hex, previous_hash),
+                                     int(previous_file_size_bytes), int(previous_chunk_size_bytes),
+                                     hex_to_chunk_digests(chunk_digests_hex, current_hash), int(file_size_bytes),
+                                     int(chunk_size_bytes))
+        for previous_chunk_digests_hex, previous_hash, previous_file_size_bytes, previous_chunk_size_bytes,
+        chunk_digests_hex, current_hash, file_size_bytes, chunk_size_bytes in zip(
+            analysis_data_frame[CHUNK_DIGESTS_COLUMN + "_comparison"], analysis_data_frame["hash_comparison"],
+            analysis_data_frame["file_size_bytes_comparison"], analysis_data_frame[CHUNK_SIZE_COLUMN + "_comparison"],
+            analysis_data_frame[CHUNK_DIGESTS_COLUMN], analysis_data_frame["hash"],
+            analysis_data_frame["file_size_bytes"], analysis_data_frame[CHUNK_SIZE_COLUMN])]
+    return DataFrame({"relative_path": analysis_data_frame["relative_path"],
+                      "changed_byte_ranges": changed_byte_ranges})
+
+
+# Yield the rows of a row iterator sorted by relative path, raising a ValueError if a row is out of order or repeats the
+# relative path of the row before it, as the streaming comparison can't give correct results for such input
+def check_rows_sorted(rows, source_name, logger):
+    previous_relative_path = None
+    for row in rows:
+        if previous_relative_path is not None and row[0] <= previous_relative_path:
+            message = "{} is not sorted by unique relative path, as {} came after {}. Rewrite it with " \
+                      "difflens-convert to sort it".format(source_name, row[0], previous_relative_path)
+            logger.error(message)
+            raise ValueError(message)
+        previous_relative_path = row[0]
+        yield row
+
+
+# Compare two iterators of (relative_path, hash, file_size_bytes) rows, each sorted by relative path, in one linear pass
+# like a merge join. Rows only in the comparison are written to removed_writer, rows only in the original are written to
+# added_writer, and the relative paths in both with a different hash are written to modified_writer. Any writer may be
+# None to skip that output. Only the current row of each input is held in memory, so inputs of any size can be compared
+def determine_changes_streaming(original_rows, comparison_rows, removed_writer, added_writer, modified_writer):
+    original_row = next(original_rows, None)
+    comparison_row = next(comparison_rows, None)
+    while original_row is not None or comparison_row is not None:
+        if original_row is None or (comparison_row is not None and comparison_row[0] < original_row[0]):
+            # The comparison's relative path sorts before any remaining original path, so it is gone from the original
+            if removed_writer is not None:
+                removed_writer.write_row(comparison_row)
+            comparison_row = next(comparison_rows, None)
+        elif comparison_row is None or original_row[0] < comparison_row[0]:
+            # Likewise, the original's relative path was never in the comparison
+            if added_writer is not None:
+                added_writer.write_row(original_row)
+            original_row = next(original_rows, None)
+        else:
+            # Both inputs have the relative path, so it was modified if the hash changed
+            if modified_writer is not None and original_row[1] != comparison_row[1]:
+                modified_writer.write_row([original_row[0]])
+            original_row = next(original_rows, None)
+            comparison_row = next(comparison_rows, None)
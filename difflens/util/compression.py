@@ -0,0 +1,153 @@
+# Used to compress and decompress with the codecs in the standard library
+import bz2
+import gzip
+import lzma
+import zlib
+# Used to keep compressed gzip blocks in the order they were written
+from collections import deque
+# Used to compress blocks of gzip output on several threads at once
+# https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+from concurrent.futures import ThreadPoolExecutor
+# Used to look for the optional compression packages without importing them
+from importlib.util import find_spec
+# Used to give the parallel gzip writer the interface of a binary file, and to write text to compressed files
+from io import BufferedIOBase, TextIOWrapper
+
+# Whether the optional zstandard and lz4 packages are installed, which provide the zstd and lz4 codecs
+# https://python-zstandard.readthedocs.io/en/latest/
+# https://python-lz4.readthedocs.io/en/stable/lz4.frame.html
+ZSTANDARD_AVAILABLE = find_spec("zstandard") is not None
+LZ4_AVAILABLE = find_spec("lz4") is not None
+# Codecs that hash files can be compressed with, picked by the extension of the file's path. Each is a Dict of:
+# - name: what the codec is called in logs, and by pandas if it can read the codec on its own
+# - levels: the compression levels the codec accepts, from fastest to smallest
+# - default_level: the level used if none is given, which is what the codec's own open() uses
+# - package: the optional package providing the codec, or None if it's in the standard library
+# - available: whether the codec can be used
+# - pandas: whether read_csv() recognizes the extension, otherwise the file is opened for it
+# - threads: whether the codec can compress with several threads
+COMPRESSION_CODECS = {
+    ".gz": {"name": "gzip", "levels": range(0, 10), "default_level": 9, "package": None, "available": True,
+            "pandas": True, "threads": True},
+    ".bz2": {"name": "bz2", "levels": range(1, 10), "default_level": 9, "package": None, "available": True,
+             "pandas": True, "threads": False},
+    ".xz": {"name": "xz", "levels": range(0, 10), "default_level": 6, "package": None, "available": True,
+            "pandas": True, "threads": False},
+    ".zst": {"name": "zstd", "levels": range(-7, 23), "default_level": 3, "package": "zstandard",
+             "available": ZSTANDARD_AVAILABLE, "pandas": True, "threads": True},
+    ".lz4": {"name": "lz4", "levels": range(0, 17), "default_level": 0, "package": "lz4", "available": LZ4_AVAILABLE,
+             "pandas": False, "threads": False}}
+# Bytes of uncompressed output each thread of the parallel gzip writer compresses at a time, as its own gzip member
+PARALLEL_GZIP_BLOCK_BYTES = 4 * 2 ** 20
+# zlib window bits that produce a gzip header and trailer around the compressed data
+# https://docs.python.org/3/library/zlib.html#zlib.compressobj
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+# Return the Dict describing the codec a file is compressed with based on its extension, or None if it's uncompressed
+def get_compression_codec(file_path):
+    for extension, codec in COMPRESSION_CODECS.items():
+        if file_path.endswith(extension):
+            return codec
+    return None
+
+
+# Compress one block into a complete gzip member. zlib releases the GIL while it compresses, so several of these can
+# run on different threads at once
+def compress_gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+# Writes a gzip file by splitting what's written to it into blocks and compressing each on a thread pool as its own gzip
+# member. gunzip, gzip.open(), and pandas read a file of several members as if it were one, so the output stays
+# compatible with them while compressing at close to threads times the speed of a single stream. Members are written in
+# order, and at most twice as many blocks as threads are held in memory at once
+class ParallelGzipWriter(BufferedIOBase):
+    def __init__(self, file_path, level, threads, block_bytes=PARALLEL_GZIP_BLOCK_BYTES):
+        super().__init__()
+        self.stream = open(file_path, "wb")
+        self.level = level
+        self.block_bytes = block_bytes
+        self.max_pending_blocks = threads * 2
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ParallelGzip")
+        self.pending_blocks = deque()
+        self.buffer = bytearray()
+        self.blocks_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_bytes:
+            self.submit_block(bytes(self.buffer[:self.block_bytes]))
+            del self.buffer[:self.block_bytes]
+        return len(data)
+
+    # Hand a block to the thread pool, first writing out finished blocks if too many are waiting
+    def submit_block(self, block):
+        while len(self.pending_blocks) >= self.max_pending_blocks:
+            self.write_next_block()
+        self.pending_blocks.append(self.executor.submit(compress_gzip_member, block, self.level))
+
+    def write_next_block(self):
+        self.stream.write(self.pending_blocks.popleft().result())
+        self.blocks_written += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An empty file still gets one member, so it's a valid gzip file
+            if self.buffer or self.blocks_written + len(self.pending_blocks) == 0:
+                self.submit_block(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending_blocks:
+                self.write_next_block()
+        finally:
+            self.executor.shutdown()
+            self.stream.close()
+            super().close()
+
+
+# Open file_path in binary mode "rb" or "wb", decompressing or compressing it with the codec its extension names. level
+# and threads only apply when writing. level defaults to the codec's default, and threads over 1 compress in parallel
+# for codecs that support it
+def open_compressed_file(file_path, mode, level=None, threads=1):
+    codec = get_compression_codec(file_path)
+    if codec is None:
+        return open(file_path, mode)
+    if not codec["available"]:
+        raise ValueError("Reading or writing {} requires the {} package, install it with `pip3 install {}`".format(
+            file_path, codec["package"], codec["package"]))
+    if level is None:
+        level = codec["default_level"]
+    writing = mode != "rb"
+    if codec["name"] == "gzip":
+        if writing and threads > 1:
+            return ParallelGzipWriter(file_path, level, threads)
+        return gzip.open(file_path, mode, compresslevel=level)
+    if codec["name"] == "bz2":
+        return bz2.open(file_path, mode, compresslevel=level)
+    if codec["name"] == "xz":
+        return lzma.open(file_path, mode, preset=level if writing else None)
+    if codec["name"] == "zstd":
+        import zstandard
+        # zstd splits the input between its own worker threads, where 0 means compressing on the calling thread
+        # https://python-zstandard.readthedocs.io/en/latest/compressor.html
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        return zstandard.open(file_path, mode, cctx=compressor if writing else None)
+    import lz4.frame
+    return lz4.frame.open(file_path, mode, compression_level=level)
+
+
+# Open file_path in text mode "r", "w", or "a" the way hash files are read and written, as UTF-8 with undecodable bytes
+# kept as surrogates. Compressed files can only be read or written, not appended to
+def open_compressed_text_file(file_path, mode, level=None, threads=1):
+    # newline="" lets the csv module handle line endings, including any inside quoted fields
+    # https://docs.python.org/3/library/csv.html#id4
+    if get_compression_codec(file_path) is None:
+        return open(file_path, mode, encoding="utf-8", errors="surrogateescape", newline="")
+    return TextIOWrapper(open_compressed_file(file_path, mode + "b", level, threads), encoding="utf-8",
+                         errors="surrogateescape", newline="")
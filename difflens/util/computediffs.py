@@ -1,20 +1,29 @@
-# Used to construct paths or traverse directory trees
-from os import path, walk
+# Used to queue up files being hashed by worker threads
+from collections import deque
+# Used to find the device the scanned directory is on
+from os import stat
 # Used to track time spent, which allows calculation of processing rates and log intervals
 from time import time
 
-# Used for computing the hash of a file on disk
-# https://github.com/oconnor663/blake3-py
-from blake3 import blake3
 # Used to create DataFrames
 from pandas import DataFrame
 
+from .carryforward import METADATA_COLUMNS
+from .chunkhash import hash_file_chunks
 from .commonutils import sanitize_and_validate_directory_path
 from .compareMode import CompareMode
+from .directorywalker import walk_directory
+from .metrics import ScanMetrics
+from .readOrder import ReadOrder
+from .readengine import ReadEngine
+from .readscheduler import schedule_file_entries
+from .scanaccumulator import NOT_COMPUTED, ScanAccumulator
 
 
-# Helper to log the progress made during hashing
-def log_current_progress(logger, start_time, current_time, bytes_read, files_seen, directories_seen):
+# Helper to log the progress made during hashing. throttled_seconds is how long reads were deliberately held back, or
+# None if reads aren't throttled
+def log_current_progress(logger, start_time, current_time, bytes_read, files_seen, directories_seen,
+                         throttled_seconds=None):
     # Calculate stats
     run_time_seconds = current_time - start_time
     run_time_minutes = run_time_seconds / 60
@@ -35,11 +44,18 @@ def log_current_progress(logger, start_time, current_time, bytes_read, files_see
         file_processing_rate = files_seen / run_time_minutes
         file_processing_unit = "minute"
 
+    # Tell a slow disk apart from one deliberately read slowly by reporting the time spent throttled in the same unit
+    throttled_message = ""
+    if throttled_seconds is not None:
+        throttled_time = throttled_seconds / 60 if time_unit == "minutes" else throttled_seconds
+        throttled_message = ", with reads throttled for {:.2f} {}".format(throttled_time, time_unit)
+
     # Print the variable-unit log line
     logger.info(
         "{:.1f}MB of data read from disk across {} directories & {} files in {:.2f} {} at {:.0f}MBps, "
-        "or {:.0f} files per {}".format(bytes_read_mb, directories_seen, files_seen, file_processing_time, time_unit,
-                                        processed_mb_per_second, file_processing_rate, file_processing_unit))
+        "or {:.0f} files per {}{}".format(bytes_read_mb, directories_seen, files_seen, file_processing_time, time_unit,
+                                          processed_mb_per_second, file_processing_rate, file_processing_unit,
+                                          throttled_message))
 
 
 # Helper to handle creating or updating a list stored in a dict
@@ -51,82 +67,107 @@ def add_or_update_dict_list(dict_to_update, dict_key, string_to_store):
     return dict_to_update
 
 
-# Inputs are a BLAKE3 hasher already loaded with the first N bytes of a file stream, the remaining bytes of the file
-# stream, the dict to update with the hash output, and the relative path to store in the dict. Compute the
-# hexadecimal hash by reading blocks at a time, to avoid exhausting memory. Then store it in the dict with
-# {key:full_hash, value:list_of_relative_paths} and then return the updated dict.
-def update_full_hash_dict(dict_to_update, relative_path, stream, blake3_hasher):
-    # Bytes to read in at a time, 2^20 = 1MB
-    # TODO this value was chosen out of a hat. Do performance testing to find the best value
-    read_block_size = 2 ** 20
-    # Read in chunks to avoid MemoryError exceptions when the full file doesn't fit in memory
-    # https://stackoverflow.com/questions/1131220
-    while True:
-        data = stream.read(read_block_size)
-        # Exit the while loop only when there is no more data to read
-        if not data:
-            break
-        # Update the hash with the new non-None data
-        blake3_hasher.update(data)
+# Inputs are a BLAKE3 hasher already loaded with the first start_offset bytes of an open file and the ReadEngine that
+# opened it. Compute the hexadecimal hash by hashing the rest of the file a block at a time, to avoid exhausting memory,
+# and return it
+def compute_full_hash(read_engine, file_descriptor, blake3_hasher, start_offset):
+    read_engine.hash_range(file_descriptor, blake3_hasher, start_offset)
     # Get the hexadecimal 64-character representation of the hash's final state
-    hex_hash_string = blake3_hasher.hexdigest()
-
-    # Save the hash and RELATIVE path to the dict, creating a new list if one didn't exist before
-    dict_to_update = add_or_update_dict_list(dict_to_update, hex_hash_string, relative_path)
-    # Return the updated dict to the caller
-    return dict_to_update
+    return blake3_hasher.hexdigest()
 
 
-# Provided with a starting dict, an absolute and path of a file, its size in bytes, and the amount of bytes to read,
-# read the first N bytes from the file to compute the BLAKE3 hash of those bytes. Then determine if the entire file
-# was read, or if more remains. Save the result to the dict, where the key is a Tuple of (partial hash,
-# file_size_less_than_bytes_to_read?) and the value is either:
-# 1. a nested dict of {key:full_hash, value:list_of_relative_paths} updated by a full_hash helper
-# 2. a list of relative paths of the files sharing the same partial hash that ALSO is under the hash threshold
-# NOTE: The split value structure is in hopes of reducing dict memory footprint
-def update_partial_dict(dict_to_update, absolute_path, relative_path, file_size_bytes, byte_count_to_hash,
-                        compare_mode):
-    # Open the file in read-only, binary format
-    # NOTE: ALL processing occurs while the file is open, as the file stream can be passed to a helper for full hashing
-    # https://stackabuse.com/file-handling-in-python/
-    with open(absolute_path, "rb") as stream:
-        # Initialize the hasher used for partial hashing and CONTINUE using for full hashing
-        blake3_hasher = blake3()
+# Provided with the absolute path of a file, its size in bytes, and the amount of bytes to read, read the first N bytes
+# from the file to compute the BLAKE3 hash of those bytes. Then determine if the entire file was read, or if more
+# remains and the compare_mode asks for the full hash. Return a Tuple of (partial_hash, file_fully_hashed, full_hash)
+# where full_hash is None if it was not computed. Files are read with read_engine
+def hash_file(absolute_path, file_size_bytes, byte_count_to_hash, compare_mode, read_engine):
+    # Open the file in read-only mode
+    # NOTE: ALL processing occurs while the file is open, as the file can be passed to a helper for full hashing
+    with read_engine.open(absolute_path) as file_descriptor:
+        # Initialize the hasher used for partial hashing and CONTINUE using for full hashing. Large files may get one
+        # that hashes with several threads
+        blake3_hasher = read_engine.create_hasher(file_descriptor, file_size_bytes)
         # Update the hasher with the first N bytes of the file
-        # NOTE: If a file is 100 bytes, f.read(100) will read the entire file.
-        blake3_hasher.update(stream.read(byte_count_to_hash))
+        # NOTE: If a file is 100 bytes, hashing the first 1000000 bytes will hash the entire file.
+        read_engine.hash_range(file_descriptor, blake3_hasher, 0, byte_count_to_hash)
         # Get the hexadecimal 64-character representation of the hash
-        hex_hash_string = blake3_hasher.hexdigest()
+        partial_hash = blake3_hasher.hexdigest()
 
         # Boolean on if the file was smaller than the read buffer. If True, the file was read in its entirety.
         file_fully_hashed = file_size_bytes <= byte_count_to_hash
-        # Make the dictKey a Tuple with schema (string:partial hash, bool:file_size_less_than_bytes_to_read?)
-        dict_key = (hex_hash_string, file_fully_hashed)
+        # Given the proper compare_mode, proceed with hashing the full file
+        full_hash = None
+        if not file_fully_hashed and compare_mode == CompareMode.FULL.value:
+            full_hash = compute_full_hash(read_engine, file_descriptor, blake3_hasher, byte_count_to_hash)
+        return partial_hash, file_fully_hashed, full_hash
 
-        if file_fully_hashed:
-            # The full file was read if file_fully_hashed=True. No more hashing necessary, store in a list at this level
-            dict_to_update = add_or_update_dict_list(dict_to_update, dict_key, relative_path)
-        else:
-            # Given the proper compare_mode, proceed with hashing the full file
-            if compare_mode == CompareMode.FULL.value:
-                if dict_key not in dict_to_update:
-                    dict_to_update[dict_key] = update_full_hash_dict({}, relative_path, stream, blake3_hasher)
-                else:
-                    dict_to_update[dict_key] = update_full_hash_dict(dict_to_update[dict_key], relative_path, stream,
-                                                                     blake3_hasher)
-            else:
-                # Otherwise, finish processing this file by adding its partial hash and name to the dict
-                dict_to_update = add_or_update_dict_list(dict_to_update, hex_hash_string, relative_path)
-        # Return the updated dict to the caller
-        return dict_to_update
+
+# Hash a file the way compare_mode asks for, returning a Tuple of (file_hash, chunk_digests) to store. In chunk-hash
+# mode, previous_chunks is the (previous_file_size_bytes, previous_chunk_digests) of a file that may have only been
+# appended to, or None. Otherwise, the hash is the full hash if one was computed, else the partial hash, which is final
+# if it covered the whole file or the compare mode is PARTIAL, and chunk_digests is empty
+def hash_file_for_storage(absolute_path, file_size_bytes, byte_count_to_hash, compare_mode, chunk_size_bytes,
+                          previous_chunks, read_engine):
+    if compare_mode == CompareMode.CHUNK.value:
+        previous_file_size_bytes, previous_chunk_digests = previous_chunks or (0, None)
+        return hash_file_chunks(absolute_path, file_size_bytes, chunk_size_bytes, read_engine,
+                                previous_file_size_bytes, previous_chunk_digests)
+    partial_hash, file_fully_hashed, full_hash = hash_file(absolute_path, file_size_bytes, byte_count_to_hash,
+                                                           compare_mode, read_engine)
+    return full_hash or partial_hash, b""
+
+
+# Save the output of hash_file_for_storage() to the accumulator, first checking it against the carried-forward hash if
+# the file was picked for verification
+def store_file_hashes(scan_accumulator, relative_path, file_size_bytes, file_metadata, file_hashes, carry_forward):
+    file_hash, chunk_digests = file_hashes
+    if carry_forward is not None:
+        carry_forward.check_verified_hash(relative_path, file_hash)
+    scan_accumulator.append(relative_path, file_hash, file_size_bytes, file_metadata, chunk_digests)
+    return scan_accumulator
+
+
+# Store the results of hashing that was handed off to a HashingEngine. Results are stored in the order the files were
+# submitted, so the accumulator ends up identical to one built by hashing serially. If wait_for_all is False, only the
+# results at the front of the queue that are already done are stored, plus however many are needed to get below
+# pending_limit. Files that disappeared before they could be hashed are counted as errors in metrics
+# Returns the amount of files whose hashes were stored
+def store_pending_hashes(pending_hashes, scan_accumulator, carry_forward, logger, pending_limit, wait_for_all,
+                         metrics):
+    files_stored = 0
+    while pending_hashes and (wait_for_all or len(pending_hashes) >= pending_limit or pending_hashes[0][0].done()):
+        future, absolute_file_path, relative_path, file_size_bytes, file_metadata = pending_hashes.popleft()
+        try:
+            # result() waits for the worker to finish and raises any exception the worker ran into
+            store_file_hashes(scan_accumulator, relative_path, file_size_bytes, file_metadata, future.result(),
+                              carry_forward)
+            files_stored += 1
+        except FileNotFoundError:
+            metrics.record_error(FileNotFoundError.__name__)
+            logger.error("File {} was in list but was not found. "
+                         "Perhaps it got deleted during scan? Skipping file.".format(absolute_file_path))
+    return files_stored
 
 
 # Entry point for hashing computation. Given a relative or absolute input path, find files it contains and determine
-# their size, partial and/or full hash, saving those values to a dict. Finally, return that dict
+# their size, partial and/or full hash, saving those values along with each file's modification time, inode, and device
+# to a ScanAccumulator. Finally, return the ScanAccumulator, whose to_data_frame() builds the DataFrame for analysis
 # If compare_mode is set to SIZE, only the file size has to match to be considered a duplicate
 # If compare_mode is set to PARTIAL, only the partial hash has to match to be considered a duplicate
+# If compare_mode is set to CHUNK, each chunk of chunk_size_bytes is hashed too, so changes can be located in the file
+# If carry_forward is provided, files whose metadata matches the previous scan reuse its hash rather than being read
+# If hashing_engine is provided, files are hashed on its worker threads rather than one at a time on this thread
+# If checkpoint_journal is provided, every file is also recorded to it as it's stored, so the scan can be resumed
+# Files are read with read_engine, which defaults to a ReadEngine with default settings, in the given read_order
+# Directories are listed by walk_workers threads if there's more than one, so files are stored in no particular order
+# If metrics is provided, the time taken to hash each file, errors, and progress are recorded to it
+# Relative paths start from relative_base, which defaults to the current working directory
+# If dirty_scan_plan is provided along with carry_forward, only the files it picks out are looked at rather than walking
+# the whole directory, and the files it carries forward are stored as they were
 def compute_diffs(input_path, logger, byte_count_to_hash, compare_mode, log_update_interval_seconds,
-                  log_update_interval_files, path_excluder):
+                  log_update_interval_files, path_excluder, carry_forward=None, hashing_engine=None,
+                  relative_base=None, chunk_size_bytes=None, checkpoint_journal=None, read_engine=None,
+                  read_order=ReadOrder.WALK.value, metrics=None, dirty_scan_plan=None, walk_workers=1):
     # Log the hashing state
     logger.debug("Comparing files using mode {}. "
                  "If partial hashing, using just the first {:.2f} MB".format(compare_mode,
@@ -134,137 +175,263 @@ def compute_diffs(input_path, logger, byte_count_to_hash, compare_mode, log_upda
     # Input directory that will be modified to be an absolute path without a trailing slash (how Python wants it)
     path_to_process = sanitize_and_validate_directory_path(input_path, logger)
 
-    # Create the top-level dict in which duplicates are stored. Dict keys at this level are file sizes in bytes
-    file_duplicates_dict = {}
+    if read_engine is None:
+        read_engine = ReadEngine()
+    if metrics is None:
+        metrics = ScanMetrics(None, float("inf"), logger)
+    # Reads are throttled per device, and progress is reported for the device the scanned directory is on
+    root_device = stat(path_to_process).st_dev
+    # Create the column buffers every file's path, hash, size, and metadata are appended to
+    scan_accumulator = ScanAccumulator(not compare_mode == CompareMode.SIZE.value,
+                                       chunk_size_bytes if compare_mode == CompareMode.CHUNK.value else None,
+                                       checkpoint_journal)
     # Initialize counters
     files_seen = last_files_seen = directories_seen = bytes_read = bytes_total = 0
     # https://www.tutorialspoint.com/python/time_time.htm
     start_time = last_logger_time = time()
+    # Queue of (Future, absolute_path, relative_path, file_size_bytes, file_metadata) for files handed off to the
+    # hashing_engine
+    # https://docs.python.org/3/library/collections.html#collections.deque
+    pending_hashes = deque()
 
-    # https://stackoverflow.com/questions/53123867
-    # Process top-down. Adding topdown=False to the walk() arguments would read from the deepest structure upwards
-    # abs_dir_path will update to the directory we're currently scanning. It is an absolute path
-    # sub_dirs is a list of subdirectories in the current abs_dir_path
-    # files is a list of file names in the current abs_dir_path
-    for abs_dir_path, sub_dirs, files in walk(path_to_process):
-
-        # If excluded, clear out the current dir's subdirectory and file lists in place and continue the loop early
-        # NOTE: relative paths will never start with . unless . is the current directory
-        # NOTE: relative paths will never end with /
-        rel_dir_path = path.relpath(abs_dir_path)
-        if path_excluder.is_excluded_dir(rel_dir_path):
-            for subdir in sub_dirs:
-                sub_dirs.remove(subdir)
-            for file in files:
-                files.remove(file)
-            continue
-        # Iterate through filenames that are immediate children in the current abs_dir_path
-        for file in files:
-            # If the current file's extension was excluded, continue the file loop early
-            if path_excluder.has_excluded_extension(file):
-                continue
+    if dirty_scan_plan is None:
+        # Iterate through each directory that wasn't excluded, along with the files in it that weren't excluded. With a
+        # read_order other than walk, every directory is listed first and all their files come back in one sorted batch
+        # Directories listed by walk workers are only ever handed to this thread, so the progress counters stay
+        # accurate however many threads are walking
+        file_entry_batches = schedule_file_entries(path_to_process, path_excluder, relative_base, logger, read_order,
+                                                   walk_workers)
+    else:
+        # Store the files that haven't changed since the last scan without looking at them, then iterate through the
+        # files that may have changed the same way as a walk's
+        for relative_path in dirty_scan_plan.carried_paths:
+            carried_hash, file_size_bytes, file_metadata = carry_forward.get_unchanged_row(relative_path)
+            carried_chunk_digests = b""
+            if compare_mode == CompareMode.CHUNK.value:
+                carried_chunk_digests = carry_forward.get_carried_chunk_digests(relative_path, carried_hash)
+            scan_accumulator.append(relative_path, carried_hash, file_size_bytes, file_metadata, carried_chunk_digests)
+            bytes_total += file_size_bytes
+        file_entry_batches = dirty_scan_plan.schedule_file_entries(carry_forward)
+    for directory_count, file_entries in file_entry_batches:
+        # Count the directories whose files are being processed
+        directories_seen += directory_count
+        # Iterate through the files of the batch. The walker has already constructed their absolute path, the
+        # relative path that will be stored, and their os.stat_result
+        for absolute_file_path, input_file_path, file_stat in file_entries:
             # Log an update if enough files have been seen since the last update, or if the time interval was reached
             current_time = time()
             if (current_time - last_logger_time) > log_update_interval_seconds or \
                     (files_seen - last_files_seen) > log_update_interval_files:
-                log_current_progress(logger, start_time, current_time, bytes_read, files_seen, directories_seen)
+                log_current_progress(logger, start_time, current_time, bytes_read, files_seen, directories_seen,
+                                     read_engine.get_throttled_seconds(root_device))
+                metrics.update_progress(files_seen, directories_seen, bytes_read)
                 last_logger_time = current_time
                 last_files_seen = files_seen
 
-            # Construct the absolute path used to access the file
-            absolute_file_path = path.join(abs_dir_path, file)
-
             # Wrap the rest of the for loop in a try/catch to handle FileNotFoundError. This is if the file disappears
             # partway through the scan of the directory.
             try:
-                # Skip symbolic link access to avoid accessing broken symlinks causing FileNotFoundError exceptions
-                if path.islink(absolute_file_path):
-                    logger.warn("Found a symbolic link at path {}, skipping".format(absolute_file_path))
-                    continue
-                # Construct the relative path based on user input that will be stored in the dict
-                # https://stackoverflow.com/questions/1192978
-                input_file_path = path.relpath(absolute_file_path)
-                # Get the size of the file, in Bytes
-                # https://stackoverflow.com/questions/6591931
-                file_size_bytes = path.getsize(absolute_file_path)
+                file_size_bytes = file_stat.st_size
+                file_metadata = (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev)
                 bytes_total += file_size_bytes
+                # Look for a hash from the previous scan that can be reused without reading the file
+                carried_hash = None
+                if carry_forward is not None and not compare_mode == CompareMode.SIZE.value:
+                    carried_hash = carry_forward.get_carried_hash(input_file_path, file_size_bytes,
+                                                                  file_stat.st_mtime_ns, file_stat.st_ino,
+                                                                  file_stat.st_dev)
+                if carried_hash is not None:
+                    carried_chunk_digests = b""
+                    if compare_mode == CompareMode.CHUNK.value:
+                        carried_chunk_digests = carry_forward.get_carried_chunk_digests(input_file_path, carried_hash)
+                    scan_accumulator.append(input_file_path, carried_hash, file_size_bytes, file_metadata,
+                                            carried_chunk_digests)
                 # Proceed with partial or full hashing if we are not in SIZE mode
-                if not compare_mode == CompareMode.SIZE.value:
+                elif not compare_mode == CompareMode.SIZE.value:
+                    # Files that grew in place may only need their appended chunks read in chunk-hash mode
+                    previous_chunks = None
+                    if carry_forward is not None and compare_mode == CompareMode.CHUNK.value:
+                        previous_chunks = carry_forward.get_appended_file_chunks(
+                            input_file_path, file_size_bytes, file_stat.st_ino, file_stat.st_dev, chunk_size_bytes)
                     # Update the anticipated bytes_read count based on the accurate amount of bytes we will read
                     if compare_mode == CompareMode.PARTIAL.value:
-                        bytes_read += min(file_size_bytes, byte_count_to_hash)
+                        file_bytes_read = min(file_size_bytes, byte_count_to_hash)
+                    elif previous_chunks is not None:
+                        # Reading starts at the last chunk that was full last time, as long as it's unchanged
+                        file_bytes_read = file_size_bytes - max(previous_chunks[0] // chunk_size_bytes - 1, 0) \
+                            * chunk_size_bytes
                     else:
-                        bytes_read += file_size_bytes
-                    # Check if the fileBytesDict already contains an entry for the byte number of the current file
-                    if file_size_bytes not in file_duplicates_dict:
-                        # If no entry existed, create a new dict as a value and populate it using a helper
-                        file_duplicates_dict[file_size_bytes] = update_partial_dict({}, absolute_file_path,
-                                                                                    input_file_path,
-                                                                                    file_size_bytes, byte_count_to_hash,
-                                                                                    compare_mode)
-                    else:
-                        # An entry already existed as the value, so pass it to the helper to update
-                        file_duplicates_dict[file_size_bytes] = update_partial_dict(
-                            file_duplicates_dict[file_size_bytes],
-                            absolute_file_path, input_file_path,
-                            file_size_bytes, byte_count_to_hash,
-                            compare_mode)
+                        file_bytes_read = file_size_bytes
+                    bytes_read += file_bytes_read
+                    # Hashing goes through metrics.time_file() so the time each file takes is recorded
+                    hash_args = (absolute_file_path, file_size_bytes, file_bytes_read, hash_file_for_storage,
+                                 absolute_file_path, file_size_bytes, byte_count_to_hash, compare_mode,
+                                 chunk_size_bytes, previous_chunks, read_engine)
+                    if hashing_engine is not None:
+                        # Hand the file off to a worker, then store any results that have come back so far
+                        future = hashing_engine.submit(file_stat.st_dev, metrics.time_file, *hash_args)
+                        pending_hashes.append((future, absolute_file_path, input_file_path, file_size_bytes,
+                                               file_metadata))
+                        files_seen += store_pending_hashes(pending_hashes, scan_accumulator, carry_forward,
+                                                           logger, hashing_engine.get_pending_limit(), False,
+                                                           metrics)
+                        continue
+                    file_hashes = metrics.time_file(*hash_args)
+                    store_file_hashes(scan_accumulator, input_file_path, file_size_bytes, file_metadata, file_hashes,
+                                      carry_forward)
                 else:
-                    # Otherwise, finish processing this file by adding just its size in bytes to the dict
-                    file_duplicates_dict = add_or_update_dict_list(file_duplicates_dict, file_size_bytes,
-                                                                   input_file_path)
+                    # Otherwise, finish processing this file by adding just its size in bytes and metadata
+                    scan_accumulator.append(input_file_path, None, file_size_bytes, file_metadata)
                 files_seen += 1
             except FileNotFoundError:
+                metrics.record_error(FileNotFoundError.__name__)
                 logger.error("File {} was in list but was not found. "
                              "Perhaps it got deleted during scan? Skipping file.".format(absolute_file_path))
-        # We've exited the for loop for the current abs_dir_path's files, onto the next abs_dir_path
-        directories_seen += 1
 
+    # Wait for any files still being hashed by the hashing_engine
+    files_seen += store_pending_hashes(pending_hashes, scan_accumulator, carry_forward, logger, 0, True, metrics)
     # Now that we're done traversing, print out summarized information
-    log_current_progress(logger, start_time, time(), bytes_read, files_seen, directories_seen)
+    log_current_progress(logger, start_time, time(), bytes_read, files_seen, directories_seen,
+                         read_engine.get_throttled_seconds(root_device))
+    metrics.update_progress(files_seen, directories_seen, bytes_read)
     if compare_mode == CompareMode.SIZE.value or compare_mode == CompareMode.PARTIAL.value:
         bytes_saved_mb = (bytes_total - bytes_read) / 1000 / 1000
         logger.info(
             "By using a partial file hash or file size instead of full file hash, "
             "difflens skipped reading {:.0f}MB from files on disk under {}".format(bytes_saved_mb, input_path))
-    # Return the dict to the caller
-    return file_duplicates_dict
-
-
-# Provided with the dict computed earlier, parse it into a flattened DataFrame for analysis
-def flatten_dict_to_data_frame(file_duplicates_dict):
-    # Define a list which will contain the flattened rows to write
-    # Schema: file_path::string, full_hash::string, file_size_bytes::int
-    # TODO add modified date, hashing date?
-    flat_list = []
-
-    # Flatten the data by iterating through the nested dicts in the correct way
-    # Level zero contains file size as the key
-    for level_zero_key, level_zero_value in file_duplicates_dict.items():
-        if isinstance(level_zero_value, dict):
-            # Level one contains the Tuple of (partial_hash, file_fully_hashed?) as the key
-            for level_one_key, level_one_value in level_zero_value.items():
-                if isinstance(level_one_value, dict):
-                    # Level two contains the full hash as the key, and guaranteed to have a list of files as the value
-                    for level_two_key, level_two_value in level_one_value.items():
-                        for list_item in level_two_value:
-                            flat_list.append([list_item, level_two_key, level_zero_key])
-                else:
-                    # If the value wasn't a dict, then it's a list of files.
-                    # This occurs when the partial hash was actually a full hash due to the file being small
-                    # or when hashing was stopped early due to the compare mode being partial-hash
-                    for list_item in level_one_value:
-                        # Handle cases where key is a Tuple of the hash and file_fully_read indicator OR a hash string
-                        if isinstance(level_one_key, tuple):
-                            flat_list.append([list_item, level_one_key[0], level_zero_key])
-                        else:
-                            flat_list.append([list_item, level_one_key, level_zero_key])
+    if carry_forward is not None:
+        carry_forward.log_summary()
+    # Return the accumulated columns to the caller
+    return scan_accumulator
+
+
+# Phase one of finding duplicates lazily. Given a relative or absolute input path, find files it contains and stat them
+# without reading any contents. Add each file to file_size_dict, which has schema
+# {key:file_size_bytes, value:list of (absolute_path, relative_path, (modified_time_ns, inode, device), root_name)}
+# and return it. Passing in the same file_size_dict for multiple roots allows finding duplicates across all of them
+# Directories are listed by walk_workers threads if there's more than one
+def collect_files_by_size(input_path, logger, log_update_interval_seconds, log_update_interval_files, path_excluder,
+                          file_size_dict, relative_base=None, root_name=None, walk_workers=1):
+    path_to_process = sanitize_and_validate_directory_path(input_path, logger)
+    files_seen = last_files_seen = directories_seen = 0
+    start_time = last_logger_time = time()
+    for abs_dir_path, file_entries in walk_directory(path_to_process, path_excluder, relative_base, logger,
+                                                     walk_workers):
+        for absolute_file_path, relative_file_path, file_stat in file_entries:
+            current_time = time()
+            if (current_time - last_logger_time) > log_update_interval_seconds or \
+                    (files_seen - last_files_seen) > log_update_interval_files:
+                log_current_progress(logger, start_time, current_time, 0, files_seen, directories_seen)
+                last_logger_time = current_time
+                last_files_seen = files_seen
+            add_or_update_dict_list(file_size_dict, file_stat.st_size,
+                                    (absolute_file_path, relative_file_path,
+                                     (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev), root_name))
+            files_seen += 1
+        directories_seen += 1
+    log_current_progress(logger, start_time, time(), 0, files_seen, directories_seen)
+    return file_size_dict
+
+
+# Hash each (file_entry, file_size_bytes) in order using the given compare_mode, yielding (file_entry, file_size_bytes,
+# hash_file() output) for each file that still exists. Files are hashed on the hashing_engine's threads if one is given.
+# The time taken to hash each file and any files that disappeared are recorded to metrics
+def hash_file_entries(file_entries, byte_count_to_hash, compare_mode, logger, hashing_engine, read_engine, metrics):
+    pending_hashes = deque()
+    for file_entry, file_size_bytes in file_entries:
+        absolute_file_path = file_entry[0]
+        # Partial hashing reads at most byte_count_to_hash bytes, and full hashing reads the whole file
+        file_bytes_read = file_size_bytes
+        if compare_mode == CompareMode.PARTIAL.value:
+            file_bytes_read = min(file_size_bytes, byte_count_to_hash)
+        hash_args = (absolute_file_path, file_size_bytes, file_bytes_read, hash_file, absolute_file_path,
+                     file_size_bytes, byte_count_to_hash, compare_mode, read_engine)
+        if hashing_engine is not None:
+            pending_hashes.append((hashing_engine.submit(file_entry[2][2], metrics.time_file, *hash_args),
+                                   file_entry, file_size_bytes))
+            if len(pending_hashes) < hashing_engine.get_pending_limit():
+                continue
+            future, file_entry, file_size_bytes = pending_hashes.popleft()
+            absolute_file_path = file_entry[0]
         else:
-            # if the value wasn't a dict, then it's a list of files
-            for list_item in level_zero_value:
-                flat_list.append([list_item, "not_computed", level_zero_key])
-
-    # Input the flat-formatted list into a DataFrame while specifying column names
-    # https://stackoverflow.com/questions/13784192
-    data_frame = DataFrame(flat_list, columns=["relative_path", "hash", "file_size_bytes"])
-    return data_frame
+            future = None
+        try:
+            if future is None:
+                yield file_entry, file_size_bytes, metrics.time_file(*hash_args)
+            else:
+                yield file_entry, file_size_bytes, future.result()
+        except FileNotFoundError:
+            metrics.record_error(FileNotFoundError.__name__)
+            logger.error("File {} was in list but was not found. "
+                         "Perhaps it got deleted during scan? Skipping file.".format(absolute_file_path))
+    # Wait for any files still being hashed by the hashing_engine
+    while pending_hashes:
+        future, file_entry, file_size_bytes = pending_hashes.popleft()
+        try:
+            yield file_entry, file_size_bytes, future.result()
+        except FileNotFoundError:
+            metrics.record_error(FileNotFoundError.__name__)
+            logger.error("File {} was in list but was not found. "
+                         "Perhaps it got deleted during scan? Skipping file.".format(file_entry[0]))
+
+
+# Phase two of finding duplicates lazily. Provided with the file_size_dict from collect_files_by_size(), read partial
+# hashes only for files sharing a size with another file, and full hashes only for files also sharing a partial hash.
+# Files that can't have a duplicate are left out. Returns a DataFrame of the remaining duplicate candidates with the
+# same columns as ScanAccumulator.to_data_frame() plus scan_root, sorted by relative path. If metrics is provided, the
+# time taken to hash each file is recorded to it
+def hash_duplicate_candidates(file_size_dict, logger, byte_count_to_hash, compare_mode, hashing_engine=None,
+                              read_engine=None, metrics=None):
+    if read_engine is None:
+        read_engine = ReadEngine()
+    if metrics is None:
+        metrics = ScanMetrics(None, float("inf"), logger)
+    rows = []
+    bytes_total = sum(file_size_bytes * len(file_entries) for file_size_bytes, file_entries in file_size_dict.items())
+    # Full hashing reads the first byte_count_to_hash bytes of a file again after partial hashing already read them.
+    # Those are counted in bytes_read, which is what was read from disk, but not again in the bytes saved compared to
+    # reading every file once
+    bytes_read = bytes_reread = 0
+    start_time = time()
+    # Only files with a size shared by another file can possibly be duplicates
+    size_candidates = [(file_entry, file_size_bytes) for file_size_bytes, file_entries in file_size_dict.items()
+                       if len(file_entries) > 1 for file_entry in file_entries]
+    logger.info("Found {} files sharing a size with at least one other file".format(len(size_candidates)))
+    if compare_mode == CompareMode.SIZE.value:
+        rows = [[file_entry[1], NOT_COMPUTED, file_size_bytes, *file_entry[2], file_entry[3]]
+                for file_entry, file_size_bytes in size_candidates]
+    else:
+        # Group the size candidates by (file_size_bytes, partial_hash)
+        partial_hash_dict = {}
+        for file_entry, file_size_bytes, file_hashes in hash_file_entries(size_candidates, byte_count_to_hash,
+                                                                          CompareMode.PARTIAL.value, logger,
+                                                                          hashing_engine, read_engine, metrics):
+            bytes_read += min(file_size_bytes, byte_count_to_hash)
+            add_or_update_dict_list(partial_hash_dict, (file_size_bytes, file_hashes[0]), file_entry)
+        full_hash_candidates = []
+        for (file_size_bytes, partial_hash), file_entries in partial_hash_dict.items():
+            if len(file_entries) < 2:
+                continue
+            # The partial hash is final if it covered the whole file or if full hashing is disabled
+            if file_size_bytes <= byte_count_to_hash or compare_mode == CompareMode.PARTIAL.value:
+                rows.extend([file_entry[1], partial_hash, file_size_bytes, *file_entry[2], file_entry[3]]
+                            for file_entry in file_entries)
+            else:
+                full_hash_candidates.extend((file_entry, file_size_bytes) for file_entry in file_entries)
+        logger.info("Found {} files sharing a size and partial hash with at least one other file".format(
+            len(full_hash_candidates)))
+        for file_entry, file_size_bytes, file_hashes in hash_file_entries(full_hash_candidates, byte_count_to_hash,
+                                                                          compare_mode, logger, hashing_engine,
+                                                                          read_engine, metrics):
+            bytes_read += file_size_bytes
+            bytes_reread += byte_count_to_hash
+            rows.append([file_entry[1], file_hashes[2], file_size_bytes, *file_entry[2], file_entry[3]])
+    logger.info("{:.1f}MB of data read from disk to find {} duplicate candidates in {:.2f} seconds".format(
+        bytes_read / 1000 / 1000, len(rows), time() - start_time))
+    bytes_saved_mb = (bytes_total - bytes_read + bytes_reread) / 1000 / 1000
+    logger.info("By only hashing files sharing a size and partial hash with other files, "
+                "difflens skipped reading {:.0f}MB from files on disk".format(bytes_saved_mb))
+    # Files were collected in whatever order their directories were listed in, so sort them like a scan's DataFrame
+    # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.sort_values.html
+    return DataFrame(rows, columns=["relative_path", "hash", "file_size_bytes"] + METADATA_COLUMNS + ["scan_root"]) \
+        .sort_values("relative_path", ignore_index=True)
@@ -0,0 +1,213 @@
+# Used to hold each walk worker's directories still to be listed
+from collections import deque
+# Used to run walk workers that list directories concurrently. Listing and stat() release the GIL while they wait on
+# the filesystem, so threads overlap the metadata latency of slow mounts
+from concurrent.futures import ThreadPoolExecutor
+# Used to list directories while reusing the file type info the OS returns alongside each name
+from os import path, scandir, sep
+# Used to hand listed directories to the thread hashing their files, holding back walk workers that get too far ahead
+from queue import Full, Queue
+# Used to let idle walk workers wait for more directories, and to stop them once the walk is over or abandoned
+from threading import Condition, Event
+
+# Amount of listed directories each walk worker may have waiting to have their files hashed, so listing runs ahead of
+# hashing without holding the whole tree in memory
+LISTED_DIRECTORIES_PER_WALK_WORKER = 64
+# Seconds a walk worker waits for room to hand off a listed directory before checking if it should stop
+WALK_STOP_CHECK_SECONDS = 0.1
+
+
+# Join a relative directory path and a name the same way path.relpath() would output it, without normalizing
+def join_relative_path(relative_dir_path, name):
+    if relative_dir_path == ".":
+        return name
+    return relative_dir_path + sep + name
+
+
+# List one directory, returning a Tuple of (file_entries, sub_dirs), or None if it couldn't be listed. file_entries is a
+# list of (absolute_file_path, relative_file_path, os.stat_result) for each regular file that wasn't excluded, and
+# sub_dirs a list of (absolute_dir_path, relative_dir_path) for each directory in it, in listing order.
+# Compared to os.walk() plus path.islink(), path.getsize() and path.relpath() per file, this costs one lstat() per file:
+# - The file type comes from the DirEntry, which on Linux is filled in by the directory listing itself
+# - Relative paths are built by concatenating names onto the relative path of the directory
+# https://docs.python.org/3/library/os.html#os.scandir
+def list_directory(abs_dir_path, rel_dir_path, path_excluder, logger):
+    file_entries = []
+    sub_dirs = []
+    try:
+        with scandir(abs_dir_path) as entries:
+            for entry in entries:
+                # Only symbolic links and unknown file types need an extra syscall to tell directories from files
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append((entry.path, join_relative_path(rel_dir_path, entry.name)))
+                    continue
+                rel_file_path = join_relative_path(rel_dir_path, entry.name)
+                # If the current file's extension or relative path was excluded, leave it out of the file list
+                if path_excluder.is_excluded_file(entry.name, rel_file_path):
+                    continue
+                if entry.is_symlink():
+                    # Links to directories were never walked into nor reported by os.walk(), so stay quiet
+                    if not entry.is_dir():
+                        logger.warning("Found a symbolic link at path {}, skipping".format(entry.path))
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    logger.warning("Found a special file such as a pipe or device at path {}, skipping".format(
+                        entry.path))
+                    continue
+                try:
+                    # Get the size of the file in Bytes, along with the metadata used to detect unchanged files
+                    # https://docs.python.org/3/library/os.html#os.DirEntry.stat
+                    file_stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    logger.error("File {} was in list but was not found. "
+                                 "Perhaps it got deleted during scan? Skipping file.".format(entry.path))
+                    continue
+                file_entries.append((entry.path, rel_file_path, file_stat))
+    except OSError as error:
+        # os.walk() silently skips directories it can't list, but mention it so missing files can be explained
+        logger.warning("Could not list directory {}, skipping it: {}".format(abs_dir_path, error))
+        return None
+    return file_entries, sub_dirs
+
+
+# Walk the directory tree under path_to_process top-down in the same order as os.walk(), yielding a Tuple of
+# (absolute_dir_path, file_entries) for each directory that wasn't excluded, with file_entries as list_directory()
+# returns them. Excluded directories are pruned before they are listed, so nothing under them is ever read.
+# With more than one walk_workers, directories are listed concurrently by a ParallelDirectoryWalker instead, and are
+# yielded in no particular order
+def walk_directory(path_to_process, path_excluder, relative_base, logger, walk_workers=1):
+    if walk_workers > 1:
+        yield from ParallelDirectoryWalker(path_to_process, path_excluder, relative_base, logger, walk_workers).walk()
+        return
+    # Stack of (absolute_dir_path, relative_dir_path) still to be listed. Popping from the end and pushing children in
+    # reverse order visits directories depth-first in listing order, just like os.walk()
+    directory_stack = [(path_to_process, path.relpath(path_to_process, relative_base))]
+    while directory_stack:
+        abs_dir_path, rel_dir_path = directory_stack.pop()
+        # NOTE: relative paths will never start with . unless . is the current directory
+        # NOTE: relative paths will never end with /
+        if path_excluder.is_excluded_dir(rel_dir_path):
+            continue
+        directory_listing = list_directory(abs_dir_path, rel_dir_path, path_excluder, logger)
+        if directory_listing is None:
+            continue
+        file_entries, sub_dirs = directory_listing
+        yield abs_dir_path, file_entries
+        directory_stack.extend(reversed(sub_dirs))
+
+
+# Walks a directory tree with several threads listing directories at once, for trees where the walk is bound by the
+# latency of each listing and stat() rather than by bandwidth, such as millions of small files or FUSE mounts like
+# Unraid's /mnt/user. Listed directories are handed through a bounded queue to the thread iterating walk(), so hashing
+# their files overlaps with listing the rest of the tree. Single use: create one per walk
+class ParallelDirectoryWalker:
+    def __init__(self, path_to_process, path_excluder, relative_base, logger, walk_workers):
+        self.path_to_process = path_to_process
+        self.path_excluder = path_excluder
+        self.relative_base = relative_base
+        self.logger = logger
+        self.walk_workers = walk_workers
+        # One deque of (absolute_dir_path, relative_dir_path) still to be listed per worker. Each worker takes from the
+        # end of its own, going depth-first like walk_directory(), and steals from the start of another's once its own
+        # is empty, taking the shallowest directory there, which likely has the most left under it
+        # https://docs.python.org/3/library/collections.html#collections.deque
+        self.directory_deques = [deque() for _ in range(walk_workers)]
+        # Amount of directories queued or being listed, which reaches 0 once the whole tree is listed. Guarded by
+        # directory_condition, which idle workers wait on for more directories
+        self.directories_outstanding = 0
+        self.directory_condition = Condition()
+        # Tuples of (absolute_dir_path, file_entries) listed but not yet yielded, followed by None once the walk is over
+        # https://docs.python.org/3/library/queue.html#queue.Queue
+        self.listed_queue = Queue(maxsize=walk_workers * LISTED_DIRECTORIES_PER_WALK_WORKER)
+        # Set once walk() is done being iterated, including when it's abandoned partway
+        self.stop_event = Event()
+        # The first exception a worker ran into, raised from walk() once the workers have stopped
+        self.error = None
+
+    # Yield a Tuple of (absolute_dir_path, file_entries) for each directory that wasn't excluded, like walk_directory()
+    def walk(self):
+        self.directory_deques[0].append((self.path_to_process, path.relpath(self.path_to_process, self.relative_base)))
+        self.directories_outstanding = 1
+        executor = ThreadPoolExecutor(max_workers=self.walk_workers, thread_name_prefix="difflens-walk")
+        try:
+            for worker_index in range(self.walk_workers):
+                executor.submit(self.run_worker, worker_index)
+            while True:
+                listed_directory = self.listed_queue.get()
+                if listed_directory is None:
+                    break
+                yield listed_directory
+        finally:
+            # Release workers waiting for directories or for room in the queue, whether or not the walk finished
+            self.stop_event.set()
+            with self.directory_condition:
+                self.directory_condition.notify_all()
+            executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+    # Take the next directory for a worker to list, waiting while other workers may still find more. Returns None once
+    # every directory has been listed or the walk was stopped
+    def take_directory(self, worker_index):
+        with self.directory_condition:
+            while not self.stop_event.is_set() and self.error is None:
+                own_deque = self.directory_deques[worker_index]
+                if own_deque:
+                    return own_deque.pop()
+                for offset in range(1, self.walk_workers):
+                    other_deque = self.directory_deques[(worker_index + offset) % self.walk_workers]
+                    if other_deque:
+                        return other_deque.popleft()
+                if self.directories_outstanding == 0:
+                    return None
+                self.directory_condition.wait()
+            return None
+
+    # Hand a listed directory, or None to end the walk, to the thread iterating walk(). Returns False if the walk was
+    # stopped before there was room for it
+    def put_listed(self, listed_directory):
+        while not self.stop_event.is_set():
+            try:
+                self.listed_queue.put(listed_directory, timeout=WALK_STOP_CHECK_SECONDS)
+                return True
+            except Full:
+                continue
+        return False
+
+    # List directories until there are none left. The worker finishing the last directory ends the walk, after every
+    # directory listed before it has been handed off
+    def run_worker(self, worker_index):
+        try:
+            while True:
+                directory = self.take_directory(worker_index)
+                if directory is None:
+                    return
+                abs_dir_path, rel_dir_path = directory
+                directory_listing = None
+                if not self.path_excluder.is_excluded_dir(rel_dir_path):
+                    directory_listing = list_directory(abs_dir_path, rel_dir_path, self.path_excluder, self.logger)
+                if directory_listing is not None:
+                    file_entries, sub_dirs = directory_listing
+                    # Queue the subdirectories before handing off the files, so idle workers can steal them while this
+                    # one waits for room in the queue
+                    with self.directory_condition:
+                        self.directory_deques[worker_index].extend(reversed(sub_dirs))
+                        self.directories_outstanding += len(sub_dirs)
+                        self.directory_condition.notify(len(sub_dirs))
+                    if not self.put_listed((abs_dir_path, file_entries)):
+                        return
+                with self.directory_condition:
+                    self.directories_outstanding -= 1
+                    walk_finished = self.directories_outstanding == 0
+                    if walk_finished:
+                        self.directory_condition.notify_all()
+                if walk_finished:
+                    self.put_listed(None)
+                    return
+        except Exception as error:
+            # Stop the other workers and end the walk, so walk() raises the error rather than waiting forever
+            with self.directory_condition:
+                if self.error is None:
+                    self.error = error
+                self.directory_condition.notify_all()
+            self.put_listed(None)
@@ -0,0 +1,318 @@
+# Used to write and read journal records in the same delimited format as hash files
+from csv import QUOTE_NONNUMERIC, reader, writer
+# Used to lock the journal while records are appended to or claimed from it, and to tell whether a watcher is running
+# https://docs.python.org/3/library/fcntl.html#fcntl.flock
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN, flock
+# Used to make records durable, to tell whether the journal at a path is still the one that was opened, and to look up
+# the files named by records
+from os import fstat, fsync, lstat, path, remove, sep, stat
+# Used to pick the carried-forward files that are sampled for bitrot
+from random import random
+# Used to match relative paths against every dirty tree at once
+import re
+# Used to tell regular files from directories, links, and special files without following links
+from stat import S_ISDIR, S_ISREG
+
+from .directorywalker import walk_directory
+from .pathExcluder import build_prefix_pattern
+
+# Record types of the dirty journal, one per row along with an absolute path or, for OVERFLOW_RECORD, a reason:
+# - DIRTY_FILE_RECORD: the file at the path was created, written to, had its metadata changed, or was moved or deleted
+# - DIRTY_TREE_RECORD: a directory at the path was created, moved, or deleted, so everything under it is dirty
+# - OVERFLOW_RECORD: the watcher may have missed changes, such as when its event queue overflowed or it was started
+DIRTY_FILE_RECORD = "F"
+DIRTY_TREE_RECORD = "T"
+OVERFLOW_RECORD = "O"
+# Suffix of the journal a run has claimed, which is kept until the run's outputs are written
+CLAIMED_JOURNAL_SUFFIX = ".claimed"
+# Suffix of the file a watcher holds locked while it runs, which names the directory it watches
+WATCHER_LOCK_SUFFIX = ".lock"
+
+
+# Open a journal for writing or reading records in the same dialect as write_hashes_to_file(), so paths containing tabs
+# or line breaks round trip
+def open_journal_stream(journal_path, mode):
+    return open(journal_path, mode, encoding="utf-8", errors="surrogateescape", newline="")
+
+
+# Return True if path_string is directory_path itself or is somewhere under it
+def is_within_directory(path_string, directory_path):
+    return path_string == directory_path or path_string.startswith(directory_path.rstrip(sep) + sep)
+
+
+# Appends the paths an inotify watcher saw change to the dirty journal, which the next difflens run claims to find out
+# which files it has to look at. Records are held in memory and appended in batches by flush(), skipping any already
+# in the journal since it was last claimed, so a file written to over and over is only recorded once
+class DirtyJournalWriter:
+    def __init__(self, journal_path, logger):
+        self.journal_path = journal_path
+        self.logger = logger
+        # Dict of {key:(record_type, absolute_path or reason), value:None}, kept in the order records were made
+        self.pending_records = {}
+        # Inode of the journal the records in written_records and written_tree_paths were appended to. A claimed
+        # journal is replaced by a new one, which starts over without any of them
+        self.journal_inode = None
+        self.written_records = set()
+        self.written_tree_paths = set()
+
+    def record(self, record_type, path_or_reason):
+        self.pending_records[(record_type, path_or_reason)] = None
+
+    # Return True if a record has already been appended to the current journal that covers the given one, either the
+    # same record or a dirty tree containing the path
+    def is_already_written(self, record_type, path_or_reason):
+        if (record_type, path_or_reason) in self.written_records:
+            return True
+        if record_type == OVERFLOW_RECORD:
+            return False
+        parent_path = path.dirname(path_or_reason)
+        while parent_path not in self.written_tree_paths:
+            next_parent_path = path.dirname(parent_path)
+            if next_parent_path == parent_path:
+                return False
+            parent_path = next_parent_path
+        return True
+
+    # Open the journal for appending and lock it, making sure it wasn't claimed and removed while waiting for the lock.
+    # Returns the locked stream
+    def open_locked_journal(self):
+        while True:
+            stream = open_journal_stream(self.journal_path, "a")
+            flock(stream.fileno(), LOCK_EX)
+            try:
+                if stat(self.journal_path).st_ino == fstat(stream.fileno()).st_ino:
+                    return stream
+            except FileNotFoundError:
+                pass
+            stream.close()
+
+    # Append every pending record to the journal and wait for them to reach the disk
+    def flush(self):
+        if not self.pending_records:
+            return
+        with self.open_locked_journal() as stream:
+            journal_inode = fstat(stream.fileno()).st_ino
+            if journal_inode != self.journal_inode:
+                self.journal_inode = journal_inode
+                self.written_records = set()
+                self.written_tree_paths = set()
+            records = [record for record in self.pending_records if not self.is_already_written(*record)]
+            writer(stream, delimiter="\t", quoting=QUOTE_NONNUMERIC, doublequote=False, escapechar="\\",
+                   lineterminator="\n").writerows(records)
+            stream.flush()
+            fsync(stream.fileno())
+            flock(stream.fileno(), LOCK_UN)
+        self.written_records.update(records)
+        self.written_tree_paths.update(path_string for record_type, path_string in records
+                                       if record_type == DIRTY_TREE_RECORD)
+        self.logger.debug("Appended {} of {} changed paths to dirty journal {}".format(
+            len(records), len(self.pending_records), self.journal_path))
+        self.pending_records = {}
+
+
+# Lock the file next to the journal that tells difflens a watcher is keeping the journal up to date, and write the
+# directory being watched into it. The lock is held until the returned stream is closed, which the OS does if the
+# watcher dies. Raises BlockingIOError if another watcher already holds it
+def hold_watcher_lock(journal_path, root_directory):
+    stream = open(journal_path + WATCHER_LOCK_SUFFIX, "a+", encoding="utf-8", errors="surrogateescape")
+    try:
+        flock(stream.fileno(), LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        stream.close()
+        raise
+    stream.seek(0)
+    stream.truncate()
+    stream.write(root_directory)
+    stream.flush()
+    return stream
+
+
+# Return the reason a watcher isn't keeping the journal of root_directory up to date, or None if one is
+def get_missing_watcher_reason(journal_path, root_directory):
+    lock_path = journal_path + WATCHER_LOCK_SUFFIX
+    if not path.isfile(lock_path):
+        return "no watcher has been started for it"
+    with open(lock_path, "r", encoding="utf-8", errors="surrogateescape") as stream:
+        try:
+            flock(stream.fileno(), LOCK_SH | LOCK_NB)
+        except BlockingIOError:
+            # The watcher holds the lock exclusively, so it's still running
+            watched_directory = stream.read()
+            if watched_directory != root_directory:
+                return "its watcher is watching {} rather than {}".format(watched_directory, root_directory)
+            return None
+    return "its watcher is no longer running"
+
+
+# The changes recorded to a dirty journal since it was last claimed. If overflow_reasons is empty, every file that may
+# have changed is in dirty_file_paths or under one of dirty_tree_paths, as absolute paths. Otherwise changes may have
+# been missed, and the whole directory has to be walked
+class DirtyPaths:
+    def __init__(self):
+        self.dirty_file_paths = set()
+        self.dirty_tree_paths = set()
+        self.overflow_reasons = []
+
+
+# Claim the changes recorded to the dirty journal of root_directory for a run, moving them to the claimed journal so
+# the watcher starts a new journal for changes made from now on. Records left in the claimed journal by a run that
+# didn't finish are claimed again along with them. Returns the DirtyPaths read from the claimed journal
+def claim_dirty_journal(journal_path, root_directory, logger):
+    dirty_paths = DirtyPaths()
+    missing_watcher_reason = get_missing_watcher_reason(journal_path, root_directory)
+    if missing_watcher_reason is not None:
+        dirty_paths.overflow_reasons.append(missing_watcher_reason)
+    claimed_path = journal_path + CLAIMED_JOURNAL_SUFFIX
+    if path.isfile(journal_path):
+        with open(journal_path, "rb") as stream:
+            # Holding the lock keeps the watcher from appending between reading the journal and removing it
+            flock(stream.fileno(), LOCK_EX)
+            with open(claimed_path, "ab") as claimed_stream:
+                claimed_stream.write(stream.read())
+                claimed_stream.flush()
+                fsync(claimed_stream.fileno())
+            remove(journal_path)
+    if path.isfile(claimed_path):
+        with open_journal_stream(claimed_path, "r") as stream:
+            for record_type, path_or_reason in reader(stream, delimiter="\t", quoting=QUOTE_NONNUMERIC,
+                                                      doublequote=False, escapechar="\\"):
+                if record_type == DIRTY_FILE_RECORD:
+                    dirty_paths.dirty_file_paths.add(path_or_reason)
+                elif record_type == DIRTY_TREE_RECORD:
+                    dirty_paths.dirty_tree_paths.add(path_or_reason)
+                else:
+                    dirty_paths.overflow_reasons.append(path_or_reason)
+    logger.info("Claimed dirty journal {} with {} changed files, {} changed directories, and {} overflows".format(
+        journal_path, len(dirty_paths.dirty_file_paths), len(dirty_paths.dirty_tree_paths),
+        len(dirty_paths.overflow_reasons)))
+    return dirty_paths
+
+
+# Delete the claimed dirty journal once the outputs of the run that claimed it have been written, as the next run
+# compares against those outputs and only needs the changes made since
+def remove_claimed_dirty_journal(journal_path, logger):
+    claimed_path = journal_path + CLAIMED_JOURNAL_SUFFIX
+    if path.isfile(claimed_path):
+        remove(claimed_path)
+        logger.info("Removed claimed dirty journal {} as the scan completed".format(claimed_path))
+
+
+# Works out which files a scan guided by a dirty journal has to look at, rather than walking the whole directory:
+# - Files in the comparison that aren't dirty, excluded, or sampled are carried forward without being looked at
+# - Dirty files are stat'ed and go through the usual carry forward checks, so they're rehashed if they changed
+# - Dirty trees that still exist are walked, and files in the comparison under them are left to that walk
+# - verify_percent of the carried-forward files are sampled and rehashed to catch bitrot, along with any a rolling scrub
+#   requested verification of
+# Dirty trees are listed by walk_workers threads if there's more than one
+class DirtyScanPlan:
+    def __init__(self, dirty_paths, path_to_process, relative_base, path_excluder, carry_forward, verify_percent,
+                 logger, walk_workers=1):
+        self.path_excluder = path_excluder
+        self.relative_base = relative_base
+        self.logger = logger
+        self.walk_workers = walk_workers
+        self.relative_root = path.relpath(path_to_process, relative_base)
+        # Dict of {key:relative_dir_path, value:True if it or a directory above it was excluded}
+        self.excluded_directory_dict = {}
+        # Trees inside another dirty tree are left out, as walking the outer one covers them. Sorting by path component
+        # puts each tree right after the one it's inside of, if any
+        self.dirty_tree_paths = []
+        for tree_path in sorted(dirty_paths.dirty_tree_paths, key=lambda tree_path: tree_path.split(sep)):
+            if is_within_directory(tree_path, path_to_process) and not (
+                    self.dirty_tree_paths and is_within_directory(tree_path, self.dirty_tree_paths[-1])):
+                self.dirty_tree_paths.append(tree_path)
+        relative_tree_paths = [path.relpath(tree_path, relative_base) for tree_path in self.dirty_tree_paths]
+        tree_pattern = build_prefix_pattern([relative_tree_path + sep for relative_tree_path in relative_tree_paths])
+        # Matches relative paths under a dirty tree, which only the walk of that tree may keep
+        tree_regex = None if tree_pattern is None else re.compile(tree_pattern)
+        self.dirty_file_paths = sorted(file_path for file_path in dirty_paths.dirty_file_paths
+                                       if is_within_directory(file_path, path_to_process)
+                                       and (tree_regex is None
+                                            or tree_regex.match(path.relpath(file_path, relative_base)) is None))
+        dirty_relative_paths = {path.relpath(file_path, relative_base) for file_path in self.dirty_file_paths}
+        # Relative paths of the files carried forward as they are, and of those sampled for bitrot
+        self.carried_paths = []
+        self.sampled_paths = []
+        for relative_path in carry_forward.carry_forward_dict:
+            if relative_path in dirty_relative_paths \
+                    or (tree_regex is not None and tree_regex.match(relative_path) is not None) \
+                    or not self.is_under_root(relative_path) or self.is_excluded_file(relative_path):
+                continue
+            # Files a rolling scrub asked to verify are sampled the same way
+            # https://docs.python.org/3/library/random.html#random.random
+            if relative_path in carry_forward.requested_verification_paths \
+                    or verify_percent > 0 and random() * 100 < verify_percent:
+                self.sampled_paths.append(relative_path)
+            else:
+                self.carried_paths.append(relative_path)
+        logger.info("Carrying forward {} files not changed since the last scan, and looking at {} changed files, {} "
+                    "changed directories, and {} files sampled for bitrot".format(
+                        len(self.carried_paths), len(self.dirty_file_paths), len(self.dirty_tree_paths),
+                        len(self.sampled_paths)))
+
+    # Return True if a relative path from the comparison is under the directory being scanned, which every path is
+    # when relative paths start from it
+    def is_under_root(self, relative_path):
+        return self.relative_root == "." or is_within_directory(relative_path, self.relative_root)
+
+    # Return True if the directory at a relative path or one of the directories above it was excluded, the same as if
+    # walk_directory() had pruned it
+    def is_excluded_directory(self, relative_dir_path):
+        excluded = self.excluded_directory_dict.get(relative_dir_path)
+        if excluded is None:
+            if relative_dir_path == self.relative_root or relative_dir_path in ["", "."]:
+                excluded = self.path_excluder.is_excluded_dir(relative_dir_path or ".")
+            else:
+                excluded = self.is_excluded_directory(relative_dir_path.rpartition(sep)[0] or ".") \
+                    or self.path_excluder.is_excluded_dir(relative_dir_path)
+            self.excluded_directory_dict[relative_dir_path] = excluded
+        return excluded
+
+    # Return True if walk_directory() would have left out the file at a relative path
+    def is_excluded_file(self, relative_path):
+        relative_dir_path, _, file_name = relative_path.rpartition(sep)
+        return self.is_excluded_directory(relative_dir_path or ".") \
+            or self.path_excluder.is_excluded_file(file_name, relative_path)
+
+    # Return the file entry of (absolute_file_path, relative_file_path, os.stat_result) that walk_directory() would
+    # have made for the file at an absolute path, or None if it no longer exists, was excluded, or isn't a regular file
+    def get_file_entry(self, absolute_file_path):
+        relative_path = path.relpath(absolute_file_path, self.relative_base)
+        try:
+            file_stat = lstat(absolute_file_path)
+        except FileNotFoundError:
+            # Deleted since the last scan, so it's left out just as if the directory had been walked
+            return None
+        if not S_ISREG(file_stat.st_mode) or self.is_excluded_file(relative_path):
+            return None
+        return absolute_file_path, relative_path, file_stat
+
+    # Yield a Tuple of (directory_count, file_entries) for the files compute_diffs should read, the same as
+    # schedule_file_entries() does for a walk. Dirty and sampled files come in one batch, then each dirty tree is
+    # walked one directory at a time
+    def schedule_file_entries(self, carry_forward):
+        file_entries = []
+        for absolute_file_path in self.dirty_file_paths:
+            file_entry = self.get_file_entry(absolute_file_path)
+            if file_entry is not None:
+                file_entries.append(file_entry)
+        for relative_path in self.sampled_paths:
+            # Relative paths start from the current working directory if there's no relative_base
+            file_entry = self.get_file_entry(path.abspath(path.join(self.relative_base or "", relative_path)))
+            if file_entry is not None:
+                carry_forward.request_verification(relative_path)
+                file_entries.append(file_entry)
+        yield 0, file_entries
+        for tree_path in self.dirty_tree_paths:
+            try:
+                tree_stat = lstat(tree_path)
+            except FileNotFoundError:
+                continue
+            relative_tree_path = path.relpath(tree_path, self.relative_base)
+            # A tree whose parent was excluded would never have been walked into
+            if not S_ISDIR(tree_stat.st_mode) \
+                    or self.is_excluded_directory(relative_tree_path.rpartition(sep)[0] or "."):
+                continue
+            for _, tree_file_entries in walk_directory(tree_path, self.path_excluder, self.relative_base,
+                                                       self.logger, self.walk_workers):
+                yield 1, tree_file_entries
@@ -1,11 +1,64 @@
-# Used to set the output mode when writing tabular data
-from csv import QUOTE_NONNUMERIC
+# Used to read several hash files at once
+from concurrent.futures import ThreadPoolExecutor
+# Used to set the output mode when writing tabular data, or to stream tabular data row by row
+from csv import QUOTE_NONNUMERIC, reader, writer
+# Used to close hash files opened for read_csv() once it's done with them
+from contextlib import contextmanager
+# Used to look for the optional pyarrow package without importing it
+from importlib.util import find_spec
+# Used to pick how many hash files to read at once
+from os import cpu_count
 
 # Used to read tabular data from a file on disk
 from pandas import read_csv, concat
 
+from difflens.util.carryforward import METADATA_COLUMNS
+from difflens.util.chunkhash import CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN
 from difflens.util.commonutils import sanitize_and_validate_file_path
 from difflens.util.compareMode import CompareMode
+from difflens.util.compression import get_compression_codec, open_compressed_file, open_compressed_text_file
+from difflens.util.hashstore import HashStoreReader, is_hash_store_path, write_hash_store
+
+
+# Columns of hash files holding integers. Every other column holds strings
+INTEGER_COLUMNS = ["file_size_bytes"] + METADATA_COLUMNS + [CHUNK_SIZE_COLUMN]
+# Ways the relative_path and hash columns can be stored once read:
+# - default is pandas' own string type
+# - category stores each distinct value once plus a small integer per row, which pays off when values repeat, such as
+#   the hashes of duplicates or the not_computed hash of file-size compare mode
+# - pyarrow stores every value of a column back to back in one Arrow buffer rather than as a Python object per row
+STRING_DTYPES = ["default", "category", "pyarrow"]
+# Whether the optional pyarrow package is installed, which provides a multithreaded CSV parser and Arrow strings
+# https://pandas.pydata.org/docs/user_guide/io.html#io-csv-engine
+PYARROW_AVAILABLE = find_spec("pyarrow") is not None
+# Rows parsed at a time when iterating over a hash file in chunks
+HASH_FILE_CHUNK_ROWS = 100000
+
+
+# Get the name of the hash column in files written with the given compare_mode, such as full_hash for full-hash
+# NOTE: Since the compare_mode has dashes but the file uses underscores, replace the character
+def get_hash_column_name(compare_mode):
+    if compare_mode == CompareMode.SIZE.value:
+        return "hash"
+    return compare_mode.replace("-", "_")
+
+
+# Open a delimited hash file in text mode, decompressing or compressing it based on its extension. See
+# open_compressed_file() for compression_level and compression_threads
+def open_hash_text_file(file_path, mode, compression_level=None, compression_threads=1):
+    return open_compressed_text_file(file_path, mode, compression_level, compression_threads)
+
+
+# Yield what read_csv() should read a delimited hash file from: its path if pandas can decompress it on its own, or
+# else the file opened and decompressed for it, which is closed once done
+@contextmanager
+def open_read_csv_source(input_path):
+    codec = get_compression_codec(input_path)
+    if codec is None or (codec["pandas"] and codec["available"]):
+        yield input_path
+        return
+    with open_compressed_file(input_path, "rb") as stream:
+        yield stream
 
 
 # Rename data_frame input column "hash" to the compare_mode in preparation for writing to disk
@@ -33,33 +86,179 @@ def update_data_frame_hash_column_name(data_frame, original_column_name, new_col
         raise ValueError(message)
 
 
-# Given a list of input paths pointing to tabular data files, read each and return their DataFrame concatenation
-def read_hashes_from_files(input_paths, logger, compare_mode):
-    data_frame_list = []
-    for path in input_paths:
-        # Pandas can read relative paths, but handle relative->absolute conversion here so extra info can print
-        path = sanitize_and_validate_file_path(path, logger)
-        # Use pandas to read a TSV file and parse it into a dataFrame
-        # https://pandas.pydata.org/docs/reference/api/pandas.read_csv.html
+# Return the column names in the header row of a delimited hash file, or None if the file is empty
+def read_hash_file_header(input_path):
+    with open_hash_text_file(input_path, "r") as stream:
+        return next(reader(stream, delimiter="\t", doublequote=False, escapechar="\\"), None)
+
+
+# Return the names of the columns to read from a hash file with the given header, given the standardized names of the
+# columns wanted, where the hash column is called "hash" whatever the compare_mode. Raises ValueError if one is missing
+def get_columns_to_read(header, columns, compare_mode, input_path, logger):
+    hash_column_name = get_hash_column_name(compare_mode)
+    columns_to_read = [hash_column_name if column_name == "hash" else column_name for column_name in columns]
+    for column_name in columns_to_read:
+        if column_name not in header:
+            message = "Column '{}' did not exist in {}! Did you switch between partial and full hashing?".format(
+                column_name, input_path)
+            logger.error(message)
+            raise ValueError(message)
+    return columns_to_read
+
+
+# Return the keyword arguments for read_csv() that parse a delimited hash file with the given header, reading only
+# columns_to_read if it isn't None. Every column's type is declared up front rather than inferred
+# https://pandas.pydata.org/docs/reference/api/pandas.read_csv.html
+def get_read_csv_arguments(header, columns_to_read, string_dtype):
+    string_type = "string[pyarrow]" if string_dtype == "pyarrow" else str
+    return {
         # Use tabs as separators
+        "sep": "\t",
         # Don't allow double-quotes inside fields without escaping
+        "doublequote": False,
         # Use a backslash \ character to escape separators or double quotes inside fields
+        "escapechar": "\\",
         # Don't read the first field in each row as the row index
-        data_frame = read_csv(path, sep="\t", doublequote=False, escapechar="\\", index_col=False)
-        # Standardize the hash mode column to "hash" even if the compare_mode is SIZE, to make modified/duplicate
-        # comparison simpler since whatever the compare_mode, it will be in the same column
-        # NOTE: Since the compare_mode has dashes but the file uses underscores, replace the character
-        data_frame = update_data_frame_hash_column_name(data_frame, compare_mode.replace("-", "_"), "hash", logger,
-                                                        True)
-        data_frame_list.append(data_frame)
+        "index_col": False,
+        "usecols": columns_to_read,
+        "dtype": {column_name: "int64" if column_name in INTEGER_COLUMNS else string_type for column_name in header},
+        # Only empty fields are missing values, so files named NA or null keep their names
+        "keep_default_na": False,
+        "na_values": [""],
+        # Integer columns with missing values are read as floats, so parse those exactly the way pyarrow does
+        "float_precision": "round_trip"}
+
+
+# Read a delimited hash file into a DataFrame with pandas' own C parser, given the arguments from
+# get_read_csv_arguments()
+def read_csv_with_pandas(input_path, read_csv_arguments):
+    with open_read_csv_source(input_path) as read_csv_source:
+        return read_csv(read_csv_source, engine="c", **read_csv_arguments)
+
+
+# Read a delimited hash file into a DataFrame with pyarrow's multithreaded parser, given the same arguments as
+# read_csv_with_pandas() so both produce the same DataFrame. pyarrow is called directly rather than through read_csv()'s
+# pyarrow engine, which can't take every argument the C parser gets, nor be told that quoted paths may contain line
+# breaks. Raises ValueError, as pyarrow.lib.ArrowInvalid, if an integer column has missing values
+# https://arrow.apache.org/docs/python/generated/pyarrow.csv.read_csv.html
+def read_csv_with_pyarrow(input_path, read_csv_arguments):
+    # Only imported once it's known to be installed
+    from pyarrow import csv as pyarrow_csv, int64, string
+    parse_options = pyarrow_csv.ParseOptions(delimiter=read_csv_arguments["sep"],
+                                             double_quote=read_csv_arguments["doublequote"],
+                                             escape_char=read_csv_arguments["escapechar"], newlines_in_values=True)
+    # Columns whose type isn't declared, such as integers with missing values, are inferred
+    convert_options = pyarrow_csv.ConvertOptions(
+        column_types={column_name: int64() if column_dtype == "int64" else string()
+                      for column_name, column_dtype in read_csv_arguments["dtype"].items()},
+        include_columns=read_csv_arguments["usecols"], null_values=read_csv_arguments["na_values"],
+        strings_can_be_null=True)
+    if get_compression_codec(input_path) is None:
+        table = pyarrow_csv.read_csv(input_path, parse_options=parse_options, convert_options=convert_options)
+    else:
+        with open_compressed_file(input_path, "rb") as stream:
+            table = pyarrow_csv.read_csv(stream, parse_options=parse_options, convert_options=convert_options)
+    return table.to_pandas()
+
+
+# Turn a DataFrame read from a hash file into the form analyses expect: the hash column renamed to "hash", empty chunk
+# digests as empty strings rather than NaN, and relative paths and hashes stored as string_dtype
+def standardize_hash_data_frame(data_frame, compare_mode, string_dtype, logger):
+    # Standardize the hash mode column to "hash" even if the compare_mode is SIZE, to make modified/duplicate
+    # comparison simpler since whatever the compare_mode, it will be in the same column
+    # NOTE: Since the compare_mode has dashes but the file uses underscores, replace the character
+    data_frame = update_data_frame_hash_column_name(data_frame, compare_mode.replace("-", "_"), "hash", logger, True)
+    # Files made of a single chunk have empty chunk digests, which read_csv() reads as NaN
+    if CHUNK_DIGESTS_COLUMN in data_frame.columns:
+        data_frame[CHUNK_DIGESTS_COLUMN] = data_frame[CHUNK_DIGESTS_COLUMN].fillna("")
+    if string_dtype in ["category", "pyarrow"]:
+        string_columns = [column_name for column_name in ["relative_path", "hash"] if column_name in data_frame.columns]
+        data_frame[string_columns] = data_frame[string_columns].astype(
+            "category" if string_dtype == "category" else "string[pyarrow]")
+    return data_frame
+
+
+# Read one hash file into a DataFrame. See read_hashes_from_files() for the arguments
+def read_hashes_from_file(input_path, logger, compare_mode, columns, string_dtype):
+    if is_hash_store_path(input_path):
+        # Memory map the binary hash store and build the DataFrame straight from its columns
+        data_frame = HashStoreReader(input_path).to_data_frame()
+        if columns is not None:
+            data_frame = data_frame[get_columns_to_read(data_frame.columns, columns, compare_mode, input_path, logger)]
+        return standardize_hash_data_frame(data_frame, compare_mode, string_dtype, logger)
+    header = read_hash_file_header(input_path)
+    columns_to_read = None
+    if header is not None and columns is not None:
+        columns_to_read = get_columns_to_read(header, columns, compare_mode, input_path, logger)
+    read_csv_arguments = get_read_csv_arguments(header or [], columns_to_read, string_dtype)
+    # Use pyarrow's multithreaded parser if it's installed, and pandas' own C parser otherwise. Empty files are left to
+    # the C parser, which reports them the same way whichever parser is used
+    read_hash_csv = read_csv_with_pyarrow if PYARROW_AVAILABLE and header is not None else read_csv_with_pandas
+    try:
+        data_frame = read_hash_csv(input_path, read_csv_arguments)
+    except ValueError:
+        # Hash files combined from older ones may have empty metadata fields, which an int64 column can't hold
+        logger.debug("Hash file {} has missing integer values, reading those columns as floats".format(input_path))
+        read_csv_arguments["dtype"] = {column_name: column_dtype for column_name, column_dtype
+                                       in read_csv_arguments["dtype"].items() if column_dtype != "int64"}
+        data_frame = read_hash_csv(input_path, read_csv_arguments)
+    return standardize_hash_data_frame(data_frame, compare_mode, string_dtype, logger)
+
+
+# Given a list of input paths pointing to tabular data files, read each and return their DataFrame concatenation.
+# Several files are read at once on up to read_workers threads, which defaults to one per file up to the CPU count.
+# If columns is a list of column names, with the hash column called "hash", only those columns are read. string_dtype
+# is one of STRING_DTYPES, picking how relative paths and hashes are stored
+def read_hashes_from_files(input_paths, logger, compare_mode, columns=None, string_dtype="default",
+                           read_workers=None):
+    # Pandas can read relative paths, but handle relative->absolute conversion here so extra info can print
+    input_paths = [sanitize_and_validate_file_path(input_path, logger) for input_path in input_paths]
+    if read_workers is None:
+        read_workers = min(len(input_paths), cpu_count() or 1)
+    if read_workers <= 1:
+        data_frame_list = [read_hashes_from_file(input_path, logger, compare_mode, columns, string_dtype)
+                           for input_path in input_paths]
+    else:
+        # The parsers spend most of their time without holding the GIL, so files can be read on threads
+        # https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.Executor.map
+        with ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="difflens-read") as executor:
+            data_frame_list = list(executor.map(read_hashes_from_file, input_paths, [logger] * len(input_paths),
+                                                [compare_mode] * len(input_paths), [columns] * len(input_paths),
+                                                [string_dtype] * len(input_paths)))
     # Now that all the input paths have been read in as DataFrames, concatenate them into one DataFrame and return
+    if len(data_frame_list) == 1:
+        return data_frame_list[0]
     concat_data_frame = concat(data_frame_list)
     return concat_data_frame
 
 
+# Given the path to a delimited hash file, yield DataFrames of up to chunk_rows rows at a time in file order, each in
+# the same form read_hashes_from_files() returns, so files larger than memory can be processed a piece at a time.
+# Binary hash stores are memory mapped rather than parsed, so they're yielded whole
+def iterate_hash_file_chunks(input_path, logger, compare_mode, columns=None, string_dtype="default",
+                             chunk_rows=HASH_FILE_CHUNK_ROWS):
+    input_path = sanitize_and_validate_file_path(input_path, logger)
+    if is_hash_store_path(input_path):
+        yield read_hashes_from_file(input_path, logger, compare_mode, columns, string_dtype)
+        return
+    header = read_hash_file_header(input_path)
+    if header is None:
+        return
+    columns_to_read = None if columns is None else get_columns_to_read(header, columns, compare_mode, input_path,
+                                                                       logger)
+    # pyarrow's parser can't read in chunks, so the C parser is used
+    # https://pandas.pydata.org/docs/user_guide/io.html#io-chunking
+    with open_read_csv_source(input_path) as read_csv_source, read_csv(
+            read_csv_source, engine="c", chunksize=chunk_rows,
+            **get_read_csv_arguments(header, columns_to_read, string_dtype)) as chunk_reader:
+        for data_frame in chunk_reader:
+            yield standardize_hash_data_frame(data_frame, compare_mode, string_dtype, logger)
+
+
 # Given a data_frame and a compare_mode, update the "hash" column to the proper compare_mode name
-# and write the data_frame to disk
-def write_hashes_to_file(data_frame, output_path, logger, compare_mode):
+# and write the data_frame to disk. Delimited files are compressed with the codec their extension names, at
+# compression_level and with compression_threads threads if the codec supports them, as rows are formatted
+def write_hashes_to_file(data_frame, output_path, logger, compare_mode, compression_level=None, compression_threads=1):
     # If not in SIZE mode and the "hash" column exists in the data_frame, rename it with the proper compare_mode
     # Do not update the data_frame in place as we may modify it or use it later and want it in its original state
     # NOTE: Since the compare_mode has dashes but the file uses underscores, replace the character
@@ -68,10 +267,62 @@ def write_hashes_to_file(data_frame, output_path, logger, compare_mode):
                                                         False)
     # Pandas can handle relative paths, but handle relative->absolute conversion here so extra info can print
     output_path = sanitize_and_validate_file_path(output_path, logger)
+    if is_hash_store_path(output_path):
+        # The binary hash store records the name of the hash column, so it can be renamed to "hash" when read back in
+        write_hash_store(data_frame, output_path, get_hash_column_name(compare_mode))
+        return
     # https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.to_csv.html
     # Use tabs as separators
     # double-quote around all non-numeric fields, just to keep things standardized
     # Don't allow double-quotes inside fields without escaping
     # Use a backslash \ character to escape separators or double quotes inside fields
     # Don't prepend a field containing the row index
-    data_frame.to_csv(output_path, sep="\t", quoting=QUOTE_NONNUMERIC, doublequote=False, escapechar="\\", index=False)
+    # Rows are formatted a batch at a time straight into the compressor rather than the whole file at once
+    with open_hash_text_file(output_path, "w", compression_level, compression_threads) as stream:
+        data_frame.to_csv(stream, sep="\t", quoting=QUOTE_NONNUMERIC, doublequote=False, escapechar="\\", index=False,
+                          lineterminator="\n")
+
+
+# Given the path to a hash file sorted by relative path, yield a Tuple of (relative_path, hash, file_size_bytes) for
+# each row in file order, without ever holding more than one chunk of rows in memory
+def iterate_hash_file_rows(input_path, logger, compare_mode):
+    input_path = sanitize_and_validate_file_path(input_path, logger)
+    if is_hash_store_path(input_path):
+        # Rows of a binary hash store are decoded one at a time from the memory mapped file
+        hash_store_reader = HashStoreReader(input_path)
+        for row_index in range(hash_store_reader.row_count):
+            yield (hash_store_reader.get_relative_path(row_index), hash_store_reader.get_hex_hash(row_index),
+                   int(hash_store_reader.file_sizes[row_index]))
+        return
+    # Parsing a chunk of rows at a time with pandas and only the three columns needed is much faster than the csv module
+    for data_frame in iterate_hash_file_chunks(input_path, logger, compare_mode,
+                                               ["relative_path", "hash", "file_size_bytes"]):
+        yield from zip(data_frame["relative_path"], data_frame["hash"], map(int, data_frame["file_size_bytes"]))
+
+
+# Writes rows to a delimited hash file one at a time, in the same format as write_hashes_to_file(), so outputs can be
+# produced without building a DataFrame first. Use as a context manager to close the file when done
+class HashFileRowWriter:
+    def __init__(self, output_path, column_names, logger, compression_level=None, compression_threads=1):
+        output_path = sanitize_and_validate_file_path(output_path, logger)
+        if is_hash_store_path(output_path):
+            message = "Output {} can't be written row by row as a binary hash store, use a delimited file " \
+                      "instead".format(output_path)
+            logger.error(message)
+            raise ValueError(message)
+        self.output_path = output_path
+        self.stream = open_hash_text_file(output_path, "w", compression_level, compression_threads)
+        self.row_writer = writer(self.stream, delimiter="\t", quoting=QUOTE_NONNUMERIC, doublequote=False,
+                                 escapechar="\\", lineterminator="\n")
+        self.row_writer.writerow(column_names)
+        self.row_count = 0
+
+    def write_row(self, row):
+        self.row_writer.writerow(row)
+        self.row_count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()
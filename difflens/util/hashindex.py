@@ -0,0 +1,143 @@
+# Used to store the index in an embedded database file, so it can be queried without reading any hash files
+# https://docs.python.org/3/library/sqlite3.html
+import sqlite3
+# Used to record when each run was indexed
+from time import time
+
+from .compareMode import CompareMode
+from .scanaccumulator import NOT_COMPUTED
+
+# Statements creating the index tables if they don't exist yet:
+# - settings holds key/value pairs, such as the compare_mode every run in the index must share
+# - runs has one row per scan root indexed, numbered in the order they were indexed
+# - files has the latest known state of every file of every root. Hashes are stored as raw 32-byte digests, or NULL when
+#   not computed, and looked up through an index so finding where a hash lives doesn't scan the table
+# - changes logs every file added, removed, or modified by each run, so changes since any run can be listed
+SCHEMA_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, root_name TEXT NOT NULL, "
+    "indexed_time_s INTEGER NOT NULL, file_count INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS files (root_name TEXT NOT NULL, relative_path TEXT NOT NULL, hash BLOB, "
+    "file_size_bytes INTEGER NOT NULL, modified_time_ns INTEGER, changed_run_id INTEGER NOT NULL, "
+    "PRIMARY KEY (root_name, relative_path)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS files_hash ON files (hash)",
+    "CREATE TABLE IF NOT EXISTS changes (run_id INTEGER NOT NULL, root_name TEXT NOT NULL, "
+    "relative_path TEXT NOT NULL, change_type TEXT NOT NULL, hash BLOB)",
+    "CREATE INDEX IF NOT EXISTS changes_run_id ON changes (run_id)"
+]
+
+
+# Convert a hex hash to the digest stored in the index, or None if it was not computed
+def hex_to_digest(hex_hash):
+    if hex_hash == NOT_COMPUTED:
+        return None
+    return bytes.fromhex(hex_hash)
+
+
+# Convert a digest stored in the index back to a hex hash
+def digest_to_hex(digest):
+    if digest is None:
+        return NOT_COMPUTED
+    return digest.hex()
+
+
+# A persistent index of the hashes of every file across every scan root, stored in a SQLite database. Each root is
+# updated after it is scanned by comparing the scan to what the index last saw, so only changed files are written
+class HashIndex:
+    # compare_mode may be None when only querying the index
+    def __init__(self, database_path, compare_mode, logger):
+        self.logger = logger
+        self.connection = sqlite3.connect(database_path)
+        with self.connection:
+            for statement in SCHEMA_STATEMENTS:
+                self.connection.execute(statement)
+            # The first compare_mode used decides what hashes the index holds, as mixing them would break lookups
+            if compare_mode is not None:
+                self.connection.execute("INSERT OR IGNORE INTO settings VALUES ('compare_mode', ?)", (compare_mode,))
+        setting_row = self.connection.execute("SELECT value FROM settings WHERE key = 'compare_mode'").fetchone()
+        self.compare_mode = None if setting_row is None else setting_row[0]
+        if compare_mode is not None and compare_mode != self.compare_mode:
+            message = "Index {} holds hashes from compare_mode {}, not {}".format(database_path, self.compare_mode,
+                                                                                  compare_mode)
+            logger.error(message)
+            raise ValueError(message)
+
+    def close(self):
+        self.connection.close()
+
+    # Replace what the index knows about root_name with the rows of data_frame, which has the columns of a hash file.
+    # Files that were added, removed, or had their hash change are logged under a new run. Returns the run's ID
+    def update_root(self, root_name, data_frame):
+        start_time = time()
+        with self.connection:
+            run_id = self.connection.execute("INSERT INTO runs (root_name, indexed_time_s, file_count) VALUES "
+                                             "(?, ?, ?)", (root_name, int(start_time), len(data_frame.index))).lastrowid
+            # Load the scan into a temporary table so it can be compared to the index with a few set operations
+            self.connection.execute("CREATE TEMP TABLE scan (relative_path TEXT PRIMARY KEY, hash BLOB, "
+                                    "file_size_bytes INTEGER NOT NULL, modified_time_ns INTEGER)")
+            modified_times = data_frame["modified_time_ns"] if "modified_time_ns" in data_frame.columns \
+                else [None] * len(data_frame.index)
+            self.connection.executemany("INSERT INTO scan VALUES (?, ?, ?, ?)", zip(
+                data_frame["relative_path"], map(hex_to_digest, data_frame["hash"]),
+                map(int, data_frame["file_size_bytes"]),
+                (None if modified_time is None else int(modified_time) for modified_time in modified_times)))
+            self.connection.execute(
+                "INSERT INTO changes SELECT ?, ?, scan.relative_path, 'added', scan.hash FROM scan LEFT JOIN files "
+                "ON files.root_name = ? AND files.relative_path = scan.relative_path WHERE files.relative_path IS NULL",
+                (run_id, root_name, root_name))
+            self.connection.execute(
+                "INSERT INTO changes SELECT ?, ?, scan.relative_path, 'modified', scan.hash FROM scan JOIN files "
+                "ON files.root_name = ? AND files.relative_path = scan.relative_path "
+                "WHERE files.hash IS NOT scan.hash", (run_id, root_name, root_name))
+            self.connection.execute(
+                "INSERT INTO changes SELECT ?, ?, relative_path, 'removed', hash FROM files WHERE root_name = ? "
+                "AND relative_path NOT IN (SELECT relative_path FROM scan)", (run_id, root_name, root_name))
+            # Apply the changes just logged, then refresh the size and modified time of unchanged files
+            self.connection.execute("DELETE FROM files WHERE root_name = ? AND relative_path IN (SELECT relative_path "
+                                    "FROM changes WHERE run_id = ? AND change_type = 'removed')", (root_name, run_id))
+            self.connection.execute(
+                "INSERT INTO files SELECT ?, scan.relative_path, scan.hash, scan.file_size_bytes, "
+                "scan.modified_time_ns, ? FROM scan WHERE true ON CONFLICT (root_name, relative_path) DO UPDATE SET "
+                "hash = excluded.hash, file_size_bytes = excluded.file_size_bytes, "
+                "modified_time_ns = excluded.modified_time_ns, changed_run_id = CASE WHEN files.hash IS excluded.hash "
+                "THEN files.changed_run_id ELSE excluded.changed_run_id END", (root_name, run_id))
+            self.connection.execute("DROP TABLE temp.scan")
+        change_counts = dict(self.connection.execute(
+            "SELECT change_type, COUNT(*) FROM changes WHERE run_id = ? GROUP BY change_type", (run_id,)).fetchall())
+        self.logger.info("Indexed {} files of {} as run {} in {:.2f} seconds: {} added, {} removed, {} modified".format(
+            len(data_frame.index), root_name, run_id, time() - start_time, change_counts.get("added", 0),
+            change_counts.get("removed", 0), change_counts.get("modified", 0)))
+        return run_id
+
+    # Return a list of (run_id, root_name, indexed_time_s, file_count) for every run, oldest first
+    def get_runs(self):
+        return self.connection.execute("SELECT run_id, root_name, indexed_time_s, file_count FROM runs "
+                                       "ORDER BY run_id").fetchall()
+
+    # Return a list of (root_name, relative_path, hash, file_size_bytes) for every file with the given hex hash
+    def find_hash(self, hex_hash):
+        return [(root_name, relative_path, digest_to_hex(digest), file_size_bytes)
+                for root_name, relative_path, digest, file_size_bytes in self.connection.execute(
+                    "SELECT root_name, relative_path, hash, file_size_bytes FROM files WHERE hash = ? "
+                    "ORDER BY root_name, relative_path", (hex_to_digest(hex_hash),))]
+
+    # Yield (hash, root_name, relative_path, file_size_bytes) for every file sharing its hash with another file, grouped
+    # by hash. Like determine_duplicate_files(), files sharing a size are duplicates when hashes weren't computed
+    def iterate_duplicates(self):
+        if self.compare_mode == CompareMode.SIZE.value:
+            query = "SELECT hash, root_name, relative_path, file_size_bytes FROM files WHERE file_size_bytes IN " \
+                    "(SELECT file_size_bytes FROM files GROUP BY file_size_bytes HAVING COUNT(*) > 1) " \
+                    "ORDER BY file_size_bytes, root_name, relative_path"
+        else:
+            query = "SELECT hash, root_name, relative_path, file_size_bytes FROM files WHERE hash IN " \
+                    "(SELECT hash FROM files WHERE hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1) " \
+                    "ORDER BY hash, root_name, relative_path"
+        for digest, root_name, relative_path, file_size_bytes in self.connection.execute(query):
+            yield digest_to_hex(digest), root_name, relative_path, file_size_bytes
+
+    # Yield (run_id, root_name, relative_path, change_type, hash) for every change logged by runs after run_id
+    def iterate_changes_since(self, run_id):
+        for change_run_id, root_name, relative_path, change_type, digest in self.connection.execute(
+                "SELECT run_id, root_name, relative_path, change_type, hash FROM changes WHERE run_id > ? "
+                "ORDER BY run_id, relative_path", (run_id,)):
+            yield change_run_id, root_name, relative_path, change_type, digest_to_hex(digest)
@@ -0,0 +1,106 @@
+# Used to run hashing on worker threads. BLAKE3 releases the GIL while hashing, so threads can hash concurrently
+from concurrent.futures import Future, ThreadPoolExecutor
+# Used to queue up work for each device until one of its reader slots is free
+from collections import deque
+# Used to find the block device backing a file
+from os import major, minor, path
+# Used to guard the reader slots and queues of every device
+from threading import Lock
+
+from .loghelper import get_logger_with_name
+
+
+# Look up whether the block device with the given device ID is a spinning disk. Partitions don't have their own queue
+# directory, so fall back to the queue of the parent device. Return None if it could not be determined, which is the
+# case for network, FUSE, or in-memory filesystems as well as non-Linux systems
+# https://www.kernel.org/doc/Documentation/block/queue-sysfs.txt
+def is_rotational_device(device):
+    device_sysfs_path = "/sys/dev/block/{}:{}".format(major(device), minor(device))
+    for queue_path in [path.join(device_sysfs_path, "queue", "rotational"),
+                       path.join(device_sysfs_path, "..", "queue", "rotational")]:
+        try:
+            with open(queue_path, "r") as stream:
+                return stream.read().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+
+# Work waiting to read from one device, along with how many readers it allows and how many are reading right now
+class DeviceQueue:
+    def __init__(self, reader_count):
+        self.reader_count = reader_count
+        self.active_readers = 0
+        # Deque of Tuples of (Future, function, args) in the order they were submitted
+        self.pending = deque()
+
+
+# Runs hashing work on a pool of threads while limiting how many threads may read from the same device at once, so
+# spinning disks are read by a single thread while solid state disks are read by several. Work only takes a thread
+# once its device has a free reader slot, so work queued up for a busy disk never holds threads other disks could use
+class HashingEngine:
+    def __init__(self, hash_workers, rotational_device_readers, solid_state_device_readers, log_level):
+        self.logger = get_logger_with_name("HashingEngine", log_level)
+        self.hash_workers = hash_workers
+        self.rotational_device_readers = rotational_device_readers
+        self.solid_state_device_readers = solid_state_device_readers
+        # https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+        self.executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="difflens-hash")
+        # Dict of {key:device_id, value:DeviceQueue} created as new devices are encountered
+        self.device_queue_dict = {}
+        self.device_queue_lock = Lock()
+        self.logger.info("HashingEngine initialized with {} workers, allowing {} concurrent readers per rotational "
+                         "device and {} per solid state device".format(hash_workers, rotational_device_readers,
+                                                                       solid_state_device_readers))
+
+    # Get or create the queue for a device, allowing readers based on whether the device spins or not. Must be called
+    # with device_queue_lock held
+    def get_device_queue(self, device):
+        if device not in self.device_queue_dict:
+            rotational = is_rotational_device(device)
+            # Treat devices of unknown type as spinning disks, as too many readers hurts them the most
+            if rotational is False:
+                reader_count = self.solid_state_device_readers
+            else:
+                reader_count = self.rotational_device_readers
+            self.logger.info("Allowing {} concurrent readers on device {}:{} (rotational: {})".format(
+                reader_count, major(device), minor(device), "unknown" if rotational is None else rotational))
+            self.device_queue_dict[device] = DeviceQueue(reader_count)
+        return self.device_queue_dict[device]
+
+    # Run the function on a worker thread once a reader slot on the device is free, returning a Future for its result
+    # https://docs.python.org/3/library/concurrent.futures.html#future-objects
+    def submit(self, device, function, *args):
+        future = Future()
+        with self.device_queue_lock:
+            device_queue = self.get_device_queue(device)
+            device_queue.pending.append((future, function, args))
+            self.dispatch(device_queue)
+        return future
+
+    # Hand queued work of the device to the pool while it has free reader slots. Must be called with device_queue_lock
+    # held
+    def dispatch(self, device_queue):
+        while device_queue.pending and device_queue.active_readers < device_queue.reader_count:
+            device_queue.active_readers += 1
+            self.executor.submit(self.run_in_device_slot, device_queue, *device_queue.pending.popleft())
+
+    # Run the function in one of the device's reader slots, then free the slot for the next queued work of the device
+    def run_in_device_slot(self, device_queue, future, function, args):
+        try:
+            result = function(*args)
+        except BaseException as exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+        finally:
+            with self.device_queue_lock:
+                device_queue.active_readers -= 1
+                self.dispatch(device_queue)
+
+    # Maximum amount of files that should be queued up at once, enough to keep every worker busy
+    def get_pending_limit(self):
+        return self.hash_workers * 4
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,194 @@
+# Used to memory map hash stores so columns can be read without parsing the whole file
+import mmap
+# Used to pack and unpack the fixed-size header at the start of a hash store
+from struct import Struct
+
+# Used to view the fixed-width columns of a memory mapped hash store as arrays without copying them
+import numpy
+# Used to create DataFrames
+from pandas import DataFrame
+
+from .carryforward import METADATA_COLUMNS
+from .scanaccumulator import DIGEST_BYTES, NOT_COMPUTED, PATH_ENCODING, PATH_ERRORS
+
+# File extension that selects the binary hash store format instead of a delimited text file
+HASH_STORE_EXTENSION = ".dlh"
+
+# Layout of the header: magic, version, flags, row count, directory count, hash column name, names blob size, and
+# directories blob size, padded out to 64 bytes. All values are little-endian
+# https://docs.python.org/3/library/struct.html#format-characters
+HEADER_STRUCT = Struct("<4sHHQQ16sQQ8x")
+HEADER_MAGIC = b"DLHS"
+HEADER_VERSION = 1
+# Flag set when the hash column holds 64-character hex digests, stored as raw 32-byte digests
+FLAG_HAS_DIGESTS = 1
+# Flag set when the modified_time_ns, inode, and device columns are stored
+FLAG_HAS_METADATA = 2
+
+INT64 = numpy.dtype("<i8")
+UINT32 = numpy.dtype("<u4")
+
+
+# Return True if the path should be read or written as a binary hash store based on its extension
+def is_hash_store_path(file_path):
+    return file_path.endswith(HASH_STORE_EXTENSION)
+
+
+# Round a byte offset up to the next multiple of 8 so every column starts aligned
+def align_offset(offset):
+    return (offset + 7) // 8 * 8
+
+
+# Join strings into one encoded blob and return it along with the (count+1) offsets of where each one starts and ends
+def build_string_table(strings):
+    encoded_strings = [string.encode(PATH_ENCODING, PATH_ERRORS) for string in strings]
+    offsets = numpy.zeros(len(encoded_strings) + 1, dtype=INT64)
+    # https://numpy.org/doc/stable/reference/generated/numpy.cumsum.html
+    numpy.cumsum([len(encoded_string) for encoded_string in encoded_strings], out=offsets[1:])
+    return b"".join(encoded_strings), offsets
+
+
+# Write a DataFrame with columns relative_path, hash, and file_size_bytes, plus optionally the metadata columns, to
+# output_path as a binary hash store. hash_column_name is the name of the hash column, such as full_hash
+def write_hash_store(data_frame, output_path, hash_column_name):
+    required_columns = ["relative_path", hash_column_name, "file_size_bytes"]
+    missing_columns = [column for column in required_columns if column not in data_frame.columns]
+    if missing_columns:
+        raise ValueError("Columns {} are required to write a {} hash store".format(missing_columns,
+                                                                                   HASH_STORE_EXTENSION))
+    supported_columns = required_columns + METADATA_COLUMNS
+    unsupported_columns = [column for column in data_frame.columns if column not in supported_columns]
+    if unsupported_columns:
+        raise ValueError("Columns {} can't be stored in a {} hash store, use a delimited file instead".format(
+            unsupported_columns, HASH_STORE_EXTENSION))
+    row_count = len(data_frame.index)
+    flags = 0
+    hash_strings = data_frame[hash_column_name].tolist()
+    if hash_strings and all(len(hash_string) == DIGEST_BYTES * 2 for hash_string in hash_strings):
+        flags |= FLAG_HAS_DIGESTS
+    elif any(hash_string != NOT_COMPUTED for hash_string in hash_strings):
+        raise ValueError("Column {} must contain 64-character hex digests or {} to be stored in a {} hash "
+                         "store".format(hash_column_name, NOT_COMPUTED, HASH_STORE_EXTENSION))
+    if all(column in data_frame.columns for column in METADATA_COLUMNS) \
+            and not data_frame[METADATA_COLUMNS].isna().any().any():
+        flags |= FLAG_HAS_METADATA
+
+    # Split each relative path into its directory, stored once per unique directory, and its file name
+    directory_index_dict = {}
+    directory_indexes = numpy.empty(row_count, dtype=UINT32)
+    file_names = []
+    for row_index, relative_path in enumerate(data_frame["relative_path"]):
+        directory, _, file_name = relative_path.rpartition("/")
+        directory_indexes[row_index] = directory_index_dict.setdefault(directory, len(directory_index_dict))
+        file_names.append(file_name)
+    names_blob, name_offsets = build_string_table(file_names)
+    directories_blob, directory_offsets = build_string_table(directory_index_dict.keys())
+
+    # Collect the sections in the order they're stored, each starting on an 8-byte boundary
+    sections = []
+    if flags & FLAG_HAS_DIGESTS:
+        # https://docs.python.org/3/library/stdtypes.html#bytes.fromhex
+        sections.append(bytes.fromhex("".join(hash_strings)))
+    sections.append(data_frame["file_size_bytes"].to_numpy(dtype=INT64).tobytes())
+    if flags & FLAG_HAS_METADATA:
+        for column in METADATA_COLUMNS:
+            sections.append(data_frame[column].to_numpy(dtype=INT64).tobytes())
+    sections.extend([directory_indexes.tobytes(), name_offsets.tobytes(), directory_offsets.tobytes(), names_blob,
+                     directories_blob])
+    with open(output_path, "wb") as stream:
+        stream.write(HEADER_STRUCT.pack(HEADER_MAGIC, HEADER_VERSION, flags, row_count, len(directory_index_dict),
+                                        hash_column_name.encode("ascii"), len(names_blob), len(directories_blob)))
+        for section in sections:
+            stream.write(section)
+            stream.write(b"\0" * (align_offset(len(section)) - len(section)))
+
+
+# Memory maps a binary hash store, exposing its fixed-width columns as zero-copy numpy arrays. Paths and hex hashes are
+# only decoded when asked for, so tools that need just sizes or digests never pay for the rest
+class HashStoreReader:
+    def __init__(self, input_path):
+        with open(input_path, "rb") as stream:
+            # https://docs.python.org/3/library/mmap.html
+            self.buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.flags, self.row_count, self.directory_count, hash_column_name, names_blob_size,
+         directories_blob_size) = HEADER_STRUCT.unpack_from(self.buffer, 0)
+        if magic != HEADER_MAGIC or version != HEADER_VERSION:
+            raise ValueError("File {} is not a version {} difflens hash store".format(input_path, HEADER_VERSION))
+        self.hash_column_name = hash_column_name.rstrip(b"\0").decode("ascii")
+        offset = HEADER_STRUCT.size
+        self.digests = None
+        if self.flags & FLAG_HAS_DIGESTS:
+            # View the digests as a (row_count, 32) array of bytes
+            self.digests = numpy.frombuffer(self.buffer, dtype=numpy.uint8, count=self.row_count * DIGEST_BYTES,
+                                            offset=offset).reshape(self.row_count, DIGEST_BYTES)
+            offset = align_offset(offset + self.row_count * DIGEST_BYTES)
+        self.file_sizes, offset = self.view_column(INT64, self.row_count, offset)
+        self.metadata_dict = {}
+        if self.flags & FLAG_HAS_METADATA:
+            for column in METADATA_COLUMNS:
+                self.metadata_dict[column], offset = self.view_column(INT64, self.row_count, offset)
+        self.directory_indexes, offset = self.view_column(UINT32, self.row_count, offset)
+        self.name_offsets, offset = self.view_column(INT64, self.row_count + 1, offset)
+        self.directory_offsets, offset = self.view_column(INT64, self.directory_count + 1, offset)
+        self.names_offset = offset
+        self.directories_offset = align_offset(offset + names_blob_size)
+        self.directories = None
+
+    # Create a numpy array viewing count values of dtype at offset in the mapped file, returning it and the offset of
+    # the next section
+    def view_column(self, dtype, count, offset):
+        column = numpy.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset)
+        return column, align_offset(offset + count * dtype.itemsize)
+
+    # Decode a string from a table of strings stored at table_offset
+    def decode_string(self, table_offset, string_offsets, index):
+        start = table_offset + int(string_offsets[index])
+        end = table_offset + int(string_offsets[index + 1])
+        return self.buffer[start:end].decode(PATH_ENCODING, PATH_ERRORS)
+
+    # Return the list of unique directories, decoding them the first time they're needed
+    def get_directories(self):
+        if self.directories is None:
+            self.directories = [self.decode_string(self.directories_offset, self.directory_offsets, index)
+                                for index in range(self.directory_count)]
+        return self.directories
+
+    # Rebuild the relative path of a single row from its directory and file name
+    def get_relative_path(self, row_index):
+        directory = self.get_directories()[self.directory_indexes[row_index]]
+        file_name = self.decode_string(self.names_offset, self.name_offsets, row_index)
+        return directory + "/" + file_name if directory else file_name
+
+    # Return the list of every relative path, in row order
+    def get_relative_paths(self):
+        directories = self.get_directories()
+        names_blob = self.buffer[self.names_offset:self.names_offset + int(self.name_offsets[-1])]
+        name_offsets = self.name_offsets.tolist()
+        relative_paths = []
+        for directory_index, start, end in zip(self.directory_indexes.tolist(), name_offsets, name_offsets[1:]):
+            directory = directories[directory_index]
+            file_name = names_blob[start:end].decode(PATH_ENCODING, PATH_ERRORS)
+            relative_paths.append(directory + "/" + file_name if directory else file_name)
+        return relative_paths
+
+    # Return the hash of a single row as a 64-character hex string
+    def get_hex_hash(self, row_index):
+        if self.digests is None:
+            return NOT_COMPUTED
+        return self.digests[row_index].tobytes().hex()
+
+    # Return the list of every hash as a 64-character hex string, in row order
+    def get_hex_hashes(self):
+        if self.digests is None:
+            return [NOT_COMPUTED] * self.row_count
+        hex_string = self.digests.tobytes().hex()
+        return [hex_string[index:index + DIGEST_BYTES * 2] for index in range(0, len(hex_string), DIGEST_BYTES * 2)]
+
+    # Build a DataFrame with the same columns a delimited hash file would have
+    def to_data_frame(self):
+        data_frame = DataFrame({"relative_path": self.get_relative_paths(),
+                                self.hash_column_name: self.get_hex_hashes(),
+                                "file_size_bytes": numpy.array(self.file_sizes)})
+        for column, values in self.metadata_dict.items():
+            data_frame[column] = numpy.array(values)
+        return data_frame
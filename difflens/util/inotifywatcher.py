@@ -0,0 +1,200 @@
+# Used to call inotify through the C library, as the standard library has no binding for it
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+import ctypes
+from ctypes.util import find_library
+# Used to tell apart why a watch couldn't be added
+from errno import ENOENT, ENOSPC, ENOTDIR
+# Used to read events, list directories being watched, and convert names between bytes and str
+from os import close, fsdecode, fsencode, path, read, scandir, strerror
+# Used to wait for events without spinning, waking up in time to flush the journals
+from select import POLLIN, poll
+# Used to unpack the fixed-size header of each event
+from struct import Struct
+# Used to decide when enough time has passed to flush the journals
+from time import time
+
+from .dirtyjournal import DIRTY_FILE_RECORD, DIRTY_TREE_RECORD, OVERFLOW_RECORD
+
+# Flags from <sys/inotify.h>, the events each watch reports and the flags describing an event
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+# Flags of inotify_init1(), which have the same values as O_NONBLOCK and O_CLOEXEC
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Every change that can make a file's size, modification time, inode, or contents differ from the last scan, along
+# with directories being created, moved, or deleted. Links aren't followed, as the scan doesn't follow them either
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of NUL-padded name
+EVENT_HEADER_STRUCT = Struct("=iIII")
+# Bytes read from the inotify file descriptor at a time, enough for hundreds of events
+EVENT_BUFFER_BYTES = 2 ** 16
+
+
+# Watches directory trees with inotify and records every path that changes to the dirty journal of the tree it's in, so
+# the next scan only has to look at those. Every directory in a tree needs its own watch, so directories created or
+# moved into a tree are watched as they appear. Whenever changes may have been missed, such as when the kernel's event
+# queue overflows or the fs.inotify.max_user_watches limit is reached, an overflow is recorded so the next scan walks
+# the whole tree instead
+class InotifyWatcher:
+    # root_directories is a list of absolute directory paths, and journal_writers the DirtyJournalWriter of each
+    def __init__(self, root_directories, journal_writers, logger):
+        self.root_directories = root_directories
+        self.journal_writers = journal_writers
+        self.logger = logger
+        # https://docs.python.org/3/library/ctypes.html#ctypes.get_errno
+        self.libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        self.inotify_fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, strerror(error_number))
+        # Dict of {key:watch descriptor, value:(root_index, absolute_dir_path)}, and the reverse lookup of
+        # {key:absolute_dir_path, value:watch descriptor} for removing the watches of a directory moved away
+        self.watch_dict = {}
+        self.watch_descriptor_dict = {}
+        # Dict of {key:root_index, value:reason} for trees that can't be fully watched, whose journals get an overflow
+        # recorded each time they're flushed until the watcher is restarted
+        self.incomplete_root_dict = {}
+
+    # Watch directory_path and every directory under it, returning the amount of watches added
+    def add_watches(self, root_index, directory_path):
+        watches_added = 0
+        directory_stack = [directory_path]
+        while directory_stack:
+            abs_dir_path = directory_stack.pop()
+            watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, fsencode(abs_dir_path), WATCH_MASK)
+            if watch_descriptor < 0:
+                error_number = ctypes.get_errno()
+                # A directory deleted or replaced before its watch was added is recorded by the watch of its parent
+                if error_number in [ENOENT, ENOTDIR]:
+                    continue
+                reason = "could not watch {}: {}".format(abs_dir_path, strerror(error_number))
+                if error_number == ENOSPC:
+                    reason += ", raise fs.inotify.max_user_watches to watch every directory"
+                self.logger.error("Changes under {} can't all be recorded as the watcher {}".format(
+                    self.root_directories[root_index], reason))
+                self.incomplete_root_dict[root_index] = reason
+                continue
+            self.watch_dict[watch_descriptor] = (root_index, abs_dir_path)
+            self.watch_descriptor_dict[abs_dir_path] = watch_descriptor
+            watches_added += 1
+            try:
+                with scandir(abs_dir_path) as entries:
+                    directory_stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError as error:
+                # The directory was watched, so if it was deleted in the meantime, its parent's watch recorded that
+                self.logger.warning("Could not list directory {} to watch what's under it: {}".format(
+                    abs_dir_path, error))
+        return watches_added
+
+    # Stop watching directory_path and every directory under it, such as after it was moved away or deleted
+    def remove_watches(self, directory_path):
+        prefix = directory_path + "/"
+        for abs_dir_path in [abs_dir_path for abs_dir_path in self.watch_descriptor_dict
+                             if abs_dir_path == directory_path or abs_dir_path.startswith(prefix)]:
+            watch_descriptor = self.watch_descriptor_dict.pop(abs_dir_path)
+            self.watch_dict.pop(watch_descriptor, None)
+            # Fails harmlessly if the kernel already removed the watch, as it does for deleted directories
+            self.libc.inotify_rm_watch(self.inotify_fd, watch_descriptor)
+
+    # Record that changes under a root may have been missed, so the next scan walks it
+    def record_overflow(self, root_index, reason):
+        self.logger.warning("Recording an overflow for {}, as {}".format(self.root_directories[root_index], reason))
+        self.journal_writers[root_index].record(OVERFLOW_RECORD, reason)
+
+    # Record what one event says changed
+    def handle_event(self, watch_descriptor, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            for root_index in range(len(self.root_directories)):
+                self.record_overflow(root_index, "the inotify event queue overflowed")
+            return
+        watch_entry = self.watch_dict.get(watch_descriptor)
+        if watch_entry is None:
+            # Events still queued for a watch that was removed
+            return
+        root_index, abs_dir_path = watch_entry
+        is_root = abs_dir_path == self.root_directories[root_index]
+        if mask & IN_IGNORED:
+            self.watch_dict.pop(watch_descriptor)
+            if self.watch_descriptor_dict.get(abs_dir_path) == watch_descriptor:
+                self.watch_descriptor_dict.pop(abs_dir_path)
+            if is_root:
+                self.incomplete_root_dict[root_index] = "the watched directory was removed"
+            return
+        if mask & IN_UNMOUNT or is_root and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.incomplete_root_dict[root_index] = "the watched directory was moved, removed, or unmounted"
+            return
+        if not name:
+            # Other events about the directory itself are reported by the watch of its parent
+            return
+        changed_path = path.join(abs_dir_path, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_watches(root_index, changed_path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_watches(changed_path)
+            else:
+                # Metadata of a directory doesn't affect the files under it
+                return
+            self.journal_writers[root_index].record(DIRTY_TREE_RECORD, changed_path)
+        else:
+            self.journal_writers[root_index].record(DIRTY_FILE_RECORD, changed_path)
+
+    # Read and handle every event that's waiting, returning the amount handled
+    def handle_waiting_events(self):
+        events_handled = 0
+        while True:
+            try:
+                buffer = read(self.inotify_fd, EVENT_BUFFER_BYTES)
+            except BlockingIOError:
+                return events_handled
+            offset = 0
+            while offset < len(buffer):
+                watch_descriptor, mask, _, name_length = EVENT_HEADER_STRUCT.unpack_from(buffer, offset)
+                offset += EVENT_HEADER_STRUCT.size
+                name = fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                self.handle_event(watch_descriptor, mask, name)
+                events_handled += 1
+
+    # Append what's been recorded to each journal, along with an overflow for trees that can't be fully watched
+    def flush(self):
+        for root_index, reason in self.incomplete_root_dict.items():
+            self.journal_writers[root_index].record(OVERFLOW_RECORD, reason)
+        for journal_writer in self.journal_writers:
+            journal_writer.flush()
+
+    # Handle events until interrupted, flushing the journals every flush_interval_seconds. The journals are flushed
+    # one last time on the way out, including when interrupted
+    def run(self, flush_interval_seconds):
+        poller = poll()
+        poller.register(self.inotify_fd, POLLIN)
+        next_flush_time = time() + flush_interval_seconds
+        try:
+            while True:
+                # https://docs.python.org/3/library/select.html#select.poll.poll
+                poller.poll(max(next_flush_time - time(), 0) * 1000)
+                self.handle_waiting_events()
+                if time() >= next_flush_time:
+                    self.flush()
+                    next_flush_time = time() + flush_interval_seconds
+        finally:
+            self.handle_waiting_events()
+            self.flush()
+
+    def close(self):
+        close(self.inotify_fd)
@@ -0,0 +1,291 @@
+# Used to write metrics in a machine-readable format
+import json
+# Used to write metrics files atomically, so a reader never sees a half written one
+from os import getpid, path, replace
+# Used to read the peak resident memory of the process, which the kernel tracks for us
+import resource
+# Used to tell which unit the peak resident memory is reported in
+from sys import platform
+# Used to time each phase in both wall clock and CPU time
+from time import perf_counter, process_time, time
+# Used to time each phase with a with statement
+from contextlib import contextmanager
+# Used to keep only the slowest files in memory
+from heapq import heappush, heappushpop
+# Used to let root threads and hashing threads record metrics at the same time
+from threading import Lock
+
+# Upper bounds in bytes of the file size buckets that hashing throughput is recorded in, with a last bucket for
+# anything larger
+SIZE_BUCKET_BOUNDS = [2 ** 12, 2 ** 16, 2 ** 20, 2 ** 24, 2 ** 28, 2 ** 32]
+SIZE_BUCKET_NAMES = ["0-4KiB", "4KiB-64KiB", "64KiB-1MiB", "1MiB-16MiB", "16MiB-256MiB", "256MiB-4GiB", "4GiB+"]
+# Amount of the slowest files kept for the JSON output
+SLOWEST_FILE_COUNT = 10
+# Prefix of every Prometheus metric name
+PROMETHEUS_PREFIX = "difflens_"
+
+
+# Return the most resident memory this process has used so far, in bytes
+# https://docs.python.org/3/library/resource.html#resource.getrusage
+def get_peak_rss_bytes():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports ru_maxrss in KB, while macOS reports it in bytes
+    return peak_rss if platform == "darwin" else peak_rss * 1024
+
+
+# Return the index of the SIZE_BUCKET_BOUNDS bucket a file of file_size_bytes falls in
+def get_size_bucket(file_size_bytes):
+    for bucket_index, bucket_bound in enumerate(SIZE_BUCKET_BOUNDS):
+        if file_size_bytes <= bucket_bound:
+            return bucket_index
+    return len(SIZE_BUCKET_BOUNDS)
+
+
+# Escape a Prometheus label value, which is quoted and may not contain raw backslashes, quotes, or line breaks
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-format-details
+def escape_label_value(label_value):
+    return str(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Write contents to output_path by writing a temporary file next to it and renaming it over output_path, which the
+# Prometheus node_exporter textfile collector needs so it never reads a partially written file
+def write_file_atomically(output_path, contents):
+    temporary_path = "{}.{}.tmp".format(output_path, getpid())
+    with open(temporary_path, "w") as stream:
+        stream.write(contents)
+    replace(temporary_path, output_path)
+
+
+# Metrics of one scanned root directory, or of the run as a whole when root_name is None: wall clock and CPU time,
+# files, bytes, and peak memory of each phase, hashing throughput of files by size, the slowest files, and errors.
+# CPU time is that of the whole process, so phases of roots scanned concurrently each include the others' CPU time
+class ScanMetrics:
+    def __init__(self, root_name, slow_file_seconds, logger):
+        self.root_name = root_name
+        self.slow_file_seconds = slow_file_seconds
+        self.logger = logger
+        self.lock = Lock()
+        # Dict of {key:phase_name, value:Dict of phase totals}, in the order phases were first entered
+        self.phase_dict = {}
+        # Files hashed, bytes read, and seconds spent hashing in each size bucket
+        self.bucket_files = [0] * len(SIZE_BUCKET_NAMES)
+        self.bucket_bytes = [0] * len(SIZE_BUCKET_NAMES)
+        self.bucket_seconds = [0.0] * len(SIZE_BUCKET_NAMES)
+        self.slow_file_count = 0
+        # Min-heap of (seconds, absolute_path, file_size_bytes) of the slowest files seen
+        self.slowest_files = []
+        # Dict of {key:error name, value:count}
+        self.error_dict = {}
+        # Progress of the scan as of the last progress update
+        self.files_seen = self.directories_seen = self.bytes_read = 0
+        # Called with no arguments after every progress update, such as to write the metrics files out
+        self.progress_callback = None
+
+    def get_phase(self, phase_name):
+        if phase_name not in self.phase_dict:
+            self.phase_dict[phase_name] = {"runs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "files": 0, "bytes": 0,
+                                           "peak_rss_bytes": 0}
+        return self.phase_dict[phase_name]
+
+    # Time the body of a with statement as phase_name, adding to the totals of any earlier runs of the same phase
+    @contextmanager
+    def phase(self, phase_name):
+        start_time = perf_counter()
+        start_cpu_time = process_time()
+        try:
+            yield
+        finally:
+            wall_seconds = perf_counter() - start_time
+            cpu_seconds = process_time() - start_cpu_time
+            peak_rss_bytes = get_peak_rss_bytes()
+            with self.lock:
+                phase_totals = self.get_phase(phase_name)
+                phase_totals["runs"] += 1
+                phase_totals["wall_seconds"] += wall_seconds
+                phase_totals["cpu_seconds"] += cpu_seconds
+                phase_totals["peak_rss_bytes"] = max(phase_totals["peak_rss_bytes"], peak_rss_bytes)
+            self.logger.debug("Phase {} of {} took {:.2f} seconds and {:.2f} CPU seconds".format(
+                phase_name, self.root_name or "the run", wall_seconds, cpu_seconds))
+
+    # Add to the amount of files and bytes a phase handled
+    def add_phase_totals(self, phase_name, file_count, byte_count):
+        with self.lock:
+            phase_totals = self.get_phase(phase_name)
+            phase_totals["files"] += file_count
+            phase_totals["bytes"] += byte_count
+
+    # Run function(*args) to hash the file at absolute_path, recording how long it took to read byte_count bytes of it
+    # under its size bucket. Returns what function returned. Files taking longer than slow_file_seconds are counted and
+    # logged, and files that raise are not recorded at all
+    def time_file(self, absolute_path, file_size_bytes, byte_count, function, *args):
+        start_time = perf_counter()
+        result = function(*args)
+        elapsed_seconds = perf_counter() - start_time
+        bucket_index = get_size_bucket(file_size_bytes)
+        with self.lock:
+            self.bucket_files[bucket_index] += 1
+            self.bucket_bytes[bucket_index] += byte_count
+            self.bucket_seconds[bucket_index] += elapsed_seconds
+            slowest_file = (elapsed_seconds, absolute_path, file_size_bytes)
+            if len(self.slowest_files) < SLOWEST_FILE_COUNT:
+                heappush(self.slowest_files, slowest_file)
+            else:
+                heappushpop(self.slowest_files, slowest_file)
+            if elapsed_seconds > self.slow_file_seconds:
+                self.slow_file_count += 1
+        if elapsed_seconds > self.slow_file_seconds:
+            self.logger.info("File {} took {:.1f} seconds to hash, reading {:.1f}MB at {:.1f}MBps".format(
+                absolute_path, elapsed_seconds, byte_count / 1000 / 1000,
+                byte_count / 1000 / 1000 / max(elapsed_seconds, 1e-9)))
+        return result
+
+    # Count an error, named after its exception type such as FileNotFoundError
+    def record_error(self, error_name):
+        with self.lock:
+            self.error_dict[error_name] = self.error_dict.get(error_name, 0) + 1
+
+    # Save the progress of the scan, the same figures log_current_progress() reports
+    def update_progress(self, files_seen, directories_seen, bytes_read):
+        with self.lock:
+            self.files_seen = files_seen
+            self.directories_seen = directories_seen
+            self.bytes_read = bytes_read
+        if self.progress_callback is not None:
+            self.progress_callback()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "root_name": self.root_name,
+                "files_seen": self.files_seen,
+                "directories_seen": self.directories_seen,
+                "bytes_read": self.bytes_read,
+                "phases": {phase_name: dict(phase_totals) for phase_name, phase_totals in self.phase_dict.items()},
+                "hash_throughput": [
+                    {"size_bucket": bucket_name, "files": file_count, "bytes": byte_count, "seconds": seconds,
+                     "bytes_per_second": byte_count / seconds if seconds > 0 else None}
+                    for bucket_name, file_count, byte_count, seconds in zip(
+                        SIZE_BUCKET_NAMES, self.bucket_files, self.bucket_bytes, self.bucket_seconds)],
+                "slow_files": self.slow_file_count,
+                "slowest_files": [{"path": absolute_path, "file_size_bytes": file_size_bytes, "seconds": seconds}
+                                  for seconds, absolute_path, file_size_bytes in sorted(self.slowest_files,
+                                                                                        reverse=True)],
+                "errors": dict(self.error_dict)}
+
+
+# Collects the ScanMetrics of every root plus those of the run as a whole, and writes them out as JSON to json_path
+# and in the Prometheus text format to prometheus_path, either of which may be None. Pointing prometheus_path into the
+# directory of node_exporter's textfile collector, in a file ending in .prom, lets scans be graphed across disks and
+# runs. If write_on_progress is True, both are also written out each time a scan logs its progress
+# https://github.com/prometheus/node_exporter#textfile-collector
+class RunMetrics:
+    def __init__(self, json_path, prometheus_path, write_on_progress, slow_file_seconds, logger):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.write_on_progress = write_on_progress
+        self.slow_file_seconds = slow_file_seconds
+        self.logger = logger
+        self.start_time = time()
+        self.start_perf_time = perf_counter()
+        self.write_lock = Lock()
+        self.run_metrics = ScanMetrics(None, slow_file_seconds, logger)
+        self.scan_metrics_list = []
+
+    # Create the ScanMetrics of one scan root
+    def create_scan_metrics(self, root_name):
+        scan_metrics = ScanMetrics(root_name, self.slow_file_seconds, self.logger)
+        if self.write_on_progress:
+            scan_metrics.progress_callback = self.write_in_progress
+        self.scan_metrics_list.append(scan_metrics)
+        return scan_metrics
+
+    def to_dict(self, completed):
+        return {"start_time": self.start_time, "duration_seconds": perf_counter() - self.start_perf_time,
+                "completed": completed, "cpu_seconds": process_time(), "peak_rss_bytes": get_peak_rss_bytes(),
+                "run": self.run_metrics.to_dict(),
+                "roots": [scan_metrics.to_dict() for scan_metrics in self.scan_metrics_list]}
+
+    # Render the metrics in the Prometheus text exposition format. Every metric is a gauge, as each file describes a
+    # single run
+    # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+    @staticmethod
+    def to_prometheus_text(metrics_dict):
+        # Dict of {key:metric name, value:Tuple of (help text, list of (labels, value))}, in the order first added
+        metric_dict = {}
+
+        def add_sample(metric_name, help_text, labels, value):
+            if value is None:
+                return
+            metric_dict.setdefault(metric_name, (help_text, []))[1].append((labels, value))
+
+        add_sample("run_start_time_seconds", "Unix time the run started at", {}, metrics_dict["start_time"])
+        add_sample("run_duration_seconds", "Seconds the run has taken so far", {}, metrics_dict["duration_seconds"])
+        add_sample("run_completed", "1 if the run finished, 0 if it is still going", {},
+                   int(metrics_dict["completed"]))
+        add_sample("run_cpu_seconds", "CPU seconds the run has used so far", {}, metrics_dict["cpu_seconds"])
+        add_sample("run_peak_rss_bytes", "Most resident memory the run has used so far", {},
+                   metrics_dict["peak_rss_bytes"])
+        for root_dict in [metrics_dict["run"]] + metrics_dict["roots"]:
+            root_labels = {} if root_dict["root_name"] is None else {"root": root_dict["root_name"]}
+            if root_dict["root_name"] is not None:
+                add_sample("scan_files_seen", "Files scanned so far", root_labels, root_dict["files_seen"])
+                add_sample("scan_directories_seen", "Directories scanned so far", root_labels,
+                           root_dict["directories_seen"])
+                add_sample("scan_bytes_read", "Bytes read from files so far", root_labels, root_dict["bytes_read"])
+            for phase_name, phase_totals in root_dict["phases"].items():
+                phase_labels = dict(root_labels, phase=phase_name)
+                add_sample("phase_wall_seconds", "Wall clock seconds spent in each phase", phase_labels,
+                           phase_totals["wall_seconds"])
+                add_sample("phase_cpu_seconds", "CPU seconds of the whole process during each phase", phase_labels,
+                           phase_totals["cpu_seconds"])
+                add_sample("phase_files", "Files handled by each phase", phase_labels, phase_totals["files"])
+                add_sample("phase_bytes", "Bytes handled by each phase", phase_labels, phase_totals["bytes"])
+                add_sample("phase_peak_rss_bytes", "Most resident memory used by the end of each phase", phase_labels,
+                           phase_totals["peak_rss_bytes"])
+            for bucket_dict in root_dict["hash_throughput"]:
+                if bucket_dict["files"] == 0:
+                    continue
+                bucket_labels = dict(root_labels, size_bucket=bucket_dict["size_bucket"])
+                add_sample("hashed_files", "Files hashed, by file size", bucket_labels, bucket_dict["files"])
+                add_sample("hashed_bytes", "Bytes read to hash files, by file size", bucket_labels,
+                           bucket_dict["bytes"])
+                add_sample("hash_seconds", "Seconds spent hashing files, by file size", bucket_labels,
+                           bucket_dict["seconds"])
+                add_sample("hash_bytes_per_second", "Average hashing throughput of files, by file size",
+                           bucket_labels, bucket_dict["bytes_per_second"])
+            # The run as a whole only hashes files itself when finding duplicates lazily across roots
+            if root_dict["root_name"] is not None or root_dict["slow_files"]:
+                add_sample("slow_files", "Files that took longer than the slow file threshold to hash", root_labels,
+                           root_dict["slow_files"])
+            for error_name, error_count in root_dict["errors"].items():
+                add_sample("errors", "Errors that caused files to be skipped, by type",
+                           dict(root_labels, error=error_name), error_count)
+
+        lines = []
+        for metric_name, (help_text, samples) in metric_dict.items():
+            lines.append("# HELP {}{} {}".format(PROMETHEUS_PREFIX, metric_name, help_text))
+            lines.append("# TYPE {}{} gauge".format(PROMETHEUS_PREFIX, metric_name))
+            for labels, value in samples:
+                label_text = ",".join("{}=\"{}\"".format(label_name, escape_label_value(label_value))
+                                      for label_name, label_value in labels.items())
+                lines.append("{}{}{} {}".format(PROMETHEUS_PREFIX, metric_name,
+                                                "{" + label_text + "}" if label_text else "", value))
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics files, if any were asked for. completed is False while scans are still going
+    def write(self, completed=True):
+        if self.json_path is None and self.prometheus_path is None:
+            return
+        with self.write_lock:
+            metrics_dict = self.to_dict(completed)
+            if self.json_path is not None:
+                write_file_atomically(self.json_path, json.dumps(metrics_dict, indent=2) + "\n")
+            if self.prometheus_path is not None:
+                write_file_atomically(self.prometheus_path, self.to_prometheus_text(metrics_dict))
+        if completed:
+            self.logger.info("Wrote run metrics to {}".format(
+                " and ".join(path.abspath(output_path) for output_path in [self.json_path, self.prometheus_path]
+                             if output_path is not None)))
+
+    def write_in_progress(self):
+        self.write(False)
@@ -1,5 +1,11 @@
+# Used to compile every exclusion rule of a kind into a single regular expression
+import re
+
 from .loghelper import get_logger_with_name
 
+# Regular expression matching any amount of leading directories of a relative path, including none
+ANY_DIRECTORIES_PATTERN = "(?:.*/)?"
+
 
 def sanitize_and_dedupe_extension_list(list_to_process):
     # Create a set that guarantees unique entries
@@ -34,24 +40,214 @@ def sanitize_and_dedupe_path_list(list_to_process):
     return list(output_set)
 
 
+# Read the patterns out of an exclude file written like a .gitignore, one per line. Blank lines and lines starting
+# with # are skipped, and trailing spaces are dropped unless escaped with a backslash
+# https://git-scm.com/docs/gitignore#_pattern_format
+def read_exclude_file(exclude_file_path):
+    patterns = []
+    with open(exclude_file_path, "r", encoding="utf-8", errors="surrogateescape") as stream:
+        for line in stream:
+            line = line.rstrip("\r\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip(" ")
+            if line == "" or line.startswith("#"):
+                continue
+            patterns.append(line)
+    return patterns
+
+
+# Build a regular expression matching the start of any string that begins with one of strings, by putting them in a
+# character trie and writing it out with every shared prefix factored out. Matching then takes one pass over the string
+# however many strings there are, rather than one startswith() per string. A string that another one starts with makes
+# the longer one redundant, so the trie is cut off there. Returns None if there are no strings
+def build_prefix_pattern(strings):
+    if not strings:
+        return None
+    # Each node is a Dict of {key:next character, value:child node}, with the key "" marking where a string ends
+    trie = {}
+    for string in strings:
+        node = trie
+        for character in string:
+            node = node.setdefault(character, {})
+        node[""] = {}
+    return trie_node_to_pattern(trie)
+
+
+# Write out the pattern matching every string below a node of the trie built by build_prefix_pattern()
+def trie_node_to_pattern(node):
+    pattern = ""
+    # Follow chains of nodes with a single child without recursing, so long strings don't run into the recursion limit
+    while "" not in node and len(node) == 1:
+        character, node = next(iter(node.items()))
+        pattern += re.escape(character)
+    if "" in node:
+        # A string ends here, so whatever follows it matches
+        return pattern
+    # https://docs.python.org/3/library/re.html#regular-expression-syntax
+    return pattern + "(?:" + "|".join(re.escape(character) + trie_node_to_pattern(child_node)
+                                      for character, child_node in sorted(node.items())) + ")"
+
+
+# Translate one path component of a glob, such as *.tmp, into a regular expression that can't match across slashes
+def translate_glob_component(component):
+    pattern = ""
+    index = 0
+    while index < len(component):
+        character = component[index]
+        index += 1
+        if character == "\\" and index < len(component):
+            pattern += re.escape(component[index])
+            index += 1
+        elif character == "*":
+            pattern += "[^/]*"
+        elif character == "?":
+            pattern += "[^/]"
+        elif character == "[":
+            # Copy a bracket expression such as [0-9] or [!a] over as a character class, or treat [ as itself if the
+            # expression is never closed. A ] right after the [ or [! is part of the expression rather than its end
+            search_index = index + 1 if component[index:index + 1] == "!" else index
+            search_index += 1 if component[search_index:search_index + 1] == "]" else 0
+            closing_index = component.find("]", search_index)
+            if closing_index == -1:
+                pattern += re.escape(character)
+                continue
+            bracket_expression = component[index:closing_index].replace("\\", "\\\\").replace("[", "\\[")
+            if bracket_expression.startswith("!"):
+                bracket_expression = "^" + bracket_expression[1:]
+            pattern += "[" + bracket_expression + "]"
+            index = closing_index + 1
+        else:
+            pattern += re.escape(character)
+    return pattern
+
+
+# Translate a .gitignore style pattern into a regular expression matching the whole of a relative path, returning a
+# Tuple of (regular expression, True if it only matches directories, True if it was negated with a leading !)
+# - A pattern with a slash at its start or middle only matches from the start of the path, others at any depth
+# - A trailing slash only matches directories
+# - * and ? match anything but a slash, and ** matches across slashes when it's a whole path component
+# https://git-scm.com/docs/gitignore#_pattern_format
+def translate_glob(glob):
+    negated = glob.startswith("!")
+    if negated:
+        glob = glob[1:]
+    directory_only = glob.endswith("/")
+    glob = glob.rstrip("/")
+    anchored = "/" in glob
+    components = glob.lstrip("/").split("/")
+    pattern = ""
+    for component_index, component in enumerate(components):
+        last_component = component_index == len(components) - 1
+        if component == "**":
+            # Leading or middle ** matches any amount of directories, and trailing ** everything inside a directory
+            pattern += ".*" if last_component else ANY_DIRECTORIES_PATTERN
+        else:
+            pattern += translate_glob_component(component) + ("" if last_component else "/")
+    return ("" if anchored else ANY_DIRECTORIES_PATTERN) + pattern, directory_only, negated
+
+
+# Combine regular expressions into one that matches a whole string matching any of them, or None if there are none.
+# The leading ANY_DIRECTORIES_PATTERN of unanchored patterns is factored out, so the regular expression engine tries
+# each directory depth once for all of them rather than once per pattern
+def combine_patterns(patterns):
+    if not patterns:
+        return None
+    anchored_patterns = [pattern for pattern in patterns if not pattern.startswith(ANY_DIRECTORIES_PATTERN)]
+    unanchored_patterns = [pattern[len(ANY_DIRECTORIES_PATTERN):] for pattern in patterns
+                           if pattern.startswith(ANY_DIRECTORIES_PATTERN)]
+    if unanchored_patterns:
+        anchored_patterns.append(ANY_DIRECTORIES_PATTERN + "(?:" + "|".join(unanchored_patterns) + ")")
+    return re.compile("(?:" + "|".join(anchored_patterns) + r")\Z")
+
+
+# Compile patterns translated by translate_glob(), in the order they were given, into a Tuple of (regular expression
+# matching a path any of them match, regular expression telling which of them matches last, list of whether each was
+# negated), or (None, None, []) if there are none. Like in a .gitignore, the last pattern matching a path decides
+# whether it's excluded, so the second regular expression tries the patterns in reverse order, each in a group named
+# after its index, and the first to match wins. It's only needed for paths the first one matches, as most paths match
+# no pattern at all
+def compile_glob_patterns(translated_globs):
+    if not translated_globs:
+        return None, None, []
+    any_glob_regex = combine_patterns([pattern for pattern, _, _ in translated_globs])
+    last_glob_regex = re.compile("|".join(r"(?P<pattern{}>(?:{})\Z)".format(pattern_index, pattern)
+                                          for pattern_index, (pattern, _, _) in reversed(list(enumerate(
+                                              translated_globs)))))
+    return any_glob_regex, last_glob_regex, [negated for _, _, negated in translated_globs]
+
+
+# Decides which directories and files a scan leaves out. Every rule is compiled into regular expressions once, so each
+# directory and file is checked in a single pass however many rules there are:
+# - path_exclude_list holds relative directory paths, and directories whose relative path starts with one are excluded
+# - extension_exclude_list holds file name endings, such as .nfo, and files whose name ends with one are excluded
+# - glob_exclude_list holds .gitignore style patterns, as do the files listed in exclude_file_list, which come after
+#   them. They're matched against paths relative to the scan root, whose relative path is glob_root, so patterns
+#   starting with / are anchored to the scan root. The last pattern a path matches decides whether it's excluded, with
+#   those negated by a leading ! keeping it. Like git, nothing under an excluded directory can be kept, as it's never
+#   listed
 class PathExcluder:
-    def __init__(self, extension_exclude_list, path_exclude_list, log_level):
+    def __init__(self, extension_exclude_list, path_exclude_list, log_level, glob_exclude_list=None,
+                 exclude_file_list=None, glob_root="."):
         self.logger = get_logger_with_name("PathExcluder", log_level)
         self.extension_exclude_list = sanitize_and_dedupe_extension_list(extension_exclude_list)
         self.path_exclude_list = sanitize_and_dedupe_path_list(path_exclude_list)
-        self.logger.info("PathExcluder initialized with excluded dirs {} and excluded extensions {}".format(
-            self.path_exclude_list, self.extension_exclude_list))
+        self.glob_exclude_list = list(glob_exclude_list or [])
+        for exclude_file_path in exclude_file_list or []:
+            self.glob_exclude_list += read_exclude_file(exclude_file_path)
+        # Relative paths are matched from their start against a trie of the excluded directories
+        path_pattern = build_prefix_pattern(self.path_exclude_list)
+        self.path_regex = None if path_pattern is None else re.compile(path_pattern)
+        # File names are reversed, so their endings can be matched from the start against a trie of reversed extensions
+        extension_pattern = build_prefix_pattern([extension[::-1] for extension in self.extension_exclude_list])
+        self.reversed_extension_regex = None if extension_pattern is None else re.compile(extension_pattern)
+        self.glob_root = glob_root
+        # Relative paths of everything under the scan root start with this, which is stripped before matching patterns
+        self.glob_root_prefix = "" if glob_root == "." else glob_root + "/"
+        translated_globs = [translate_glob(glob) for glob in self.glob_exclude_list]
+        self.directory_globs = compile_glob_patterns(translated_globs)
+        # Directory-only patterns are left out of those matched against files
+        self.file_globs = compile_glob_patterns([translated_glob for translated_glob in translated_globs
+                                                 if not translated_glob[1]])
+        self.logger.info("PathExcluder initialized with excluded dirs {}, excluded extensions {}, and {} excluded "
+                         "patterns".format(self.path_exclude_list, self.extension_exclude_list,
+                                           len(self.glob_exclude_list)))
+
+    # Return True if the last of the patterns compiled into globs by compile_glob_patterns() that matches the relative
+    # path isn't negated. The scan root itself is never matched, as with git
+    def matches_glob(self, relative_path, globs):
+        any_glob_regex, last_glob_regex, negated_list = globs
+        if any_glob_regex is None or relative_path == self.glob_root:
+            return False
+        if self.glob_root_prefix:
+            if not relative_path.startswith(self.glob_root_prefix):
+                return False
+            relative_path = relative_path[len(self.glob_root_prefix):]
+        if any_glob_regex.match(relative_path) is None:
+            return False
+        if not any(negated_list):
+            return True
+        # https://docs.python.org/3/library/re.html#re.Match.lastgroup
+        return not negated_list[int(last_glob_regex.match(relative_path).lastgroup[len("pattern"):])]
 
     def is_excluded_dir(self, input_path):
-        for path in self.path_exclude_list:
-            if input_path.startswith(path):
-                self.logger.info("Directory {} matched exclusion rule, skipping".format(input_path))
-                return True
+        if (self.path_regex is not None and self.path_regex.match(input_path) is not None) \
+                or self.matches_glob(input_path, self.directory_globs):
+            self.logger.info("Directory {} matched exclusion rule, skipping".format(input_path))
+            return True
         return False
 
     def has_excluded_extension(self, file_name):
-        for extension in self.extension_exclude_list:
-            if file_name.endswith(extension):
-                self.logger.debug("File {} matched exclusion rule {}, skipping".format(file_name, extension))
-                return True
+        if self.reversed_extension_regex is not None \
+                and self.reversed_extension_regex.match(file_name[::-1]) is not None:
+            self.logger.debug("File {} matched an excluded extension, skipping".format(file_name))
+            return True
+        return False
+
+    # Return True if the file should be left out of the scan, based on its name and its relative path
+    def is_excluded_file(self, file_name, relative_path):
+        if self.has_excluded_extension(file_name):
+            return True
+        if self.matches_glob(relative_path, self.file_globs):
+            self.logger.debug("File {} matched an exclusion pattern, skipping".format(relative_path))
+            return True
         return False
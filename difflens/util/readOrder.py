@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class ReadOrder(Enum):
+    WALK = "walk"
+    INODE = "inode"
+    EXTENT = "extent"
@@ -0,0 +1,228 @@
+# Used to open files with flags Python's open() doesn't expose, read them into an existing buffer, and advise the kernel
+# on how their pages will be used. Flags that only exist on some platforms are looked up with hasattr()
+import os
+# Used to close each file once hashing is done with it, even if hashing fails partway
+from contextlib import contextmanager
+# Used to clear O_DIRECT from a file that turns out not to support it
+from errno import EINVAL
+from fcntl import F_GETFL, F_SETFL, fcntl
+# Used to allocate page-aligned read buffers, which O_DIRECT requires, and to memory map large files
+from mmap import ACCESS_READ, ALLOCATIONGRANULARITY, mmap
+# Used to give each hashing thread its own read buffer, and to share the cache of which devices spin across threads
+from threading import Lock, local
+# Used to tell how recently a file was modified before memory mapping it
+from time import time
+
+# Used for computing the hash of a file on disk
+# https://github.com/oconnor663/blake3-py
+from blake3 import blake3
+
+from .hashingengine import is_rotational_device
+from .loghelper import get_logger_with_name
+
+# Bytes to read in at a time. 2^20 = 1MB, which difflens/benchmark/blocksize.py can be used to tune for a given disk
+DEFAULT_READ_BLOCK_SIZE = 2 ** 20
+# O_DIRECT reads must start at and cover a multiple of the device's logical block size, which 4096 is for common disks
+DIRECT_IO_ALIGNMENT = 4096
+# While reading a large file, how many bytes to read between telling the kernel to drop what was just read from the page
+# cache, so a single huge file can't evict everything else either
+DROP_CACHE_INTERVAL_BYTES = 64 * 2 ** 20
+# Bytes of a large file memory mapped and hashed at a time, so address space and page cache use stay bounded
+MMAP_WINDOW_BYTES = 2 ** 30
+# Smaller window used when reads are throttled, so the wait for each window's read budget stays short
+THROTTLED_MMAP_WINDOW_BYTES = 16 * 2 ** 20
+# Files modified more recently than this are read rather than memory mapped, as they may still be written to, and a
+# file truncated while it's mapped kills the process with SIGBUS rather than raising an error
+MMAP_MIN_UNMODIFIED_SECONDS = 60
+
+
+# Reads files a block at a time into one preallocated buffer per thread, passing views of it to a hasher so no bytes
+# object is created per block. The kernel is told each file is read sequentially, and optionally to drop the file from
+# the page cache once read so a scan of many terabytes doesn't push out pages that other programs are using. With
+# direct_io, files are opened with O_DIRECT to skip the page cache entirely, falling back to buffered reads for files
+# on filesystems that don't support it.
+# Ranges of at least mmap_threshold_bytes on solid state disks are instead memory mapped and handed to BLAKE3 whole, so
+# it can hash them with blake3_threads threads. Spinning disks stay on the read path, as the scattered page faults of
+# several hashing threads would make them seek, as do files that were recently modified or change while being hashed.
+# A threshold of 0 turns memory mapping off.
+# If read_throttle is given, it's told about every read and may hold it back to limit the read rate of each device
+class ReadEngine:
+    def __init__(self, read_block_size=DEFAULT_READ_BLOCK_SIZE, drop_page_cache=True, direct_io=False,
+                 log_level="INFO", mmap_threshold_bytes=0, blake3_threads=blake3.AUTO, read_throttle=None):
+        self.logger = get_logger_with_name("ReadEngine", log_level)
+        self.direct_io = direct_io and hasattr(os, "O_DIRECT")
+        if direct_io and not self.direct_io:
+            self.logger.warning("O_DIRECT is not supported on this platform, using buffered reads instead")
+        # Direct reads start at an aligned offset and read aligned lengths, so the buffer is rounded up to match
+        self.alignment = DIRECT_IO_ALIGNMENT if self.direct_io else 1
+        self.read_block_size = -(-max(read_block_size, 1) // self.alignment) * self.alignment
+        self.advise_kernel = hasattr(os, "posix_fadvise")
+        self.drop_page_cache = drop_page_cache and self.advise_kernel
+        self.thread_local = local()
+        self.mmap_threshold_bytes = mmap_threshold_bytes
+        self.blake3_threads = blake3_threads
+        self.read_throttle = read_throttle
+        # Dict of {key:device_id, value:True if files on it may be memory mapped}, filled in as devices are encountered
+        self.mmap_device_dict = {}
+        self.mmap_device_lock = Lock()
+        self.logger.debug("ReadEngine initialized with {} byte reads, dropping page cache: {}, direct I/O: {}, memory "
+                          "mapping ranges of at least {} bytes".format(self.read_block_size, self.drop_page_cache,
+                                                                       self.direct_io, mmap_threshold_bytes))
+
+    # Return the calling thread's read buffer, allocating it on first use. Anonymous memory maps are page-aligned
+    # https://docs.python.org/3/library/mmap.html
+    def get_buffer(self):
+        buffer = getattr(self.thread_local, "buffer", None)
+        if buffer is None:
+            buffer = self.thread_local.buffer = memoryview(mmap(-1, self.read_block_size))
+        return buffer
+
+    # Return True if ranges of range_bytes of the file should be memory mapped rather than read
+    def uses_mmap(self, file_descriptor, range_bytes):
+        if self.mmap_threshold_bytes <= 0 or range_bytes < self.mmap_threshold_bytes:
+            return False
+        device = os.fstat(file_descriptor).st_dev
+        with self.mmap_device_lock:
+            if device not in self.mmap_device_dict:
+                # Only solid state disks are known to handle the out of order reads well
+                self.mmap_device_dict[device] = is_rotational_device(device) is False
+                self.logger.info("Memory mapping files of at least {:.0f}MB on device {}:{}: {}".format(
+                    self.mmap_threshold_bytes / 2 ** 20, os.major(device), os.minor(device),
+                    self.mmap_device_dict[device]))
+            return self.mmap_device_dict[device]
+
+    # Create a hasher for range_bytes of an open file, which hashes with several threads if the range will be memory
+    # mapped. Each produces the same digest, only the speed differs
+    def create_hasher(self, file_descriptor, range_bytes):
+        if self.uses_mmap(file_descriptor, range_bytes):
+            # https://github.com/oconnor663/blake3-py#usage
+            return blake3(max_threads=self.blake3_threads)
+        return blake3()
+
+    # Return the total seconds reads from the device were held back by the read throttle, or None if there isn't one
+    def get_throttled_seconds(self, device):
+        if self.read_throttle is None:
+            return None
+        return self.read_throttle.get_throttled_seconds(device)
+
+    # Open a file for reading, yielding its file descriptor, then drop it from the page cache if asked to and close it.
+    # Raises FileNotFoundError like open() does if the file is gone
+    @contextmanager
+    def open(self, absolute_path):
+        flags = os.O_RDONLY
+        if self.direct_io:
+            try:
+                file_descriptor = os.open(absolute_path, flags | os.O_DIRECT)
+            except OSError as error:
+                if error.errno != EINVAL:
+                    raise
+                # Filesystems such as tmpfs refuse O_DIRECT outright
+                file_descriptor = os.open(absolute_path, flags)
+        else:
+            file_descriptor = os.open(absolute_path, flags)
+        try:
+            if self.advise_kernel:
+                # https://docs.python.org/3/library/os.html#os.posix_fadvise
+                os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            yield file_descriptor
+        finally:
+            if self.drop_page_cache:
+                os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(file_descriptor)
+
+    # Read up to length bytes at offset into the start of buffer, returning the amount read, which is less than asked
+    # for only at the end of the file. If the filesystem rejects an O_DIRECT read, O_DIRECT is cleared and it's retried
+    @staticmethod
+    def read_into(file_descriptor, buffer, offset, length):
+        # https://docs.python.org/3/library/os.html#os.preadv
+        try:
+            return os.preadv(file_descriptor, [buffer[:length]], offset)
+        except OSError as error:
+            file_flags = fcntl(file_descriptor, F_GETFL)
+            if error.errno != EINVAL or not file_flags & getattr(os, "O_DIRECT", 0):
+                raise
+            fcntl(file_descriptor, F_SETFL, file_flags & ~os.O_DIRECT)
+            return os.preadv(file_descriptor, [buffer[:length]], offset)
+
+    # Update hasher with byte_count bytes of the file starting at offset, or every byte to the end of the file if
+    # byte_count is None. Returns the amount of bytes hashed, which is less than byte_count if the file ended first
+    def hash_range(self, file_descriptor, hasher, offset, byte_count=None):
+        if self.mmap_threshold_bytes > 0:
+            file_stat = os.fstat(file_descriptor)
+            range_bytes = max(file_stat.st_size - offset, 0)
+            if byte_count is not None:
+                range_bytes = min(range_bytes, byte_count)
+            if self.uses_mmap(file_descriptor, range_bytes) \
+                    and time() - file_stat.st_mtime >= MMAP_MIN_UNMODIFIED_SECONDS:
+                return self.hash_mapped_range(file_descriptor, hasher, offset, range_bytes, byte_count, file_stat)
+        return self.hash_read_range(file_descriptor, hasher, offset, byte_count)
+
+    # Update hasher with byte_count bytes of the file starting at offset, or every byte to the end of the file if
+    # byte_count is None, by reading them into the buffer a block at a time. Returns the amount of bytes hashed
+    def hash_read_range(self, file_descriptor, hasher, offset, byte_count):
+        device = None if self.read_throttle is None else os.fstat(file_descriptor).st_dev
+        buffer = self.get_buffer()
+        end_offset = None if byte_count is None else offset + byte_count
+        position = dropped_offset = offset
+        while end_offset is None or position < end_offset:
+            # Direct reads start at the aligned offset before position, with the bytes before position skipped
+            read_offset = position - position % self.alignment
+            read_length = self.read_block_size
+            if end_offset is not None:
+                read_length = min(read_length, -(-(end_offset - read_offset) // self.alignment) * self.alignment)
+            bytes_read = self.read_into(file_descriptor, buffer, read_offset, read_length)
+            read_end_offset = read_offset + bytes_read
+            if read_end_offset <= position:
+                break
+            if device is not None:
+                self.read_throttle.consume(device, bytes_read)
+            if end_offset is not None:
+                read_end_offset = min(read_end_offset, end_offset)
+            # Hash a view of the buffer rather than a copy of it
+            hasher.update(buffer[position - read_offset:read_end_offset - read_offset])
+            position = read_end_offset
+            if self.drop_page_cache and position - dropped_offset >= DROP_CACHE_INTERVAL_BYTES:
+                os.posix_fadvise(file_descriptor, dropped_offset, position - dropped_offset, os.POSIX_FADV_DONTNEED)
+                dropped_offset = position
+        return position - offset
+
+    # Hash range_bytes of the file starting at offset by memory mapping it a window at a time and passing each window to
+    # the hasher in one call, which lets a multithreaded hasher split it between its threads. file_stat is the fstat()
+    # range_bytes was worked out from. If the file's size or modification time changes along the way, the rest of the
+    # byte_count bytes hash_range() was asked for are read instead of mapped, as mapping past the end of a file that
+    # shrank fails, or kills the process if it shrinks while mapped. Returns the amount of bytes hashed
+    def hash_mapped_range(self, file_descriptor, hasher, offset, range_bytes, byte_count, file_stat):
+        position = offset
+        end_offset = offset + range_bytes
+        window_bytes = MMAP_WINDOW_BYTES
+        device = None
+        if self.read_throttle is not None:
+            window_bytes = THROTTLED_MMAP_WINDOW_BYTES
+            device = os.fstat(file_descriptor).st_dev
+        while position < end_offset:
+            # Maps must start on a multiple of the allocation granularity, with the bytes before position skipped
+            map_offset = position - position % ALLOCATIONGRANULARITY
+            map_length = min(end_offset - map_offset, window_bytes)
+            current_stat = os.fstat(file_descriptor)
+            file_map = None
+            if current_stat.st_size == file_stat.st_size and current_stat.st_mtime_ns == file_stat.st_mtime_ns:
+                try:
+                    # https://docs.python.org/3/library/mmap.html
+                    file_map = mmap(file_descriptor, map_length, access=ACCESS_READ, offset=map_offset)
+                except ValueError:
+                    # The file shrank since it was checked
+                    pass
+            if file_map is None:
+                self.logger.debug("File descriptor {} changed while being hashed, reading the rest of it rather than "
+                                  "memory mapping it".format(file_descriptor))
+                remaining_bytes = None if byte_count is None else offset + byte_count - position
+                return position - offset + self.hash_read_range(file_descriptor, hasher, position, remaining_bytes)
+            # Wait for the read budget before hashing, as hashing is what reads the mapped pages in
+            if device is not None:
+                self.read_throttle.consume(device, map_offset + map_length - position)
+            with file_map, memoryview(file_map) as file_view:
+                hasher.update(file_view[position - map_offset:])
+            position = map_offset + map_length
+            if self.drop_page_cache:
+                os.posix_fadvise(file_descriptor, map_offset, map_length, os.POSIX_FADV_DONTNEED)
+        return position - offset
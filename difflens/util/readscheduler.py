@@ -0,0 +1,94 @@
+# Used to ask the filesystem where a file's data starts on disk
+from errno import EBADR, EINVAL, ENOTSUP, ENOTTY, EOPNOTSUPP
+from fcntl import ioctl
+from os import O_RDONLY, close, open as open_file
+# Used to pack the FIEMAP request and unpack the first extent of its response
+from struct import Struct
+# Used to time how long collecting and ordering the file list took
+from time import time
+
+from .directorywalker import walk_directory
+from .readOrder import ReadOrder
+
+# ioctl that maps a file's logical offsets to physical offsets on its device, supported by ext4, XFS, and Btrfs
+# https://www.kernel.org/doc/html/latest/filesystems/fiemap.html
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_HEADER_STRUCT = Struct("=QQIIII")
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+FIEMAP_EXTENT_STRUCT = Struct("=QQQ2QI3I")
+FIEMAP_MAX_OFFSET = 2 ** 64 - 1
+# Errors meaning the filesystem can't report extents at all, rather than something being wrong with one file
+FIEMAP_UNSUPPORTED_ERRORS = {EBADR, EINVAL, ENOTSUP, ENOTTY, EOPNOTSUPP}
+
+
+# Return the physical byte offset on its device where the file's first extent starts, or None if it has no extents,
+# such as an empty file or one whose data is stored inline with its inode. Raises OSError if FIEMAP fails
+def get_first_physical_offset(absolute_path):
+    # Ask for the extent covering offset 0 onwards, with room in the buffer for exactly one extent
+    request = bytearray(FIEMAP_HEADER_STRUCT.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0)) \
+        + bytearray(FIEMAP_EXTENT_STRUCT.size)
+    file_descriptor = open_file(absolute_path, O_RDONLY)
+    try:
+        # https://docs.python.org/3/library/fcntl.html#fcntl.ioctl
+        ioctl(file_descriptor, FS_IOC_FIEMAP, request, True)
+    finally:
+        close(file_descriptor)
+    mapped_extents = FIEMAP_HEADER_STRUCT.unpack_from(request)[3]
+    if mapped_extents == 0:
+        return None
+    return FIEMAP_EXTENT_STRUCT.unpack_from(request, FIEMAP_HEADER_STRUCT.size)[1]
+
+
+# Sort file entries of (absolute_file_path, relative_file_path, os.stat_result) in place into the order they should be
+# read in. Inode order follows the order files were allocated in on most filesystems, while extent order follows where
+# their data actually sits on disk. Files on a filesystem without FIEMAP support fall back to inode order
+def sort_file_entries(file_entries, read_order, logger):
+    if read_order == ReadOrder.EXTENT.value:
+        # Dict of {key:device, value:False if FIEMAP isn't supported}, so an unsupported filesystem is only tried once
+        extent_support_dict = {}
+        sort_keys = {}
+        for absolute_file_path, _, file_stat in file_entries:
+            physical_offset = None
+            if extent_support_dict.get(file_stat.st_dev, True):
+                try:
+                    physical_offset = get_first_physical_offset(absolute_file_path)
+                except OSError as error:
+                    if error.errno in FIEMAP_UNSUPPORTED_ERRORS:
+                        logger.warning("Filesystem of {} can't report file extents, falling back to inode order for "
+                                       "its device".format(absolute_file_path))
+                        extent_support_dict[file_stat.st_dev] = False
+                    # Other errors, such as the file having been deleted, are reported once the file is read
+            # Files without a physical offset are read after the rest, in inode order
+            sort_keys[absolute_file_path] = (file_stat.st_dev, physical_offset is None, physical_offset or 0,
+                                             file_stat.st_ino)
+        file_entries.sort(key=lambda file_entry: sort_keys[file_entry[0]])
+    else:
+        file_entries.sort(key=lambda file_entry: (file_entry[2].st_dev, file_entry[2].st_ino))
+    return file_entries
+
+
+# Yield a Tuple of (directory_count, file_entries) for the files compute_diffs should read, in the given read_order.
+# In walk order, each directory is yielded as soon as it's listed, in the order walk_directory() visits them. Otherwise
+# the whole tree is walked first and its files are yielded in a single batch sorted by sort_file_entries(), which spares
+# spinning disks from seeking back and forth between files that are near each other in the tree but not on disk.
+# Directories are listed by walk_workers threads if there's more than one, in which case walk order is whichever order
+# they finish being listed in
+def schedule_file_entries(path_to_process, path_excluder, relative_base, logger, read_order, walk_workers=1):
+    directory_batches = walk_directory(path_to_process, path_excluder, relative_base, logger, walk_workers)
+    if read_order == ReadOrder.WALK.value:
+        for _, file_entries in directory_batches:
+            yield 1, file_entries
+        return
+    start_time = time()
+    all_file_entries = []
+    directory_count = 0
+    for _, file_entries in directory_batches:
+        all_file_entries.extend(file_entries)
+        directory_count += 1
+    logger.info("Collected {} files across {} directories in {:.2f} seconds, ordering them by {}".format(
+        len(all_file_entries), directory_count, time() - start_time, read_order))
+    sort_file_entries(all_file_entries, read_order, logger)
+    logger.info("Ordered {} files by {} in {:.2f} seconds".format(len(all_file_entries), read_order,
+                                                                  time() - start_time))
+    yield directory_count, all_file_entries
@@ -0,0 +1,112 @@
+# Used to find where the cursor left off in the sorted relative paths
+from bisect import bisect_right
+# Used to read and write the scrub state file
+import json
+# Used to tell whether there's a scrub state file to read
+from os import path
+# Used to pick a slice by the day when there's no scrub state file to count runs in
+from time import time
+
+# Used to assign each relative path to a slice, spread evenly however similar the paths are
+# https://github.com/oconnor663/blake3-py
+from blake3 import blake3
+
+from .metrics import write_file_atomically
+
+# Ways the files each run scrubs are picked:
+# - PATH_HASH_ORDER: files whose relative path hashes to the slice of this run, so each slice has about as many files
+# - CURSOR_ORDER: the files following the cursor in relative path order, until a share of the bytes is reached
+PATH_HASH_ORDER = "path-hash"
+CURSOR_ORDER = "cursor"
+SCRUB_ORDERS = [PATH_HASH_ORDER, CURSOR_ORDER]
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+# Return the slice of cycle_runs a relative path belongs to
+def get_path_slice(relative_path, cycle_runs):
+    path_digest = blake3(relative_path.encode("utf-8", "surrogateescape")).digest(length=8)
+    return int.from_bytes(path_digest, "little") % cycle_runs
+
+
+# Picks the files a rolling scrub rehashes this run, so that every file hashed by the previous run is read back and
+# checked once every cycle_runs runs, while each run reads about 1 / cycle_runs of them. Which slice comes next is kept
+# in the JSON state file at state_path. Without one, path-hash order picks the slice by the day, which suits nightly
+# runs
+class RollingScrub:
+    def __init__(self, cycle_runs, scrub_order, state_path, logger):
+        self.cycle_runs = cycle_runs
+        self.scrub_order = scrub_order
+        self.state_path = state_path
+        self.logger = logger
+        # Dict of {next_slice: slice of the next run in path-hash order, cursor: last relative path scrubbed in cursor
+        # order}, starting over if the cycle length or order changed since it was saved
+        self.state = {"cycle_runs": cycle_runs, "scrub_order": scrub_order, "next_slice": 0, "cursor": ""}
+        if state_path is not None and path.isfile(state_path):
+            with open(state_path, "r") as stream:
+                saved_state = json.load(stream)
+            if saved_state.get("cycle_runs") == cycle_runs and saved_state.get("scrub_order") == scrub_order:
+                self.state.update(saved_state)
+            else:
+                logger.warning("Scrub state file {} was saved for {} order over {} runs, starting a new cycle".format(
+                    state_path, saved_state.get("scrub_order"), saved_state.get("cycle_runs")))
+        self.files_scrubbed = self.bytes_scrubbed = 0
+
+    # Request verification from carry_forward for each file of this run's slice, so they're rehashed and checked
+    # against the hash carried forward if their metadata is unchanged. Every other unchanged file keeps its last
+    # verified hash. Files that changed since the last scan are always hashed, whatever slice they're in
+    def request_slice_verification(self, carry_forward):
+        if self.scrub_order == PATH_HASH_ORDER:
+            slice_paths = self.get_path_hash_slice(carry_forward.carry_forward_dict)
+        else:
+            slice_paths = self.get_cursor_slice(carry_forward.carry_forward_dict)
+        for relative_path in slice_paths:
+            carry_forward.request_verification(relative_path)
+            self.bytes_scrubbed += carry_forward.carry_forward_dict[relative_path][0]
+        self.files_scrubbed = len(slice_paths)
+        self.logger.info("Scrubbing {} of {} previously hashed files this run, {:.1f}MB of {:.1f}MB".format(
+            self.files_scrubbed, len(carry_forward.carry_forward_dict), self.bytes_scrubbed / 1000 / 1000,
+            sum(entry[0] for entry in carry_forward.carry_forward_dict.values()) / 1000 / 1000))
+
+    # Return the relative paths hashing to this run's slice, moving the next run on to the slice after it
+    def get_path_hash_slice(self, carry_forward_dict):
+        if self.state_path is None:
+            current_slice = int(time() // SECONDS_PER_DAY) % self.cycle_runs
+        else:
+            current_slice = self.state["next_slice"] % self.cycle_runs
+        self.state["next_slice"] = (current_slice + 1) % self.cycle_runs
+        self.logger.info("Scrubbing slice {} of {} by relative path hash".format(current_slice + 1, self.cycle_runs))
+        return [relative_path for relative_path in carry_forward_dict
+                if get_path_slice(relative_path, self.cycle_runs) == current_slice]
+
+    # Return the relative paths following the cursor in sorted order, wrapping around to the start, until
+    # 1 / cycle_runs of the bytes are covered or the slice gets back to where it started. Empty files don't count
+    # towards the bytes, so they're always included along the way. The cursor is moved on to the last path returned,
+    # or past the first one if every path was returned, so each run starts further along than the one before
+    def get_cursor_slice(self, carry_forward_dict):
+        sorted_paths = sorted(carry_forward_dict)
+        if not sorted_paths:
+            return []
+        byte_budget = sum(entry[0] for entry in carry_forward_dict.values()) / self.cycle_runs
+        start_index = bisect_right(sorted_paths, self.state["cursor"]) % len(sorted_paths)
+        self.logger.info("Scrubbing {:.1f}MB by relative path starting from {}".format(
+            byte_budget / 1000 / 1000, sorted_paths[start_index]))
+        slice_paths = []
+        slice_bytes = 0
+        while len(slice_paths) < len(sorted_paths):
+            relative_path = sorted_paths[(start_index + len(slice_paths)) % len(sorted_paths)]
+            file_size_bytes = carry_forward_dict[relative_path][0]
+            if slice_bytes >= byte_budget and file_size_bytes > 0:
+                break
+            slice_paths.append(relative_path)
+            slice_bytes += file_size_bytes
+        # Having wrapped all the way around, the last path returned is the one before the first, which would have the
+        # next run start from the same path again
+        self.state["cursor"] = sorted_paths[start_index] if len(slice_paths) == len(sorted_paths) else slice_paths[-1]
+        return slice_paths
+
+    # Save which slice the next run scrubs, once this run's slice has been read
+    def save_state(self):
+        if self.state_path is None:
+            return
+        write_file_atomically(self.state_path, json.dumps(self.state, indent=2) + "\n")
+        self.logger.info("Saved rolling scrub state to {}".format(self.state_path))
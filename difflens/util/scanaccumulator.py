@@ -0,0 +1,91 @@
+# Used to store integer columns as packed 64-bit values rather than a Python int object per file
+from array import array
+
+# Used to copy the packed columns into arrays pandas can take ownership of
+import numpy
+# Used to create DataFrames
+from pandas import DataFrame
+
+from .carryforward import METADATA_COLUMNS
+from .chunkhash import CHUNK_DIGESTS_COLUMN, CHUNK_SIZE_COLUMN, DIGEST_BYTES, chunk_digests_to_hex
+
+# Stands in for the hash of files that were never read, such as in file-size compare mode
+NOT_COMPUTED = "not_computed"
+# Relative paths are stored one after another in a single buffer, separated by a character no path can contain.
+# Encoding with surrogateescape allows file names that aren't valid UTF-8 to round trip exactly
+PATH_SEPARATOR = "\0"
+PATH_SEPARATOR_BYTES = PATH_SEPARATOR.encode("ascii")
+PATH_ENCODING = "utf-8"
+PATH_ERRORS = "surrogateescape"
+
+
+# Collects the results of a scan into compact column buffers as files are processed: raw 32-byte digests in one
+# bytearray, sizes and metadata in packed int64 arrays, and paths encoded into one growing buffer. This costs 64 bytes
+# per file plus the length of its path, where the nested dicts it replaced held several Python objects per file
+class ScanAccumulator:
+    # chunk_size_bytes is set in chunk-hash compare mode, where the digest of every chunk of each file is also kept.
+    # If checkpoint_journal is set, every file appended is also recorded to it so an interrupted scan can be resumed
+    def __init__(self, store_hashes, chunk_size_bytes=None, checkpoint_journal=None):
+        # False in file-size compare mode, where every file gets the NOT_COMPUTED hash and no digests are kept
+        self.store_hashes = store_hashes
+        self.chunk_size_bytes = chunk_size_bytes
+        self.checkpoint_journal = checkpoint_journal
+        self.digests = bytearray()
+        # The chunk digests of every file one after another, along with how many bytes of them belong to each file
+        self.chunk_digests = bytearray()
+        self.chunk_digests_lengths = array("q")
+        # https://docs.python.org/3/library/array.html
+        self.file_sizes = array("q")
+        self.metadata_columns = [array("q") for _ in METADATA_COLUMNS]
+        self.paths = bytearray()
+
+    def __len__(self):
+        return len(self.file_sizes)
+
+    # Add one file. hex_hash is the 64-character hash to store, or None in file-size compare mode. file_metadata is a
+    # Tuple of (modified_time_ns, inode, device). chunk_digests is the raw digests of each chunk in chunk-hash mode
+    def append(self, relative_path, hex_hash, file_size_bytes, file_metadata, chunk_digests=b""):
+        if self.store_hashes:
+            # https://docs.python.org/3/library/stdtypes.html#bytes.fromhex
+            self.digests += bytes.fromhex(hex_hash)
+        if self.chunk_size_bytes is not None:
+            self.chunk_digests += chunk_digests
+            self.chunk_digests_lengths.append(len(chunk_digests))
+        self.file_sizes.append(file_size_bytes)
+        for metadata_column, metadata_value in zip(self.metadata_columns, file_metadata):
+            metadata_column.append(metadata_value)
+        if len(self.file_sizes) > 1:
+            self.paths += PATH_SEPARATOR_BYTES
+        self.paths += relative_path.encode(PATH_ENCODING, PATH_ERRORS)
+        if self.checkpoint_journal is not None:
+            self.checkpoint_journal.record(relative_path, hex_hash, file_size_bytes, file_metadata, chunk_digests)
+
+    # Build a DataFrame with columns relative_path, hash, file_size_bytes, and the metadata columns, in the order files
+    # were added. Each column is built with a single pass over its buffer, without going through a list of rows
+    def to_data_frame(self):
+        row_count = len(self)
+        if row_count == 0:
+            relative_paths = hashes = []
+        else:
+            relative_paths = self.paths.decode(PATH_ENCODING, PATH_ERRORS).split(PATH_SEPARATOR)
+            if self.store_hashes:
+                # Hex encode every digest at once, placing a separator between each 32-byte digest
+                # https://docs.python.org/3/library/stdtypes.html#bytes.hex
+                hashes = self.digests.hex("\n", DIGEST_BYTES).split("\n")
+            else:
+                hashes = [NOT_COMPUTED] * row_count
+        data_frame = DataFrame({"relative_path": relative_paths, "hash": hashes,
+                                "file_size_bytes": numpy.array(self.file_sizes, dtype="int64")})
+        for column_name, metadata_column in zip(METADATA_COLUMNS, self.metadata_columns):
+            data_frame[column_name] = numpy.array(metadata_column, dtype="int64")
+        if self.chunk_size_bytes is not None:
+            chunk_digests_view = memoryview(self.chunk_digests)
+            chunk_digests_hex = []
+            chunk_offset = 0
+            for chunk_digests_length in self.chunk_digests_lengths:
+                chunk_digests_hex.append(chunk_digests_to_hex(
+                    chunk_digests_view[chunk_offset:chunk_offset + chunk_digests_length]))
+                chunk_offset += chunk_digests_length
+            data_frame[CHUNK_DIGESTS_COLUMN] = chunk_digests_hex
+            data_frame[CHUNK_SIZE_COLUMN] = self.chunk_size_bytes
+        return data_frame
@@ -0,0 +1,156 @@
+# Used to find the /proc/diskstats line of the device a file is on
+from os import major, minor
+# Used to keep concurrent hashing threads from spending the same read budget twice
+from threading import Lock
+# Used to refill the read budget over time and to wait when it runs out
+from time import monotonic, sleep
+
+from .loghelper import get_logger_with_name
+
+# Kernel I/O statistics for every block device, one line per device
+# https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
+DISKSTATS_PATH = "/proc/diskstats"
+# /proc/diskstats counts sectors of 512 bytes, whatever the device's actual sector size
+DISKSTATS_SECTOR_BYTES = 512
+# Seconds between samples of /proc/diskstats in adaptive mode
+ADAPTIVE_SAMPLE_SECONDS = 1.0
+# Bytes per second of reads and writes by other programs above which the device is considered in use by them
+FOREGROUND_BYTES_PER_SECOND = 2 * 1000 * 1000
+# Bytes the device may read per byte hashed before the difference is blamed on other programs, allowing for readahead
+READAHEAD_ALLOWANCE = 1.5
+# The adaptive read rate never drops below this, so a device that stays busy slows a scan down but never stalls it
+MIN_ADAPTIVE_BYTES_PER_SECOND = 1000 * 1000
+# How much the adaptive read rate grows each quiet sample, and shrinks relative to the current rate each busy one
+ADAPTIVE_INCREASE_FACTOR = 1.5
+ADAPTIVE_DECREASE_FACTOR = 0.5
+
+
+# Read the counters of one device from /proc/diskstats, returning a Tuple of (I/Os completed, milliseconds spent on
+# them, bytes read, bytes written), or None if the device isn't listed, as is the case for network or FUSE filesystems
+def read_device_stats(device):
+    device_prefix = [str(major(device)), str(minor(device))]
+    try:
+        with open(DISKSTATS_PATH, "r") as stream:
+            for line in stream:
+                fields = line.split()
+                if fields[:2] != device_prefix:
+                    continue
+                reads, read_ms, sectors_read = int(fields[3]), int(fields[6]), int(fields[5])
+                writes, sectors_written, write_ms = int(fields[7]), int(fields[9]), int(fields[10])
+                return (reads + writes, read_ms + write_ms, sectors_read * DISKSTATS_SECTOR_BYTES,
+                        sectors_written * DISKSTATS_SECTOR_BYTES)
+    except OSError:
+        return None
+    return None
+
+
+# Limits the rate of reads from a single device with a token bucket, optionally adjusting the limit from /proc/diskstats
+class DeviceThrottle:
+    def __init__(self, device, max_bytes_per_second, adaptive, max_latency_ms, logger):
+        self.device = device
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_latency_ms = max_latency_ms
+        self.logger = logger
+        self.lock = Lock()
+        # Bytes that may be read right away. Allowed to go negative, which is paid back by waiting
+        self.tokens = 0.0
+        self.last_refill_time = monotonic()
+        self.throttled_seconds = 0.0
+        # The adaptive rate starts out unset, meaning only max_bytes_per_second applies, until the device gets busy
+        self.adaptive_bytes_per_second = None
+        self.last_device_stats = read_device_stats(device) if adaptive else None
+        if adaptive and self.last_device_stats is None:
+            logger.warning("Device {}:{} is not in {}, so reads from it can't adapt to its load".format(
+                major(device), minor(device), DISKSTATS_PATH))
+        self.last_sample_time = monotonic()
+        self.bytes_since_sample = 0
+
+    # Return the current limit in bytes per second, or None if reads are unlimited
+    def get_rate(self):
+        rates = [rate for rate in [self.max_bytes_per_second, self.adaptive_bytes_per_second] if rate is not None]
+        return min(rates) if rates else None
+
+    # Compare the device's counters against the last sample, slowing down when other programs are using it or its
+    # requests are waiting longer than max_latency_ms, and speeding back up while neither is true
+    def sample_device_stats(self, current_time):
+        device_stats = read_device_stats(self.device)
+        if device_stats is None:
+            return
+        elapsed_seconds = current_time - self.last_sample_time
+        io_count, io_ms, bytes_read, bytes_written = [current - previous for current, previous in
+                                                      zip(device_stats, self.last_device_stats)]
+        latency_ms = io_ms / io_count if io_count else 0
+        # Anything beyond what was hashed, give or take readahead, was read or written by something else
+        foreground_bytes = bytes_written + max(bytes_read - self.bytes_since_sample * READAHEAD_ALLOWANCE, 0)
+        foreground_bytes_per_second = foreground_bytes / elapsed_seconds
+        own_bytes_per_second = self.bytes_since_sample / elapsed_seconds
+        if latency_ms > self.max_latency_ms or foreground_bytes_per_second > FOREGROUND_BYTES_PER_SECOND:
+            self.adaptive_bytes_per_second = max(own_bytes_per_second * ADAPTIVE_DECREASE_FACTOR,
+                                                 MIN_ADAPTIVE_BYTES_PER_SECOND)
+            self.logger.debug("Device {}:{} is busy with {:.1f}ms latency and {:.1f}MBps of other I/O, limiting reads "
+                              "to {:.1f}MBps".format(major(self.device), minor(self.device), latency_ms,
+                                                     foreground_bytes_per_second / 1000 / 1000,
+                                                     self.adaptive_bytes_per_second / 1000 / 1000))
+        elif self.adaptive_bytes_per_second is not None:
+            self.adaptive_bytes_per_second *= ADAPTIVE_INCREASE_FACTOR
+            # Lift the adaptive limit once it's no longer what's holding reads back
+            if self.adaptive_bytes_per_second > own_bytes_per_second * ADAPTIVE_INCREASE_FACTOR * 2 or (
+                    self.max_bytes_per_second is not None
+                    and self.adaptive_bytes_per_second >= self.max_bytes_per_second):
+                self.adaptive_bytes_per_second = None
+        self.last_device_stats = device_stats
+        self.last_sample_time = current_time
+        self.bytes_since_sample = 0
+
+    # Account for byte_count bytes that were just read, waiting until the read budget allows for them
+    def consume(self, byte_count):
+        with self.lock:
+            current_time = monotonic()
+            if self.last_device_stats is not None and current_time - self.last_sample_time >= ADAPTIVE_SAMPLE_SECONDS:
+                self.sample_device_stats(current_time)
+            self.bytes_since_sample += byte_count
+            rate = self.get_rate()
+            if rate is None:
+                self.tokens = 0.0
+                self.last_refill_time = current_time
+                return
+            # Refill the bucket for the time passed, holding at most one second of reads so idle time can't be banked
+            self.tokens = min(self.tokens + (current_time - self.last_refill_time) * rate, rate)
+            self.last_refill_time = current_time
+            self.tokens -= byte_count
+            wait_seconds = -self.tokens / rate if self.tokens < 0 else 0
+            self.throttled_seconds += wait_seconds
+        # Wait outside the lock so other threads can queue up behind this one rather than behind the lock
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+
+
+# Throttles reads on each device separately, so scanning several disks at once gives each its own limit. With
+# max_read_mbps, reads from a device are capped at that many megabytes per second. With adaptive, each device's
+# /proc/diskstats counters are watched and reads back off while other programs are using it or its latency is high
+class ReadThrottle:
+    def __init__(self, max_read_mbps, adaptive, max_latency_ms, log_level):
+        self.logger = get_logger_with_name("ReadThrottle", log_level)
+        self.max_bytes_per_second = None if max_read_mbps is None else max_read_mbps * 1000 * 1000
+        self.adaptive = adaptive
+        self.max_latency_ms = max_latency_ms
+        # Dict of {key:device_id, value:DeviceThrottle}, created as new devices are encountered
+        self.device_throttle_dict = {}
+        self.device_throttle_lock = Lock()
+        self.logger.info("ReadThrottle initialized with a limit of {} per device, adapting to device load: {}".format(
+            "no limit" if max_read_mbps is None else "{}MBps".format(max_read_mbps), adaptive))
+
+    def get_device_throttle(self, device):
+        with self.device_throttle_lock:
+            if device not in self.device_throttle_dict:
+                self.device_throttle_dict[device] = DeviceThrottle(device, self.max_bytes_per_second, self.adaptive,
+                                                                   self.max_latency_ms, self.logger)
+            return self.device_throttle_dict[device]
+
+    # Account for byte_count bytes that were just read from the device, waiting if it's being read too quickly
+    def consume(self, device, byte_count):
+        self.get_device_throttle(device).consume(byte_count)
+
+    # Return the total seconds that reads from the device have been held back
+    def get_throttled_seconds(self, device):
+        return self.get_device_throttle(device).throttled_seconds
@@ -0,0 +1,84 @@
+# Watches scan directories with inotify between difflens runs, appending every changed path to a dirty journal so a run
+# with --incremental --dirty-journal only looks at those, rather than walking every directory. Meant to be left running,
+# such as from the Unraid go file, and stopped with Ctrl+C or SIGTERM. Linux only
+# Used for getting more easily defined CLI args
+import argparse
+# Used to name each watched directory's journal after its last directory, the same as difflens does
+from os import path
+# Used to flush the journals and exit cleanly when asked to stop
+from signal import SIGTERM, signal
+
+from difflens.util.commonutils import ROOT_NAME_PLACEHOLDER, format_root_path, sanitize_and_validate_directory_path
+from difflens.util.dirtyjournal import OVERFLOW_RECORD, DirtyJournalWriter, hold_watcher_lock
+from difflens.util.inotifywatcher import InotifyWatcher
+from difflens.util.loghelper import get_logger_with_name
+
+
+# Set up the argparse object that defines and handles program input arguments
+def configure_argument_parser():
+    parser = argparse.ArgumentParser(description="Record paths that change under scan directories to dirty journals "
+                                                 "for difflens --dirty-journal")
+    parser.add_argument("--scan-directory", "-s", help="Path(s) to watch, the same as those passed to difflens",
+                        type=str, nargs="+", required=True)
+    parser.add_argument("--dirty-journal", help="Journal to record changed paths to, the same as the one passed to "
+                                                "difflens. Must contain {} when watching multiple "
+                                                "directories".format(ROOT_NAME_PLACEHOLDER), type=str, required=True)
+    parser.add_argument("--flush-interval-seconds", help="Target interval in seconds between appending changed paths "
+                                                         "to the journals", type=float, default=1)
+    parser.add_argument("--log-level", "-l", help="Set log level",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], type=str, default="INFO")
+    return parser
+
+
+# Raise SystemExit on SIGTERM like Ctrl+C raises KeyboardInterrupt, so the journals are flushed on the way out
+def exit_on_signal(signal_number, _):
+    exit(128 + signal_number)
+
+
+def main():
+    args = configure_argument_parser().parse_args()
+    logger = get_logger_with_name("Watcher", args.log_level)
+    root_directories = [sanitize_and_validate_directory_path(root, logger) for root in args.scan_directory]
+    if len(root_directories) > 1 and ROOT_NAME_PLACEHOLDER not in args.dirty_journal:
+        logger.error("--dirty-journal {} must contain {} when watching multiple directories. Exiting".format(
+            args.dirty_journal, ROOT_NAME_PLACEHOLDER))
+        exit(1)
+    journal_paths = [format_root_path(args.dirty_journal, path.basename(root_directory))
+                     for root_directory in root_directories]
+    watcher_locks = []
+    journal_writers = []
+    for root_directory, journal_path in zip(root_directories, journal_paths):
+        try:
+            watcher_locks.append(hold_watcher_lock(journal_path, root_directory))
+        except BlockingIOError:
+            logger.error("Another watcher is already recording to {}. Exiting".format(journal_path))
+            exit(1)
+        journal_writer = DirtyJournalWriter(journal_path, logger)
+        # Changes made before every directory is watched are missed, so a run claiming the journal before then has
+        # to walk everything. Recorded right away so the journal isn't mistaken for one with nothing changed
+        journal_writer.record(OVERFLOW_RECORD, "its watcher started")
+        journal_writer.flush()
+        journal_writers.append(journal_writer)
+
+    watcher = InotifyWatcher(root_directories, journal_writers, logger)
+    signal(SIGTERM, exit_on_signal)
+    try:
+        for root_index, root_directory in enumerate(root_directories):
+            logger.info("Watching {} and recording changes to {}".format(root_directory, journal_paths[root_index]))
+            watch_count = watcher.add_watches(root_index, root_directory)
+            logger.info("Added {} watches under {}".format(watch_count, root_directory))
+            # A run that claimed the journal while watches were being added may have walked past a change made before
+            # its directory was watched, so the run after it has to walk everything too
+            journal_writers[root_index].record(OVERFLOW_RECORD, "its watcher finished watching every directory")
+        watcher.run(args.flush_interval_seconds)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, stopping watcher")
+    finally:
+        watcher.close()
+        for watcher_lock in watcher_locks:
+            watcher_lock.close()
+
+
+# Used for running via module mode, aka python -m difflens.watch
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,15 @@
 # https://vaneyckt.io/posts/safer_bash_scripts_with_set_euxo_pipefail/
 set -euo pipefail
 
-# Script to assist with running multiple difflens executions in parallel
+# Script to assist with running a difflens execution that scans every disk in parallel
 
 # Set the max disk number to check. Disks should be numbered 1,2,...,max_disk_num
 max_disk_num=3
 
 # Set the directory where difflens will write its output files. No trailing slash
 output_dir="/boot/logs"
-# Set the suffix of the output files
+# Set the suffix of the output files, whose extension picks how they're compressed. .tsv.zst and .tsv.lz4 are faster
+# but need the zstandard or lz4 wheel in dependency_wheel_dir
 file_suffix=".tsv.gz"
 
 # Set the directory where screen will output logs. No trailing slash
@@ -45,21 +46,35 @@ $pip3_path install $dependency_wheel_dir/difflens* --no-index --find-links file:
 # Set the executable that pip3 creates when installing
 difflens_wrapper="/usr/bin/difflens"
 
-echo "Assembling input arguments and starting screens for each disk"
+echo "Assembling input arguments and starting a screen scanning all disks"
+# Construct the root of the output files' names. All outputs will share this prefix and path, and difflens replaces
+# {root_name} with the name of each disk's directory, such as disk1 for /mnt/disk1
+output_file_root="$output_dir/$run_date-{root_name}"
+# Construct the path where the full scan's hash list is stored
+output_hash_file="$output_file_root-hashes$file_suffix"
+# Construct the path where the removed files list is stored
+output_removed_files="$output_file_root-removed$file_suffix"
+# Construct the path where the added files list is stored
+output_added_files="$output_file_root-added$file_suffix"
+# Construct the path where the modified files list is stored
+output_modified_files="$output_file_root-modified$file_suffix"
+# Construct the path where files moved or renamed within a disk are stored, keeping them out of the removed/added lists
+output_moved_files="$output_file_root-moved$file_suffix"
+# Construct the path where the duplicate files list is stored. Without {root_name}, duplicates are found across disks
+output_duplicates="$output_dir/$run_date-duplicates$file_suffix"
+# Construct the path of each disk's checkpoint journal. It's kept on the USB disk without the run date so a scan cut
+# short by a reboot is resumed by the next run, and is removed once a run completes
+checkpoint_file="$output_dir/{root_name}-checkpoint.tsv"
+# Construct the path where phase timings, memory use, and hashing throughput of the run are stored, for graphing scan
+# health across disks and runs
+metrics_json_file="$output_dir/$run_date-metrics.json"
+
+scan_directories=""
+comparison_args=""
 # https://stackoverflow.com/questions/169511
 for disk_num in $(seq 1 $max_disk_num); do
-    # Construct the root of the output files' names. All outputs will share this prefix and path
-    output_file_root="$output_dir/$run_date-disk$disk_num"
-    # Construct the path where the full scan's hash list is stored
-    output_hash_file="$output_file_root-hashes$file_suffix"
-    # Construct the path where the removed files list is stored
-    output_removed_files="$output_file_root-removed$file_suffix"
-    # Construct the path where the added files list is stored
-    output_added_files="$output_file_root-added$file_suffix"
-    # Construct the path where the modified files list is stored
-    output_modified_files="$output_file_root-modified$file_suffix"
-    # Construct the path where the duplicate files list is stored
-    output_duplicates="$output_file_root-duplicates$file_suffix"
+    # Construct the path to the disk. Relative paths in the output files are relative to this directory
+    scan_directories="$scan_directories /mnt/disk$disk_num"
 
     # Find the previous hash to diff against.
     # Filenames are prefixed with date, so can sort and get the last line to find the most recent file
@@ -70,54 +85,58 @@ for disk_num in $(seq 1 $max_disk_num); do
     # https://stackoverflow.com/questions/1015678/get-most-recent-file-in-a-directory-on-linux
     previous_hash_file_pattern="*-disk$disk_num-hashes$file_suffix"
     previous_hash_file=$(find "$output_dir" -type f -maxdepth 1 -name "$previous_hash_file_pattern" | sort -n | tail -1)
-    # If the previous file did not exist, make a stand-in path instead of an empty string
+    # If the previous file did not exist, make a stand-in path instead of an empty string. difflens skips the
+    # comparison for that disk only
     # https://www.cyberciti.biz/faq/unix-linux-bash-script-check-if-variable-is-empty/
     [[ -z "$previous_hash_file" ]] && previous_hash_file="no_such_file"
     echo "The files on disk$disk_num will be compared against $previous_hash_file"
-
-    # Construct the path to the disk, which is used as the working directory.
-    # This sets up the relative path stored in the output files
-    cd "/mnt/disk$disk_num"
-
-    # Construct the list of input arguments
-    # https://stackoverflow.com/questions/46807924/bash-split-long-string-argument-to-multiple-lines
-    difflens_args="--scan-directory . \
-      --output-hash-file $output_hash_file \
-      --comparison-hash-file $previous_hash_file \
-      --output-removed-files $output_removed_files \
-      --output-added-files $output_added_files \
-      --output-modified-files $output_modified_files \
-      --output-duplicates $output_duplicates  \
-      --exclude-file-extension .DS_Store  \
-      --exclude-file-extension .nfo  \
-      --exclude-file-extension .ignore  \
-      --exclude-relative-path TimeMachine \
-      --log-update-interval-seconds 60"
-
-    # Construct the full command used to start up difflens.
-    difflens_command="$difflens_wrapper $difflens_args"
-    echo -e "\nExecuting $difflens_command\n"
-
-    # Construct the screen session name and log path
-    screen_name="disk$disk_num-difflens"
-    screen_log_path="$log_output_dir/$run_date-$screen_name.log"
-    # Send a notification indicating that DiffLens is starting, indicating hostname, disk number, and log path.
-    # https://forums.unraid.net/topic/61996-cron-jobs-notify/
-    bash -c "$notify_path -s 'DiffLens started on $($hostname_path)-disk$disk_num' -d 'Logs located at $screen_log_path'"
-    # Prepare a similar notification for after the job completes
-    notify_command="$notify_path -s 'DiffLens finished on $($hostname_path)-disk$disk_num' -d 'Logs located at $screen_log_path'"
-
-    # Add command on the difflens initiation to send an Unraid notification when finished, regardless of exit code
-    daemon_command="$difflens_command; $notify_command"
-
-    # Run the script in a detached screen session
-    # -L required to enable logs. -Logfile to specify where. -S to name the session. -dm <cmd> to run <cmd> in screen
-    # https://superuser.com/questions/454907/how-to-execute-a-command-in-screen-and-detach
-    # https://fvdm.com/code/howto-write-screen-output-to-a-log-file
-    $screen_path -L -Logfile "$screen_log_path" -S "$screen_name" -dm bash -c "$daemon_command"
-    echo -e "Monitor logs at $screen_log_path for Screen with name $screen_name\n\n"
+    # Comparison files are matched up with scan directories in the order they're passed in
+    comparison_args="$comparison_args --comparison-hash-file $previous_hash_file"
 done
 
-echo "Screens started for $max_disk_num difflens executions. Use screen -r <name> to connect."
+# Construct the list of input arguments
+# https://stackoverflow.com/questions/46807924/bash-split-long-string-argument-to-multiple-lines
+difflens_args="--scan-directory $scan_directories \
+  --output-hash-file $output_hash_file \
+  $comparison_args \
+  --output-removed-files $output_removed_files \
+  --output-added-files $output_added_files \
+  --output-modified-files $output_modified_files \
+  --output-moved-files $output_moved_files \
+  --output-duplicates $output_duplicates  \
+  --checkpoint-file $checkpoint_file \
+  --resume \
+  --metrics-json-file $metrics_json_file \
+  --compression-threads 4 \
+  --exclude-file-extension .DS_Store  \
+  --exclude-file-extension .nfo  \
+  --exclude-file-extension .ignore  \
+  --exclude-relative-path TimeMachine \
+  --log-update-interval-seconds 60"
+
+# Construct the full command used to start up difflens. Bash leaves {root_name} as-is, as it has no comma or range
+difflens_command="$difflens_wrapper $difflens_args"
+echo -e "\nExecuting $difflens_command\n"
+
+# Construct the screen session name and log path
+screen_name="difflens"
+screen_log_path="$log_output_dir/$run_date-$screen_name.log"
+# Send a notification indicating that DiffLens is starting, indicating hostname, disk count, and log path.
+# https://forums.unraid.net/topic/61996-cron-jobs-notify/
+bash -c "$notify_path -s 'DiffLens started on $($hostname_path) for $max_disk_num disks' -d 'Logs located at $screen_log_path'"
+# Prepare a similar notification for after the job completes
+notify_command="$notify_path -s 'DiffLens finished on $($hostname_path) for $max_disk_num disks' -d 'Logs located at $screen_log_path'"
+
+# Add command on the difflens initiation to send an Unraid notification when finished, regardless of exit code
+daemon_command="$difflens_command; $notify_command"
+
+# Run the script in a detached screen session
+# -L required to enable logs. -Logfile to specify where. -S to name the session. -dm <cmd> to run <cmd> in screen
+# https://superuser.com/questions/454907/how-to-execute-a-command-in-screen-and-detach
+# https://fvdm.com/code/howto-write-screen-output-to-a-log-file
+$screen_path -L -Logfile "$screen_log_path" -S "$screen_name" -dm bash -c "$daemon_command"
+echo -e "Monitor logs at $screen_log_path for Screen with name $screen_name\n\n"
+
+echo "Screen started for a difflens execution across $max_disk_num disks. Use screen -r $screen_name to connect."
 # https://github.com/koalaman/shellcheck/wiki/SC2005
 $screen_path -list
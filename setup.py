@@ -7,7 +7,9 @@ setuptools.setup(
     # https://packaging.python.org/guides/distributing-packages-using-setuptools/#packages
     packages=setuptools.find_packages(),
     # https://packaging.python.org/guides/distributing-packages-using-setuptools/#entry-points
-    entry_points={"console_scripts": ["difflens = difflens.run:main"]},
+    entry_points={"console_scripts": ["difflens = difflens.run:main", "difflens-convert = difflens.convert:main",
+                                      "difflens-index = difflens.index:main",
+                                      "difflens-watch = difflens.watch:main"]},
     # https://packaging.python.org/guides/distributing-packages-using-setuptools/#install-requires
     # NOTE: The Pipfile is for setting up the build/dev env while install_requires tells Pip what dependencies
     # are also needed when installing this .whl from a package index